@@ -0,0 +1,206 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from time import monotonic
+
+from . import metrics
+
+__all__ = ['AdmissionException', 'AdmissionScheduler']
+
+logger = logging.getLogger('ccb.admission')
+
+
+class AdmissionException(Exception):
+	'''
+	The request was not admitted: the queue is full or the wait timed out.
+	'''
+	def __init__(self, message: str, retry_after: float):
+		super().__init__(message)
+		self.retry_after = retry_after
+
+
+class _Waiter:
+	def __init__(self, wake: Callable[[], None]):
+		self.wake = wake
+		self.granted = False
+		self.enqueued_at = monotonic()
+
+
+class AdmissionScheduler:
+	'''
+	Lets at most max_in_flight requests use a backend at once, the others wait in a bounded queue.
+	The queue is ordered by arrival time plus priority_secs_per_kchar seconds per 1000 characters
+	of the prompt, so short prompts are served first but a long prompt is not overtaken forever.
+
+	Sync callers (threads) and async callers (of any event loop) share the same slots.
+	'''
+
+	def __init__(
+		self,
+		name: str,
+		max_in_flight: int,
+		max_queued: int,
+		queue_timeout_secs: float,
+		priority_secs_per_kchar: float,
+	):
+		self.name = name
+		self.max_in_flight = max(max_in_flight, 1)
+		self.max_queued = max_queued
+		self.queue_timeout_secs = queue_timeout_secs
+		self.priority_secs_per_kchar = priority_secs_per_kchar
+
+		self._lock = threading.Lock()
+		self._in_flight = 0
+		self._queue: list[tuple[float, int, _Waiter]] = []
+		self._seq = itertools.count()
+
+	def _update_gauges(self):
+		metrics.set_gauge(f'{self.name}.in_flight', self._in_flight)
+		metrics.set_gauge(f'{self.name}.queue_depth', len(self._queue))
+
+	def _enqueue(self, prompt_len: int, wake: Callable[[], None]) -> _Waiter | None:
+		'''
+		Returns None if a slot was free, else the queued waiter
+
+		Raises
+		------
+		AdmissionException
+			The queue is full
+		'''
+		with self._lock:
+			if self._in_flight < self.max_in_flight and len(self._queue) == 0:
+				self._in_flight += 1
+				self._update_gauges()
+				metrics.observe(f'{self.name}.wait_secs', 0)
+				return None
+
+			if len(self._queue) >= self.max_queued:
+				metrics.inc(f'{self.name}.rejected')
+				logger.warning(f'{self.name}: rejected a request, {len(self._queue)} requests are queued')
+				raise AdmissionException(
+					f'Too many queued requests ({len(self._queue)}), try again later',
+					self.queue_timeout_secs,
+				)
+
+			waiter = _Waiter(wake)
+			priority = waiter.enqueued_at + prompt_len / 1000 * self.priority_secs_per_kchar
+			heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+			self._update_gauges()
+			return waiter
+
+	def _dequeue(self, waiter: _Waiter) -> bool:
+		'''
+		Removes a waiter that gave up, returns False if it was given a slot in the meantime
+		'''
+		with self._lock:
+			if waiter.granted:
+				return True
+			self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+			heapq.heapify(self._queue)
+			self._update_gauges()
+			return False
+
+	def _admitted(self, waiter: _Waiter):
+		metrics.observe(f'{self.name}.wait_secs', monotonic() - waiter.enqueued_at)
+
+	def _timed_out(self, waiter: _Waiter) -> AdmissionException:
+		metrics.inc(f'{self.name}.timeouts')
+		logger.warning(f'{self.name}: a request timed out after {monotonic() - waiter.enqueued_at:.1f}s in the queue')
+		return AdmissionException(
+			f'Request was not admitted in {self.queue_timeout_secs} seconds, try again later',
+			self.queue_timeout_secs,
+		)
+
+	def acquire(self, prompt_len: int = 0):
+		'''
+		Blocks until a slot is free
+
+		Raises
+		------
+		AdmissionException
+		'''
+		event = threading.Event()
+		if (waiter := self._enqueue(prompt_len, event.set)) is None:
+			return
+
+		if not event.wait(self.queue_timeout_secs) and not self._dequeue(waiter):
+			raise self._timed_out(waiter)
+		self._admitted(waiter)
+
+	async def aacquire(self, prompt_len: int = 0):
+		'''
+		Same as acquire but waits on the event loop instead of blocking a thread
+
+		Raises
+		------
+		AdmissionException
+		'''
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+
+		def wake():
+			loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+		if (waiter := self._enqueue(prompt_len, wake)) is None:
+			return
+
+		try:
+			await asyncio.wait_for(future, self.queue_timeout_secs)
+		except TimeoutError:
+			if not self._dequeue(waiter):
+				raise self._timed_out(waiter) from None
+		except asyncio.CancelledError:
+			# the request was cancelled, e.g. the client disconnected
+			if self._dequeue(waiter):
+				self.release()
+			raise
+		self._admitted(waiter)
+
+	def try_acquire_all(self) -> bool:
+		'''
+		Takes all the slots if nothing is running or queued, e.g. to unload the model.
+		Release them with release_all().
+		'''
+		with self._lock:
+			if self._in_flight > 0 or len(self._queue) > 0:
+				return False
+			self._in_flight = self.max_in_flight
+			self._update_gauges()
+			return True
+
+	def release(self, count: int = 1):
+		with self._lock:
+			self._in_flight -= count
+			while len(self._queue) > 0 and self._in_flight < self.max_in_flight:
+				_, _, waiter = heapq.heappop(self._queue)
+				waiter.granted = True
+				self._in_flight += 1
+				waiter.wake()
+			self._update_gauges()
+
+	def release_all(self):
+		self.release(self.max_in_flight)
+
+	@contextmanager
+	def slot(self, prompt_len: int = 0) -> Iterator[None]:
+		self.acquire(prompt_len)
+		try:
+			yield
+		finally:
+			self.release()
+
+	@asynccontextmanager
+	async def aslot(self, prompt_len: int = 0) -> AsyncIterator[None]:
+		await self.aacquire(prompt_len)
+		try:
+			yield
+		finally:
+			self.release()
@@ -32,6 +32,25 @@ def get_context_docs(
 	return vectordb.doc_search(user_id, query, ctx_limit, scope_type, scope_list)
 
 
+async def aget_context_docs(
+	user_id: str,
+	query: str,
+	vectordb: BaseVectorDB,
+	ctx_limit: int,
+	scope_type: ScopeType | None = None,
+	scope_list: list[str] | None = None,
+) -> list[Document]:
+	if not scope_type:
+		logger.debug('Searching for context docs without scope')
+		return await vectordb.adoc_search(user_id, query, ctx_limit)
+
+	if not scope_list:
+		raise ContextException('Error: scope list must be provided and not empty if scope type is provided')
+
+	logger.debug('Searching for context docs with scope')
+	return await vectordb.adoc_search(user_id, query, ctx_limit, scope_type, scope_list)
+
+
 def get_context_chunks(context_docs: list[Document]) -> list[str]:
 	context_chunks = []
 	for doc in context_docs:
@@ -42,27 +61,25 @@ def get_context_chunks(context_docs: list[Document]) -> list[str]:
 	return context_chunks
 
 
-def do_doc_search(
-	user_id: str,
-	query: str,
-	vectordb_loader: VectorDBLoader,
-	ctx_limit: int = 20,
-	scope_type: ScopeType | None = None,
-	scope_list: list[str] | None = None,
-) -> list[SearchResult]:
-	"""
-	Raises
-	------
-	ContextException
-		If the scope type is provided but the scope list is empty or not provided
-	"""
-	db = vectordb_loader.load()
-	augmented_limit = ctx_limit * 2 # to account for duplicate sources
-	docs = get_context_docs(user_id, query, db, augmented_limit, scope_type, scope_list)
-	if len(docs) == 0:
-		logger.warning('No documents retrieved, please index a few documents first')
-		return []
+def get_context_chunk_ids(context_docs: list[Document]) -> list[str | None]:
+	'''
+	Keys of the chunks returned by get_context_chunks to memoize their token counts
+	'''
+	chunk_ids: list[str | None] = []
+	for doc in context_docs:
+		if title := doc.metadata.get('title'):
+			chunk_ids.append(f'title:{title}')
+		chunk_ids.append(doc.id)
 
+	return chunk_ids
+
+
+def _to_search_results(
+	docs: list[Document],
+	ctx_limit: int,
+	scope_type: ScopeType | None,
+	scope_list: list[str] | None,
+) -> list[SearchResult]:
 	sources_cache = {}
 	results: list[SearchResult] = []
 	for doc in docs:
@@ -90,3 +107,53 @@ def do_doc_search(
 		'scope_list': scope_list,
 	})
 	return results
+
+
+def do_doc_search(
+	user_id: str,
+	query: str,
+	vectordb_loader: VectorDBLoader,
+	ctx_limit: int = 20,
+	scope_type: ScopeType | None = None,
+	scope_list: list[str] | None = None,
+) -> list[SearchResult]:
+	"""
+	Raises
+	------
+	ContextException
+		If the scope type is provided but the scope list is empty or not provided
+	"""
+	db = vectordb_loader.load()
+	augmented_limit = ctx_limit * 2 # to account for duplicate sources
+	docs = get_context_docs(user_id, query, db, augmented_limit, scope_type, scope_list)
+	if len(docs) == 0:
+		logger.warning('No documents retrieved, please index a few documents first')
+		return []
+
+	return _to_search_results(docs, ctx_limit, scope_type, scope_list)
+
+
+async def ado_doc_search(
+	user_id: str,
+	query: str,
+	vectordb_loader: VectorDBLoader,
+	ctx_limit: int = 20,
+	scope_type: ScopeType | None = None,
+	scope_list: list[str] | None = None,
+) -> list[SearchResult]:
+	"""
+	Async variant of do_doc_search
+
+	Raises
+	------
+	ContextException
+		If the scope type is provided but the scope list is empty or not provided
+	"""
+	db = await vectordb_loader.aload()
+	augmented_limit = ctx_limit * 2 # to account for duplicate sources
+	docs = await aget_context_docs(user_id, query, db, augmented_limit, scope_type, scope_list)
+	if len(docs) == 0:
+		logger.warning('No documents retrieved, please index a few documents first')
+		return []
+
+	return _to_search_results(docs, ctx_limit, scope_type, scope_list)
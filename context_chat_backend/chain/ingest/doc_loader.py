@@ -3,10 +3,15 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 
+import codecs
+import io
 import logging
+import os
 import re
+import shutil
 import tempfile
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
 from typing import BinaryIO
 
 import docx2txt
@@ -21,11 +26,43 @@ from striprtf import striprtf
 
 logger = logging.getLogger('ccb.doc_loader')
 
-def _temp_file_wrapper(file: BinaryIO, loader: Callable, sep: str = '\n') -> str:
-	raw_bytes = file.read()
+READ_CHUNK_SIZE = 1024 * 1024
+
+@contextmanager
+def _file_path(file: BinaryIO) -> Iterator[str]:
+	'''
+	Yields a path to the file for the loaders that only accept paths.
+	The upload is already spooled to disk so it is opened again through /proc/self/fd without a copy,
+	it is only copied (in chunks) to a temporary file if it has no file descriptor.
+	'''
+	try:
+		fd = file.fileno()
+	except (AttributeError, OSError, io.UnsupportedOperation):
+		fd = None
+
+	if fd is not None and os.path.exists(f'/proc/self/fd/{fd}'):
+		yield f'/proc/self/fd/{fd}'
+		return
+
 	with tempfile.NamedTemporaryFile(mode='wb') as tmp:
-		tmp.write(raw_bytes)
-		docs = loader(tmp.name)
+		shutil.copyfileobj(file, tmp, READ_CHUNK_SIZE)
+		tmp.flush()
+		yield tmp.name
+
+
+def _read_text(file: BinaryIO) -> str:
+	'''
+	Decodes the file in chunks so the raw bytes are never held in memory all at once
+	'''
+	decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+	chunks = [decoder.decode(chunk) for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b'')]
+	chunks.append(decoder.decode(b'', final=True))
+	return ''.join(chunks)
+
+
+def _file_path_wrapper(file: BinaryIO, loader: Callable, sep: str = '\n') -> str:
+	with _file_path(file) as path:
+		docs = loader(path)
 
 	if isinstance(docs, str) or isinstance(docs, bytes):
 		return docs.decode('utf-8', 'ignore') if isinstance(docs, bytes) else docs  # pyright: ignore[reportReturnType]
@@ -45,7 +82,7 @@ def _load_csv(file: BinaryIO) -> str:
 
 
 def _load_epub(file: BinaryIO) -> str:
-	return _temp_file_wrapper(file, epub2txt).strip()
+	return _file_path_wrapper(file, epub2txt).strip()
 
 
 def _load_docx(file: BinaryIO) -> str:
@@ -53,21 +90,25 @@ def _load_docx(file: BinaryIO) -> str:
 
 
 def _load_odt(file: BinaryIO) -> str:
-	return _temp_file_wrapper(file, lambda fp: Document(fp).get_formatted_text()).strip()
+	return _file_path_wrapper(file, lambda fp: Document(fp).get_formatted_text()).strip()
 
 
 def _load_ppt_x(file: BinaryIO) -> str:
-	return _temp_file_wrapper(file, lambda fp: UnstructuredLoader(fp).load()).strip()
+	return _file_path_wrapper(file, lambda fp: UnstructuredLoader(fp).load()).strip()
 
 
 def _load_rtf(file: BinaryIO) -> str:
-	return striprtf.rtf_to_text(file.read().decode('utf-8', 'ignore')).strip()
+	return striprtf.rtf_to_text(_read_text(file)).strip()
 
 
 def _load_xml(file: BinaryIO) -> str:
-	data = file.read().decode('utf-8', 'ignore')
-	data = re.sub(r'</.+>', '', data)
-	return data.strip()
+	# the closing tags never span lines, so they are removed line by line while decoding
+	reader = io.TextIOWrapper(file, encoding='utf-8', errors='ignore', newline='')
+	try:
+		return ''.join(re.sub(r'</.+>', '', line) for line in reader).strip()
+	finally:
+		# the caller closes the file
+		reader.detach()
 
 
 def _load_xlsx(file: BinaryIO) -> str:
@@ -89,7 +130,7 @@ def _load_email(file: BinaryIO, ext: str = 'eml') -> str | None:
 	):
 		...
 
-	return _temp_file_wrapper(
+	return _file_path_wrapper(
 		file,
 		lambda fp: UnstructuredLoader(fp, process_attachments=False).load(),
 	).strip()
@@ -131,12 +172,15 @@ def decode_source(source: UploadFile) -> str | None:
 			source.file.close()
 			return result
 
-		result = source.file.read().decode('utf-8', 'ignore')
+		result = _read_text(source.file)
 		source.file.close()
 		return result
 	except PdfFileNotDecryptedError:
 		logger.warning(f'PDF file ({source.filename}) is encrypted and cannot be read')
 		return None
+	except MemoryError:
+		# the source is retried later instead of being treated as empty
+		raise
 	except Exception:
 		logger.exception(f'Error decoding source file ({source.filename})', stack_info=True)
 		return None
@@ -2,10 +2,71 @@
 # SPDX-FileCopyrightText: 2023 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import re
+import zlib
 from functools import lru_cache
+from itertools import pairwise
 
 from langchain.text_splitter import MarkdownTextSplitter, RecursiveCharacterTextSplitter, TextSplitter
 
+# chunks are only cut after a line break or the end of a sentence unless a chunk would get too long
+_CUT_CANDIDATE_RE = re.compile(r'\n\s*|[.!?;]\s+')
+_WHITESPACE_RE = re.compile(r'\s+')
+# characters before a cut candidate that decide whether it is a chunk boundary
+_BOUNDARY_WINDOW = 64
+
+
+class ContentDefinedSplitter(TextSplitter):
+	'''
+	Splits the text where the content before a cut candidate hashes below a threshold, like the
+	content-defined chunking of backup tools, instead of greedily filling chunks from the start.
+	An edit only moves the boundaries of the chunks around it, so the other chunks of a modified
+	document stay identical and can be matched with the stored ones.
+	The chunks do not overlap, an overlap would make the edit change the next chunk too.
+	'''
+
+	def __init__(self, chunk_size: int, **kwargs):
+		super().__init__(chunk_size=chunk_size, chunk_overlap=0, **kwargs)
+		self._min_size = chunk_size // 4
+		# expected characters between the minimum size and the cut
+		self._avg_gap = max(chunk_size // 3, 1)
+
+	def _is_boundary(self, text: str, gap: int, pos: int) -> bool:
+		# the probability grows with the distance to the previous candidate so that the expected
+		# chunk size does not depend on how dense the candidates are
+		window = text[max(pos - _BOUNDARY_WINDOW, 0):pos]
+		return zlib.crc32(window.encode('utf-8')) < min(gap / self._avg_gap, 1) * 2**32
+
+	def _forced_cut(self, text: str, start: int) -> int:
+		# no boundary before the maximum size, cut at the last whitespace that fits
+		span = text[start + self._min_size:start + self._chunk_size]
+		ends = [m.end() for m in _WHITESPACE_RE.finditer(span)]
+		if len(ends) == 0:
+			return start + self._chunk_size
+		return start + self._min_size + ends[-1]
+
+	def split_text(self, text: str) -> list[str]:
+		cuts = [0]
+		prev = 0
+		for m in _CUT_CANDIDATE_RE.finditer(text):
+			pos = m.end()
+			while pos - cuts[-1] > self._chunk_size:
+				cuts.append(prev if prev - cuts[-1] >= self._min_size else self._forced_cut(text, cuts[-1]))
+
+			start = cuts[-1]
+			if pos - start >= self._min_size and self._is_boundary(text, pos - max(prev, start), pos):
+				cuts.append(pos)
+			prev = pos
+
+		while len(text) - cuts[-1] > self._chunk_size:
+			cuts.append(self._forced_cut(text, cuts[-1]))
+		cuts.append(len(text))
+
+		chunks = (text[a:b] for a, b in pairwise(cuts))
+		if self._strip_whitespace:
+			chunks = (chunk.strip() for chunk in chunks)
+		return [chunk for chunk in chunks if chunk != '']
+
 
 @lru_cache(maxsize=32)
 def get_splitter_for(chunk_size: int, mimetype: str = 'text/plain') -> TextSplitter:
@@ -39,4 +100,12 @@ def get_splitter_for(chunk_size: int, mimetype: str = 'text/plain') -> TextSplit
 	)
 
 
-__all__ = [ 'get_splitter_for' ]
+@lru_cache(maxsize=8)
+def get_content_defined_splitter(chunk_size: int) -> TextSplitter:
+	'''
+	Splitter with stable chunk boundaries for all mimetypes, used for the incremental re-indexing
+	'''
+	return ContentDefinedSplitter(chunk_size, add_start_index=True, strip_whitespace=True)
+
+
+__all__ = [ 'get_content_defined_splitter', 'get_splitter_for' ]
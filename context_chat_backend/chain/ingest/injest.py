@@ -3,8 +3,11 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 import logging
+import os
 import re
+import resource
 
+import psutil
 from fastapi.datastructures import UploadFile
 from langchain.schema import Document
 
@@ -13,20 +16,25 @@ from ...types import TConfig
 from ...utils import is_valid_source_id, to_int
 from ...vectordb.base import BaseVectorDB
 from ...vectordb.types import DbException, SafeDbException, UpdateAccessOp
+from ...worker_pool import WorkerPool
 from ..types import InDocument
 from .doc_loader import decode_source
-from .doc_splitter import get_splitter_for
+from .doc_splitter import get_content_defined_splitter, get_splitter_for
 from .mimetype_list import SUPPORTED_MIMETYPES
+from .pipeline import IngestPipeline, PipelineStage
 
 logger = logging.getLogger('ccb.injest')
 
+_decode_pools: dict[int, WorkerPool] = {}
+
 def _allowed_file(file: UploadFile) -> bool:
 	return file.headers['type'] in SUPPORTED_MIMETYPES
 
 
 def _filter_sources(
 	vectordb: BaseVectorDB,
-	sources: list[UploadFile]
+	sources: list[UploadFile],
+	incremental: bool,
 ) -> tuple[list[UploadFile], list[UploadFile]]:
 	'''
 	Returns
@@ -37,7 +45,7 @@ def _filter_sources(
 	'''
 
 	try:
-		existing_sources, new_sources = vectordb.check_sources(sources)
+		existing_sources, new_sources = vectordb.check_sources(sources, incremental)
 	except Exception as e:
 		raise DbException('Error: Vectordb sources_to_embed error') from e
 
@@ -50,55 +58,111 @@ def _filter_sources(
 	])
 
 
-def _sources_to_indocuments(config: TConfig, sources: list[UploadFile]) -> list[InDocument]:
-	indocuments = []
-
-	for source in sources:
-		logger.debug('processing source', extra={ 'source_id': source.filename })
+def _limit_memory(max_memory_mb: int):
+	'''
+	Caps the address space of a decode worker at its current size plus max_memory_mb
+	so that a runaway parser fails with a MemoryError instead of taking the container down.
+	'''
+	if max_memory_mb <= 0:
+		return
+	limit = psutil.Process().memory_info().vms + max_memory_mb * 1024 * 1024
+	resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _get_decode_pool(config: TConfig) -> WorkerPool:
+	# one pool per ingest worker process, its workers are terminated with the ingest worker
+	pid = os.getpid()
+	if pid not in _decode_pools:
+		_decode_pools[pid] = WorkerPool(
+			'ccb-decode',
+			config.ingest_pipeline.parse_workers,
+			config.worker_max_tasks,
+			config.worker_max_rss_mb,
+			initializer=_limit_memory,
+			initargs=(config.ingest_pipeline.parse_max_memory_mb,),
+			daemon=True,
+		)
+	return _decode_pools[pid]
+
+
+def _decode_and_clean(source: UploadFile) -> str | None:
+	'''
+	Runs in a decode worker process
+	'''
+	# transform the source to have text data
+	content = decode_source(source)
 
-		# transform the source to have text data
-		content = decode_source(source)
+	if content is None or (content := content.strip()) == '':
+		logger.debug('decoded empty source', extra={ 'source_id': source.filename })
+		return None
 
-		if content is None or (content := content.strip()) == '':
-			logger.debug('decoded empty source', extra={ 'source_id': source.filename })
-			continue
+	# replace more than two newlines with two newlines (also blank spaces, more than 4)
+	content = re.sub(r'((\r)?\n){3,}', '\n\n', content)
+	# NOTE: do not use this with all docs when programming files are added
+	content = re.sub(r'(\s){5,}', r'\g<1>', content)
+	# filter out null bytes
+	content = content.replace('\0', '')
 
-		# replace more than two newlines with two newlines (also blank spaces, more than 4)
-		content = re.sub(r'((\r)?\n){3,}', '\n\n', content)
-		# NOTE: do not use this with all docs when programming files are added
-		content = re.sub(r'(\s){5,}', r'\g<1>', content)
-		# filter out null bytes
-		content = content.replace('\0', '')
+	if content is None or content == '':
+		logger.debug('decoded empty source after cleanup', extra={ 'source_id': source.filename })
+		return None
 
-		if content is None or content == '':
-			logger.debug('decoded empty source after cleanup', extra={ 'source_id': source.filename })
-			continue
+	return content
 
-		logger.debug('decoded non empty source', extra={ 'source_id': source.filename })
 
-		metadata = {
-			'source': source.filename,
-			'title': _decode_latin_1(source.headers['title']),
-			'type': source.headers['type'],
-		}
-		doc = Document(page_content=content, metadata=metadata)
+def _parse_source(config: TConfig, source: UploadFile) -> tuple[UploadFile, str] | None:
+	'''
+	Raises
+	------
+	WorkerPoolException
+		If the decoding timed out or the decode worker crashed
+	MemoryError
+		If the decoding went over the memory limit
+	'''
+	logger.debug('processing source', extra={ 'source_id': source.filename })
 
+	try:
+		# the upload's file descriptor is shared with the decode worker, not its contents
+		content = _get_decode_pool(config).submit(
+			_decode_and_clean,
+			args=(source,),
+			timeout=config.ingest_pipeline.parse_timeout_secs or None,
+		)
+	finally:
+		source.file.close()
+
+	if content is None:
+		return None
+
+	logger.debug('decoded non empty source', extra={ 'source_id': source.filename })
+	return source, content
+
+
+def _split_source(config: TConfig, source: UploadFile, content: str) -> InDocument:
+	metadata = {
+		'source': source.filename,
+		'title': _decode_latin_1(source.headers['title']),
+		'type': source.headers['type'],
+	}
+	doc = Document(page_content=content, metadata=metadata)
+
+	if config.ingest_pipeline.incremental_reindex:
+		splitter = get_content_defined_splitter(config.embedding_chunk_size)
+	else:
 		splitter = get_splitter_for(config.embedding_chunk_size, source.headers['type'])
-		split_docs = splitter.split_documents([doc])
-		logger.debug('split document into chunks', extra={
-			'source_id': source.filename,
-			'len(split_docs)': len(split_docs),
-		})
-
-		indocuments.append(InDocument(
-			documents=split_docs,
-			userIds=list(map(_decode_latin_1, source.headers['userIds'].split(','))),
-			source_id=source.filename,  # pyright: ignore[reportArgumentType]
-			provider=source.headers['provider'],
-			modified=to_int(source.headers['modified']),
-		))
+	split_docs = splitter.split_documents([doc])
+	logger.debug('split document into chunks', extra={
+		'source_id': source.filename,
+		'len(split_docs)': len(split_docs),
+	})
 
-	return indocuments
+	return InDocument(
+		documents=split_docs,
+		userIds=list(map(_decode_latin_1, source.headers['userIds'].split(','))),
+		source_id=source.filename,  # pyright: ignore[reportArgumentType]
+		provider=source.headers['provider'],
+		modified=to_int(source.headers['modified']),
+	)
 
 
 def _process_sources(
@@ -110,7 +174,8 @@ def _process_sources(
 	Processes the sources and adds them to the vectordb.
 	Returns the list of source ids that were successfully added and those that need to be retried.
 	'''
-	existing_sources, filtered_sources = _filter_sources(vectordb, sources)
+	pconf = config.ingest_pipeline
+	existing_sources, filtered_sources = _filter_sources(vectordb, sources, pconf.incremental_reindex)
 	logger.debug('db filter source results', extra={
 		'len(existing_sources)': len(existing_sources),
 		'existing_sources': existing_sources,
@@ -144,19 +209,28 @@ def _process_sources(
 	logger.debug('Filtered sources:', extra={
 		'source_ids': [source.filename for source in filtered_sources]
 	})
-	# invalid/empty sources are filtered out here and not counted in loaded/retryable
-	indocuments = _sources_to_indocuments(config, filtered_sources)
-
-	logger.debug('Converted all sources to documents')
-
-	if len(indocuments) == 0:
-		# filtered document(s) were invalid/empty, not an error
-		logger.debug('All documents were found empty after being processed')
-		return loaded_source_ids, []  # pyright: ignore[reportReturnType]
-
-	added_source_ids, retry_source_ids = vectordb.add_indocuments(indocuments)
+	# the sources are parsed, split, embedded and written concurrently
+	# invalid/empty sources are filtered out in the parse stage and not counted in loaded/retryable
+	pipeline = IngestPipeline(
+		stages=[
+			PipelineStage('parse', lambda source: _parse_source(config, source), pconf.parse_workers),
+			PipelineStage('split', lambda parsed: _split_source(config, *parsed), pconf.split_workers),
+			PipelineStage(
+				'embed',
+				lambda indoc: vectordb.embed_indocument(indoc, pconf.incremental_reindex),
+				pconf.embed_workers,
+			),
+		],
+		writer=vectordb.write_embedded,
+		write_batch_size=pconf.write_batch_size,
+		queue_size=pconf.queue_size,
+	)
+	added_source_ids, retry_source_ids = pipeline.run([(source.filename, source) for source in filtered_sources])  # pyright: ignore[reportArgumentType]
 	loaded_source_ids.extend(added_source_ids)
-	logger.debug('Added documents to vectordb')
+	logger.debug('Added documents to vectordb', extra={
+		'len(added_source_ids)': len(added_source_ids),
+		'len(retry_source_ids)': len(retry_source_ids),
+	})
 
 	return loaded_source_ids, retry_source_ids  # pyright: ignore[reportReturnType]
 
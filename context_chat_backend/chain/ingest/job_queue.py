@@ -0,0 +1,169 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import os
+import shutil
+from contextlib import ExitStack
+
+from fastapi.datastructures import Headers, UploadFile
+
+from ... import metrics
+from ...dyn_loader import VectorDBLoader
+from ...types import TConfig
+from ...vectordb.types import IngestStatus, QueuedSource
+from .doc_loader import READ_CHUNK_SIZE
+from .injest import embed_sources
+
+__all__ = ['lease_queued_sources', 'persist_sources', 'process_queued_sources', 'return_queued_sources']
+
+logger = logging.getLogger('ccb.job_queue')
+
+
+def persist_sources(queue_dir: str, job_id: str, sources: list[UploadFile]) -> list[QueuedSource]:
+	'''
+	Copies the uploaded files to the queue directory so that they outlive the request
+	and a restart of the server.
+
+	Returns
+	-------
+	list[QueuedSource]
+		The sources to add to the ingest queue.
+	'''
+	job_dir = os.path.join(queue_dir, job_id)
+	os.makedirs(job_dir, exist_ok=True)
+
+	queued = []
+	for i, source in enumerate(sources):
+		file_path = os.path.join(job_dir, str(i))
+		source.file.seek(0)
+		with open(file_path, 'wb') as f:
+			shutil.copyfileobj(source.file, f, READ_CHUNK_SIZE)
+			size = f.tell()
+
+		queued.append(QueuedSource(
+			job_id=job_id,
+			source_id=source.filename,  # pyright: ignore[reportArgumentType]
+			headers=dict(source.headers),
+			file_path=file_path,
+			size=size,
+		))
+
+	return queued
+
+
+def _remove_files(sources: list[QueuedSource]):
+	for source in sources:
+		try:
+			os.remove(source.file_path)
+		except FileNotFoundError:
+			pass
+
+	for job_dir in {os.path.dirname(source.file_path) for source in sources}:
+		try:
+			os.rmdir(job_dir)
+		except OSError:
+			# other sources of the job are still queued
+			pass
+
+
+def lease_queued_sources(vectordb_loader: VectorDBLoader, config: TConfig) -> list[QueuedSource]:
+	'''
+	Leases a batch of sources from the ingest queue, or removes the old finished sources if it is empty.
+	Only uses the database, so it runs in the ingest queue runner and a worker is only taken
+	when there is something to index.
+
+	Returns
+	-------
+	list[QueuedSource]
+		The leased sources, empty if the queue is empty.
+	'''
+	qconf = config.ingest_queue
+	db = vectordb_loader.load(check_embedding=False)
+	leased = db.lease_queued_sources(qconf.batch_size, qconf.lease_secs)
+	if len(leased) == 0 and (count := db.cleanup_ingest_queue(qconf.retention_hours)) > 0:
+		logger.info(f'Removed {count} finished sources from the ingest queue')
+	return leased
+
+
+def return_queued_sources(vectordb_loader: VectorDBLoader, leased: list[QueuedSource]):
+	'''
+	Puts the leased sources back in the queue when no ingest worker became free to process them
+	'''
+	db = vectordb_loader.load(check_embedding=False)
+	db.return_queued_sources([source.id for source in leased])  # pyright: ignore[reportArgumentType]
+
+
+def process_queued_sources(vectordb_loader: VectorDBLoader, config: TConfig, leased: list[QueuedSource]):
+	'''
+	Indexes the leased sources and records the outcome.
+	Runs in an ingest worker.
+	'''
+	qconf = config.ingest_queue
+	db = vectordb_loader.load()
+
+	statuses: dict[int, tuple[IngestStatus, str | None]] = {}
+	finished: list[QueuedSource] = []
+
+	# only the latest upload of a source queued more than once is indexed
+	latest: dict[str, QueuedSource] = {}
+	for source in leased:
+		if source.source_id in latest:
+			superseded = latest[source.source_id]
+			statuses[superseded.id] = (IngestStatus.skipped, 'Superseded by a later upload')  # pyright: ignore[reportArgumentType]
+			finished.append(superseded)
+		latest[source.source_id] = source
+
+	with ExitStack() as stack:
+		uploads: dict[str, QueuedSource] = {}
+		files: list[UploadFile] = []
+		for source in latest.values():
+			try:
+				file = stack.enter_context(open(source.file_path, 'rb'))
+			except OSError as e:
+				logger.error('Queued source file is missing', exc_info=e, extra={'source_id': source.source_id})
+				statuses[source.id] = (IngestStatus.failed, f'Queued file could not be read: {e}')  # pyright: ignore[reportArgumentType]
+				finished.append(source)
+				continue
+
+			uploads[source.source_id] = source
+			files.append(UploadFile(
+				file=file,
+				filename=source.source_id,
+				size=source.size,
+				headers=Headers(headers=source.headers),
+			))
+
+		try:
+			loaded, retry = embed_sources(vectordb_loader, config, files) if len(files) > 0 else ([], [])
+		except Exception as e:
+			logger.exception('Error indexing the queued sources', exc_info=e)
+			loaded, retry = [], list(uploads.keys())
+
+	loaded_ids, retry_ids = set(loaded), set(retry)
+	for source_id, source in uploads.items():
+		if source_id in loaded_ids:
+			statuses[source.id] = (IngestStatus.indexed, None)  # pyright: ignore[reportArgumentType]
+		elif source_id in retry_ids:
+			if source.attempts >= qconf.max_attempts:
+				statuses[source.id] = (  # pyright: ignore[reportArgumentType]
+					IngestStatus.failed,
+					f'Indexing failed after {source.attempts} attempts',
+				)
+			else:
+				statuses[source.id] = (IngestStatus.queued, 'Indexing failed, will be retried')  # pyright: ignore[reportArgumentType]
+				continue
+		else:
+			# unsupported or empty document
+			statuses[source.id] = (IngestStatus.skipped, 'The source could not be indexed')  # pyright: ignore[reportArgumentType]
+		finished.append(source)
+
+	db.finish_queued_sources(statuses)
+	_remove_files(finished)
+
+	for status, _ in statuses.values():
+		metrics.inc(f'ingest_queue.{status.value}')
+	logger.debug('Processed queued sources', extra={
+		'Count of indexed sources': f'{len(loaded_ids)}/{len(leased)}',
+	})
@@ -0,0 +1,155 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import queue
+import threading
+from collections.abc import Callable
+from time import monotonic
+from typing import Any, NamedTuple
+
+from ... import metrics
+
+__all__ = ['IngestPipeline', 'PipelineStage']
+
+logger = logging.getLogger('ccb.ingest_pipeline')
+
+# marks the end of the input of a stage worker
+_DONE = object()
+
+
+class PipelineStage(NamedTuple):
+	name: str
+	# returns the input of the next stage or None to drop the item (e.g. an empty document)
+	fn: Callable[[Any], Any]
+	workers: int
+
+
+class IngestPipeline:
+	'''
+	Runs the items through the stages concurrently, each stage with its own threads.
+	The stages are connected by bounded queues so that a slow stage makes the previous ones wait
+	instead of buffering all the documents in memory.
+	The output of the last stage is written in batches by the writer, which returns the added
+	and the failed source ids. Items failing in any stage are returned as sources to retry.
+	'''
+
+	def __init__(
+		self,
+		stages: list[PipelineStage],
+		writer: Callable[[list[Any]], tuple[list[str], list[str]]],
+		write_batch_size: int,
+		queue_size: int,
+	):
+		self.stages = stages
+		self.writer = writer
+		self.write_batch_size = max(write_batch_size, 1)
+		self.queue_size = max(queue_size, 1)
+
+		self._lock = threading.Lock()
+		self._added: list[str] = []
+		self._retry: list[str] = []
+
+	def _retry_sources(self, source_ids: list[str]):
+		with self._lock:
+			self._retry.extend(source_ids)
+
+	def _stage_worker(self, stage: PipelineStage, inbox: queue.Queue, outbox: queue.Queue):
+		while (item := inbox.get()) is not _DONE:
+			source_id, value = item
+			start = monotonic()
+			try:
+				result = stage.fn(value)
+			except Exception as e:
+				logger.exception(f'Error in the {stage.name} stage of the indexing', exc_info=e, extra={
+					'source_id': source_id,
+				})
+				metrics.inc(f'ingest.{stage.name}.errors')
+				self._retry_sources([source_id])
+				continue
+
+			metrics.observe(f'ingest.{stage.name}.secs', monotonic() - start)
+			if result is None:
+				logger.debug(f'{stage.name} stage dropped the source', extra={'source_id': source_id})
+				continue
+			outbox.put((source_id, result))
+
+	def _write(self, batch: list[tuple[str, Any]]):
+		start = monotonic()
+		try:
+			added, retry = self.writer([value for _, value in batch])
+		except Exception as e:
+			logger.exception('Error writing a batch of documents to the vectordb', exc_info=e, extra={
+				'source_ids': [source_id for source_id, _ in batch],
+			})
+			metrics.inc('ingest.write.errors')
+			self._retry_sources([source_id for source_id, _ in batch])
+			return
+
+		metrics.observe('ingest.write.secs', monotonic() - start)
+		metrics.inc('ingest.write.documents', len(added))
+		with self._lock:
+			self._added.extend(added)
+			self._retry.extend(retry)
+
+	def _write_worker(self, inbox: queue.Queue):
+		done = False
+		while not done:
+			# write what is ready without waiting for a full batch
+			batch = [inbox.get()]
+			while len(batch) < self.write_batch_size:
+				try:
+					batch.append(inbox.get_nowait())
+				except queue.Empty:
+					break
+
+			if _DONE in batch:
+				done = True
+				batch = [item for item in batch if item is not _DONE]
+			if len(batch) > 0:
+				self._write(batch)
+
+	def run(self, items: list[tuple[str, Any]]) -> tuple[list[str], list[str]]:
+		'''
+		Args
+		----
+		items: list[tuple[str, Any]]
+			Pairs of the source id and the input of the first stage
+
+		Returns
+		-------
+		tuple[list[str], list[str]]
+			List of source ids that were successfully added and the list of source ids that need to be retried.
+		'''
+		queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+		stage_threads = [
+			[
+				threading.Thread(
+					target=self._stage_worker,
+					args=(stage, queues[i], queues[i + 1]),
+					name=f'ccb-ingest-{stage.name}-{n}',
+					daemon=True,
+				)
+				for n in range(max(stage.workers, 1))
+			]
+			for i, stage in enumerate(self.stages)
+		]
+		writer = threading.Thread(target=self._write_worker, args=(queues[-1],), name='ccb-ingest-write', daemon=True)
+
+		for thread in [*(t for threads in stage_threads for t in threads), writer]:
+			thread.start()
+
+		for item in items:
+			queues[0].put(item)
+
+		# each stage is closed once the previous one has processed all its items
+		for i, threads in enumerate(stage_threads):
+			for _ in threads:
+				queues[i].put(_DONE)
+			for thread in threads:
+				thread.join()
+		queues[-1].put(_DONE)
+		writer.join()
+
+		return self._added, self._retry
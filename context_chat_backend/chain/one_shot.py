@@ -2,13 +2,16 @@
 # SPDX-FileCopyrightText: 2023 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import asyncio
 import logging
+from collections.abc import Iterator
 
 from langchain.llms.base import LLM
+from langchain.schema import Document
 
 from ..dyn_loader import VectorDBLoader
 from ..types import TConfig
-from .context import get_context_chunks, get_context_docs
+from .context import aget_context_docs, get_context_chunk_ids, get_context_chunks, get_context_docs
 from .query_proc import get_pruned_query
 from .types import ContextException, LLMOutput, ScopeType
 
@@ -20,6 +23,93 @@ _LLM_TEMPLATE = '''Answer based only on this context and do not add any imaginat
 
 logger = logging.getLogger('ccb.chain')
 
+def get_query_prompt(
+	llm: LLM,
+	app_config: TConfig,
+	query: str,
+	no_ctx_template: str | None = None,
+) -> str:
+	"""
+	Raises
+	------
+	ValueError
+		If the context length is too small to fit the query
+	"""
+	return (query, get_pruned_query(llm, app_config, query, no_ctx_template, []))[no_ctx_template is not None]  # pyright: ignore[reportReturnType]
+
+
+def get_context_query_prompt(
+	user_id: str,
+	vectordb_loader: VectorDBLoader,
+	llm: LLM,
+	app_config: TConfig,
+	query: str,
+	ctx_limit: int = 20,
+	scope_type: ScopeType | None = None,
+	scope_list: list[str] | None = None,
+	template: str | None = None,
+) -> tuple[str, list[str]]:
+	"""
+	Returns
+	-------
+	tuple[str, list[str]]
+		The prompt with the retrieved context and the unique source ids of the context
+
+	Raises
+	------
+	ContextException
+		If no documents were retrieved
+	ValueError
+		If the context length is too small to fit the query
+	"""
+	db = vectordb_loader.load()
+	context_docs = get_context_docs(user_id, query, db, ctx_limit, scope_type, scope_list)
+	return _build_context_prompt(llm, app_config, query, template, context_docs)
+
+
+async def aget_context_query_prompt(
+	user_id: str,
+	vectordb_loader: VectorDBLoader,
+	llm: LLM,
+	app_config: TConfig,
+	query: str,
+	ctx_limit: int = 20,
+	scope_type: ScopeType | None = None,
+	scope_list: list[str] | None = None,
+	template: str | None = None,
+) -> tuple[str, list[str]]:
+	"""
+	Async variant of get_context_query_prompt
+	"""
+	db = await vectordb_loader.aload()
+	context_docs = await aget_context_docs(user_id, query, db, ctx_limit, scope_type, scope_list)
+	# the token counting and pruning (and the first load of a tokenizer) would block the event loop
+	return await asyncio.to_thread(_build_context_prompt, llm, app_config, query, template, context_docs)
+
+
+def _build_context_prompt(
+	llm: LLM,
+	app_config: TConfig,
+	query: str,
+	template: str | None,
+	context_docs: list[Document],
+) -> tuple[str, list[str]]:
+	if len(context_docs) == 0:
+		raise ContextException('No documents retrieved, please index a few documents first')
+
+	context_chunks = get_context_chunks(context_docs)
+	logger.debug('context retrieved', extra={
+		'len(context_docs)': len(context_docs),
+		'len(context_chunks)': len(context_chunks),
+	})
+
+	prompt = get_pruned_query(
+		llm, app_config, query, template or _LLM_TEMPLATE, context_chunks, get_context_chunk_ids(context_docs),
+	)
+	unique_sources: list[str] = list({source for d in context_docs if (source := d.metadata.get('source'))})
+	return prompt, unique_sources
+
+
 def process_query(
 	user_id: str,
 	llm: LLM,
@@ -36,7 +126,7 @@ def process_query(
 	"""
 	stop = [end_separator] if end_separator else None
 	output = llm.invoke(
-		(query, get_pruned_query(llm, app_config, query, no_ctx_template, []))[no_ctx_template is not None],  # pyright: ignore[reportArgumentType]
+		get_query_prompt(llm, app_config, query, no_ctx_template),
 		stop=stop,
 		userid=user_id,
 	).strip()
@@ -62,22 +152,79 @@ def process_context_query(
 	ValueError
 		If the context length is too small to fit the query
 	"""
-	db = vectordb_loader.load()
-	context_docs = get_context_docs(user_id, query, db, ctx_limit, scope_type, scope_list)
-	if len(context_docs) == 0:
-		raise ContextException('No documents retrieved, please index a few documents first')
+	prompt, unique_sources = get_context_query_prompt(
+		user_id, vectordb_loader, llm, app_config, query, ctx_limit, scope_type, scope_list, template,
+	)
+	output = llm.invoke(prompt, stop=[end_separator], userid=user_id).strip()
 
-	context_chunks = get_context_chunks(context_docs)
-	logger.debug('context retrieved', extra={
-		'len(context_docs)': len(context_docs),
-		'len(context_chunks)': len(context_chunks),
-	})
+	return LLMOutput(output=output, sources=unique_sources)
 
-	output = llm.invoke(
-		get_pruned_query(llm, app_config, query, template or _LLM_TEMPLATE, context_chunks),
-		stop=[end_separator],
+
+async def aprocess_query(
+	user_id: str,
+	llm: LLM,
+	app_config: TConfig,
+	query: str,
+	no_ctx_template: str | None = None,
+	end_separator: str = '',
+):
+	"""
+	Async variant of process_query, LLMs without an async implementation run in a thread
+
+	Raises
+	------
+	ValueError
+		If the context length is too small to fit the query
+	"""
+	stop = [end_separator] if end_separator else None
+	prompt = await asyncio.to_thread(get_query_prompt, llm, app_config, query, no_ctx_template)
+	output = (await llm.ainvoke(
+		prompt,
+		stop=stop,
 		userid=user_id,
-	).strip()
-	unique_sources: list[str] = list({source for d in context_docs if (source := d.metadata.get('source'))})
+	)).strip()
+
+	return LLMOutput(output=output, sources=[])
+
+
+async def aprocess_context_query(
+	user_id: str,
+	vectordb_loader: VectorDBLoader,
+	llm: LLM,
+	app_config: TConfig,
+	query: str,
+	ctx_limit: int = 20,
+	scope_type: ScopeType | None = None,
+	scope_list: list[str] | None = None,
+	template: str | None = None,
+	end_separator: str = '',
+):
+	"""
+	Async variant of process_context_query, LLMs without an async implementation run in a thread
+
+	Raises
+	------
+	ValueError
+		If the context length is too small to fit the query
+	"""
+	prompt, unique_sources = await aget_context_query_prompt(
+		user_id, vectordb_loader, llm, app_config, query, ctx_limit, scope_type, scope_list, template,
+	)
+	output = (await llm.ainvoke(prompt, stop=[end_separator], userid=user_id)).strip()
 
 	return LLMOutput(output=output, sources=unique_sources)
+
+
+def stream_output(llm: LLM, prompt: str, user_id: str, stop: list[str] | None = None) -> Iterator[str]:
+	"""
+	Yields the output of the LLM as it is generated, without the leading whitespace.
+	LLMs that cannot stream yield the whole output at once.
+	"""
+	started = False
+	for token in llm.stream(prompt, stop=stop, userid=user_id):
+		if not started:
+			token = token.lstrip()
+			if token == '':
+				continue
+			started = True
+		yield token
@@ -7,13 +7,22 @@ import logging
 from langchain.llms.base import LLM
 
 from ..types import TConfig
+from .token_counter import get_token_counter
 
 logger = logging.getLogger('ccb.chain')
 
-def get_pruned_query(llm: LLM, config: TConfig, query: str, template: str, text_chunks: list[str]) -> str:
+def get_pruned_query(
+	llm: LLM,
+	config: TConfig,
+	query: str,
+	template: str,
+	text_chunks: list[str],
+	chunk_ids: list[str | None] | None = None,
+) -> str:
 	'''
 	Truncates the input to fit the model's maximum context length
-	and returns the model's prediction
+	and returns the model's prediction.
+	The token counts of the chunks are memoized by their ids.
 
 	Raises
 	------
@@ -36,8 +45,11 @@ def get_pruned_query(llm: LLM, config: TConfig, query: str, template: str, text_
 		) \
 		or 4096
 
-	query_tokens = llm.get_num_tokens(query)
-	template_tokens = llm.get_num_tokens(template.format(context='', question=''))
+	counter = get_token_counter(llm)
+	query_tokens, template_tokens = counter.count_many(
+		[query, template.format(context='', question='')],
+		[None, f'template:{template}'],
+	)
 
 	# remaining tokens after the template, query and 'to be' generated tokens
 	remaining_tokens = n_ctx - template_tokens - query_tokens - n_gen
@@ -45,8 +57,7 @@ def get_pruned_query(llm: LLM, config: TConfig, query: str, template: str, text_
 	# If the query is too long to fit in the context, truncate it (keeping the template)
 	if remaining_tokens <= 0:
 		new_remaining_tokens = n_ctx - template_tokens - n_gen
-		while query and llm.get_num_tokens(query) > new_remaining_tokens:
-			query = ' '.join(query.split()[:-10])
+		query = counter.truncate(query, new_remaining_tokens)
 
 		if not query:
 			raise ValueError('Context length is too small even to fit the template')
@@ -54,10 +65,11 @@ def get_pruned_query(llm: LLM, config: TConfig, query: str, template: str, text_
 		return template.format(context='', question=query)
 
 	accepted_chunks = []
+	chunk_tokens = counter.count_many(text_chunks, chunk_ids)
 
-	while text_chunks and remaining_tokens > 0:
-		context = text_chunks.pop(0)
-		context_tokens = llm.get_num_tokens(context)
+	for context, context_tokens in zip(text_chunks, chunk_tokens, strict=True):
+		if remaining_tokens <= 0:
+			break
 
 		if context_tokens <= remaining_tokens:
 			accepted_chunks.append(context)
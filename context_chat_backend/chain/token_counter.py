@@ -0,0 +1,157 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from functools import cache
+
+from langchain_community.llms.huggingface_pipeline import HuggingFacePipeline
+from langchain_community.llms.llamacpp import LlamaCpp
+from langchain_core.language_models import BaseLanguageModel
+
+from ..models.batching import BatchedLLM
+
+__all__ = ['GPT2_REVISION', 'TokenCounter', 'get_token_counter']
+
+logger = logging.getLogger('ccb.chain')
+
+# the gpt2 tokenizer is fetched to the hub cache at startup (see models_to_fetch in controller.py)
+GPT2_REVISION = '607a30d783dfa663caf39e06633721c8d4cfcd7e'
+# max memoized token counts per model
+MAX_MEMOIZED = 65536
+
+_counters: dict[int, 'TokenCounter'] = {}
+_counters_lock = threading.Lock()
+
+Encoder = Callable[[BaseLanguageModel, list[str]], list[int]]
+
+
+@cache
+def _gpt2_tokenizer():
+	# imported here to not load transformers in the processes that never count tokens
+	from transformers import GPT2TokenizerFast
+	return GPT2TokenizerFast.from_pretrained('gpt2', revision=GPT2_REVISION)
+
+
+def _count_llama(llm: BaseLanguageModel, texts: list[str]) -> list[int]:
+	# llama.cpp has no batch tokenization, but it only needs the vocabulary and does not wait for a generation
+	return [len(llm.client.tokenize(text.encode('utf-8'), add_bos=False)) for text in texts]  # pyright: ignore[reportAttributeAccessIssue]
+
+
+def _count_hf(llm: BaseLanguageModel, texts: list[str]) -> list[int]:
+	tokenizer = llm.pipeline.tokenizer  # pyright: ignore[reportAttributeAccessIssue]
+	return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+
+def _count_gpt2(_: BaseLanguageModel, texts: list[str]) -> list[int]:
+	return [len(ids) for ids in _gpt2_tokenizer()(texts, add_special_tokens=False)['input_ids']]
+
+
+def _count_each(llm: BaseLanguageModel, texts: list[str]) -> list[int]:
+	return [llm.get_num_tokens(text) for text in texts]
+
+
+def _encoder_for(llm: BaseLanguageModel) -> Encoder:
+	if isinstance(llm, LlamaCpp):
+		return _count_llama
+	if isinstance(llm, HuggingFacePipeline) and getattr(llm.pipeline, 'tokenizer', None) is not None:
+		return _count_hf
+	if type(llm).get_num_tokens is not BaseLanguageModel.get_num_tokens or llm.custom_get_token_ids is not None:
+		# the model has its own way to count the tokens
+		return _count_each
+	# the default of langchain, without loading the tokenizer again for every call
+	return _count_gpt2
+
+
+class TokenCounter:
+	'''
+	Counts the tokens of many texts with one batch encoding of the model's tokenizer.
+	The counts of texts with a key, like the id of a stored chunk, are memoized.
+	'''
+
+	def __init__(self, llm: BaseLanguageModel):
+		# the counter must not keep an offloaded model in memory
+		self._llm = weakref.ref(llm)
+		self._encode = _encoder_for(llm)
+		self._memo: OrderedDict[str, int] = OrderedDict()
+		self._lock = threading.Lock()
+
+	def _encode_texts(self, texts: list[str]) -> list[int]:
+		if len(texts) == 0:
+			return []
+		if (llm := self._llm()) is None:
+			raise RuntimeError('The model of the token counter was offloaded')
+		return self._encode(llm, texts)
+
+	def count(self, text: str) -> int:
+		return self._encode_texts([text])[0]
+
+	def count_many(self, texts: Sequence[str], keys: Sequence[str | None] | None = None) -> list[int]:
+		'''
+		Returns the token counts of the texts, the ones not memoized by their keys are encoded in one batch
+		'''
+		keys = keys if keys is not None else [None] * len(texts)
+		counts: list[int | None] = [None] * len(texts)
+		with self._lock:
+			for i, key in enumerate(keys):
+				if key is not None and (count := self._memo.get(key)) is not None:
+					self._memo.move_to_end(key)
+					counts[i] = count
+
+		missing = [i for i, count in enumerate(counts) if count is None]
+		encoded = self._encode_texts([texts[i] for i in missing])
+		with self._lock:
+			for i, count in zip(missing, encoded, strict=True):
+				counts[i] = count
+				if keys[i] is not None:
+					self._memo[keys[i]] = count  # pyright: ignore[reportArgumentType]
+			while len(self._memo) > MAX_MEMOIZED:
+				self._memo.popitem(last=False)
+
+		return counts  # pyright: ignore[reportReturnType]
+
+	def truncate(self, text: str, max_tokens: int) -> str:
+		'''
+		Returns the longest prefix of whole words of the text with at most max_tokens tokens,
+		found with a binary search over the word offsets
+		'''
+		if max_tokens <= 0:
+			return ''
+		if self.count(text) <= max_tokens:
+			return text
+
+		ends = [match.end() for match in re.finditer(r'\S+', text)]
+		# number of words that fit, at least lo and less than hi
+		lo, hi = 0, len(ends)
+		while hi - lo > 1:
+			mid = (lo + hi) // 2
+			if self.count(text[:ends[mid - 1]]) <= max_tokens:
+				lo = mid
+			else:
+				hi = mid
+
+		return text[:ends[lo - 1]] if lo > 0 else ''
+
+
+def get_token_counter(llm: BaseLanguageModel) -> TokenCounter:
+	'''
+	The token counter of the model, created once per loaded model
+	'''
+	if isinstance(llm, BatchedLLM):
+		llm = llm.llm
+
+	if (counter := _counters.get(id(llm))) is not None:
+		return counter
+
+	with _counters_lock:
+		if (counter := _counters.get(id(llm))) is None:
+			counter = TokenCounter(llm)
+			_counters[id(llm)] = counter
+			# forget the counter and its memoized counts when the model is offloaded
+			weakref.finalize(llm, _counters.pop, id(llm), None)
+		return counter
@@ -56,8 +56,14 @@ def get_config(file_path: str) -> TConfig:
 		uvicorn_workers=config.get('uvicorn_workers', 1),
 		embedding_chunk_size=config.get('embedding_chunk_size', 1000),
 		doc_parser_worker_limit=config.get('doc_parser_worker_limit', 10),
+		worker_pool_size=config.get('worker_pool_size', 4),
+		worker_max_tasks=config.get('worker_max_tasks', 500),
+		worker_max_rss_mb=config.get('worker_max_rss_mb', 2048),
 
 		vectordb=vectordb,
 		embedding=config.get('embedding', {}), # for a more appropriate response
+		ingest_pipeline=config.get('ingest_pipeline', {}),
+		ingest_queue=config.get('ingest_queue', {}),
+		query_queue=config.get('query_queue', {}),
 		llm=llm,
 	)
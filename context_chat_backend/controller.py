@@ -6,46 +6,77 @@
 # isort: off
 from .chain.types import ContextException, LLMOutput, ScopeType, SearchResult
 from .types import LoaderException, EmbeddingException
-from .vectordb.types import DbException, SafeDbException, UpdateAccessOp
+from .vectordb.types import DbException, IngestStatus, SafeDbException, SourceManifestEntry, UpdateAccessOp
 # isort: on
 
+import asyncio
+import inspect
+import json
 import logging
-import multiprocessing as mp
 import os
+import shutil
 import tempfile
 import threading
+import uuid
 import zipfile
 from collections.abc import Callable
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, closing, suppress
 from functools import wraps
 from threading import Event, Thread
-from time import sleep
+from time import monotonic, sleep
 from typing import Annotated, Any
 
+import psutil
 from fastapi import Body, FastAPI, Request, UploadFile
 from langchain.llms.base import LLM
 from nc_py_api import AsyncNextcloudApp, NextcloudApp
 from nc_py_api.ex_app import persistent_storage, set_handlers
 from pydantic import BaseModel, ValidationInfo, field_validator
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import FileResponse
 
-from .chain.context import do_doc_search
+from . import metrics
+from .admission import AdmissionException, AdmissionScheduler
+from .chain.context import ado_doc_search
 from .chain.ingest.injest import embed_sources
-from .chain.one_shot import process_context_query, process_query
+from .chain.ingest.job_queue import (
+	lease_queued_sources,
+	persist_sources,
+	process_queued_sources,
+	return_queued_sources,
+)
+from .chain.one_shot import (
+	aget_context_query_prompt,
+	aprocess_context_query,
+	aprocess_query,
+	get_query_prompt,
+	process_context_query,
+	process_query,
+	stream_output,
+)
+from .chain.token_counter import GPT2_REVISION
 from .config_parser import get_config
 from .dyn_loader import EmbeddingModelLoader, LLMModelLoader, VectorDBLoader
+from .models.task_processing import Task, notify_task_finished
 from .models.types import LlmException
 from .ocs_utils import AppAPIAuthMiddleware
 from .setup_functions import ensure_config_file, repair_run, setup_env_vars
 from .utils import JSONResponse, exec_in_proc, is_valid_provider_id, is_valid_source_id, value_of
 from .vectordb.service import (
+	adecl_update_access,
+	aupdate_access,
+	aupdate_access_provider,
+	check_manifest,
 	count_documents_by_provider,
-	decl_update_access,
 	delete_by_provider,
 	delete_by_source,
 	delete_user,
-	update_access,
+	enqueue_sources,
+	ensure_index,
+	get_job_status,
 )
+from .worker_pool import WorkerPool, WorkerPoolBusyException
 
 # setup
 
@@ -63,7 +94,7 @@ models_to_fetch = {
 	'gpt2': {
 		'cache_dir': os.path.join(persistent_storage(), 'model_files/hub'),
 		'allow_patterns': ['config.json', 'merges.txt', 'tokenizer.json', 'tokenizer_config.json', 'vocab.json'],
-		'revision': '607a30d783dfa663caf39e06633721c8d4cfcd7e',
+		'revision': GPT2_REVISION,
 	}
 }
 app_enabled = Event()
@@ -71,6 +102,8 @@ app_enabled = Event()
 def enabled_handler(enabled: bool, _: NextcloudApp | AsyncNextcloudApp) -> str:
 	if enabled:
 		app_enabled.set()
+		if llm_loader.warmup_on_enable:
+			Thread(target=llm_warmup_task, daemon=True).start()
 	else:
 		app_enabled.clear()
 
@@ -87,7 +120,15 @@ async def lifespan(app: FastAPI):
 	logger.info(f'App enable state at startup: {app_enabled.is_set()}')
 	t = Thread(target=background_thread_task, args=())
 	t.start()
+	Thread(target=vector_index_task, daemon=True).start()
+	Thread(target=llm_reaper_task, daemon=True).start()
+	for i in range(app_config.ingest_queue.runners):
+		Thread(target=ingest_queue_task, name=f'ccb-ingest-queue-{i}', daemon=True).start()
+	if app_enabled.is_set() and llm_loader.warmup_on_enable:
+		Thread(target=llm_warmup_task, daemon=True).start()
 	yield
+	worker_pool.shutdown()
+	ingest_pool.shutdown()
 	vectordb_loader.offload()
 	embedding_loader.offload()
 	llm_loader.offload()
@@ -107,31 +148,147 @@ vectordb_loader = VectorDBLoader(embedding_loader, app_config)
 llm_loader = LLMModelLoader(app, app_config)
 
 
+# worker pools
+
+# long-lived processes that keep the db and embedding clients warm between requests
+worker_pool = WorkerPool(
+	'ccb-worker',
+	app_config.worker_pool_size,
+	app_config.worker_max_tasks,
+	app_config.worker_max_rss_mb,
+)
+# indexing requests can run for a long time, they get their own workers to not block the other requests
+ingest_pool = WorkerPool(
+	'ccb-ingest',
+	app_config.doc_parser_worker_limit,
+	app_config.worker_max_tasks,
+	app_config.worker_max_rss_mb,
+)
+
+
 # locks and semaphores
 
-# sequential prompt processing for in-house LLMs (non-nc_texttotext)
-llm_lock = threading.Lock()
+# max concurrent queries of the LLM backend, the others wait in a bounded priority queue
+llm_admission = AdmissionScheduler(
+	'query_queue',
+	app_config.query_queue.max_in_flight_for(app_config.llm[0]),
+	app_config.query_queue.max_queued,
+	app_config.query_queue.queue_timeout_secs,
+	app_config.query_queue.priority_secs_per_kchar,
+)
+
+# seconds between the checks for an idle LLM
+LLM_REAPER_INTERVAL = 60
+# seconds between the attempts to build the vector index, e.g. until the first embeddings are stored
+VECTOR_INDEX_RETRY_INTERVAL = 5 * 60
+# max wait of the ingest queue runners for a free ingest worker, the leased sources are returned to
+# the queue after it so that their lease does not run out while waiting
+INGEST_QUEUE_WORKER_WAIT = 60
+# the admission slot of a streamed query is given back if the client does not start reading the stream
+STREAM_START_TIMEOUT = 30
+
+# uploads of /queueSources waiting to be indexed
+INGEST_QUEUE_DIR = os.path.join(persistent_storage(), 'ingest_queue')
 
 # lock to update the sources dict currently being processed
 index_lock = threading.Lock()
 _indexing = {}
 
-# limit the number of concurrent document parsing
-doc_parse_semaphore = mp.Semaphore(app_config.doc_parser_worker_limit)
-
 
 # middlewares
 
 if not app_config.disable_aaa:
 	app.add_middleware(AppAPIAuthMiddleware)
 
-# logger background thread
+# background threads
 
 def background_thread_task():
 	while(True):
 		logger.info(f'Currently indexing {len(_indexing)} documents (filename, size): ', extra={'_indexing': _indexing})
 		sleep(10)
 
+def vector_index_task():
+	# the index build needs the embedding server which only starts after the app is enabled
+	if not app_config.disable_aaa:
+		app_enabled.wait()
+
+	while True:
+		try:
+			# a one-off process so a long index build does not hold a pool worker
+			if exec_in_proc(target=ensure_index, args=(vectordb_loader,)):
+				return
+		except Exception as e:
+			logger.error('Failed to build the vector index, searches will use exact distance scans', exc_info=e)
+
+		sleep(VECTOR_INDEX_RETRY_INTERVAL)
+
+def ingest_queue_task():
+	if not app_config.disable_aaa:
+		app_enabled.wait()
+
+	while True:
+		try:
+			# leasing is a cheap db query, an idle poll does not take an ingest worker
+			leased = lease_queued_sources(vectordb_loader, app_config)
+			if len(leased) > 0:
+				ingest_pool.submit(
+					process_queued_sources,
+					args=(vectordb_loader, app_config, leased),
+					wait_timeout=min(INGEST_QUEUE_WORKER_WAIT, app_config.ingest_queue.lease_secs / 2),
+				)
+		except WorkerPoolBusyException:
+			logger.info(f'No ingest worker is free, returning {len(leased)} sources to the ingest queue')
+			try:
+				return_queued_sources(vectordb_loader, leased)
+			except Exception as e:
+				logger.error('Error returning the sources to the ingest queue', exc_info=e)
+			leased = []
+		except Exception as e:
+			logger.error('Error processing the ingest queue', exc_info=e)
+			leased = []
+
+		if len(leased) == 0:
+			sleep(app_config.ingest_queue.poll_interval_secs)
+
+def llm_reaper_task():
+	# nothing is held in memory for the task processing backend
+	offload_after_secs = llm_loader.offload_after_mins * 60
+	if app_config.llm[0] == 'nc_texttotext' or offload_after_secs <= 0:
+		return
+
+	while True:
+		sleep(min(LLM_REAPER_INTERVAL, offload_after_secs))
+		idle_secs = llm_loader.idle_secs()
+		if idle_secs is None or idle_secs < offload_after_secs:
+			continue
+
+		# a query is running or waiting, check again later
+		if not llm_admission.try_acquire_all():
+			continue
+		try:
+			rss_before = psutil.Process().memory_info().rss
+			llm_loader.offload()
+			freed_mb = (rss_before - psutil.Process().memory_info().rss) / (1024 * 1024)
+		finally:
+			llm_admission.release_all()
+
+		metrics.inc('llm.offloads')
+		logger.info(
+			f'Offloaded the LLM after {idle_secs / 60:.1f} minutes of inactivity, freed {freed_mb:.2f} MiB',
+			extra={'llm': app_config.llm[0]},
+		)
+
+def llm_warmup_task():
+	if app_config.llm[0] == 'nc_texttotext':
+		return
+
+	try:
+		with llm_admission.slot():
+			llm_loader.load()
+		logger.info('LLM warmed up', extra={'llm': app_config.llm[0]})
+	except Exception as e:
+		logger.error('Failed to warm up the LLM', exc_info=e)
+
 # exception handlers
 
 @app.exception_handler(DbException)
@@ -178,6 +335,12 @@ async def _(request: Request, exc: EmbeddingException):
 	return JSONResponse(f'Embedding Request Error: {exc}', 500)
 
 
+@app.exception_handler(AdmissionException)
+async def _(request: Request, exc: AdmissionException):
+	logger.warning(f'Request not admitted: {request.url.path}: {exc}')
+	return JSONResponse(f'Server Busy: {exc}', 503, headers={'Retry-After': str(int(exc.retry_after))})
+
+
 # guards
 
 def enabled_guard(app: FastAPI):
@@ -185,10 +348,22 @@ def enabled_guard(app: FastAPI):
 		'''
 		Decorator to check if the service is enabled
 		'''
+		def is_disabled() -> bool:
+			return not app.extra['CONFIG'].disable_aaa and not app_enabled.is_set()
+
+		if inspect.iscoroutinefunction(func):
+			@wraps(func)
+			async def async_wrapper(*args, **kwargs):
+				if is_disabled():
+					return JSONResponse('Context Chat is disabled, enable it from AppAPI to use it.', 503)
+
+				return await func(*args, **kwargs)
+
+			return async_wrapper
+
 		@wraps(func)
 		def wrapper(*args, **kwargs):
-			disable_aaa = app.extra['CONFIG'].disable_aaa
-			if not disable_aaa and not app_enabled.is_set():
+			if is_disabled():
 				return JSONResponse('Context Chat is disabled, enable it from AppAPI to use it.', 503)
 
 			return func(*args, **kwargs)
@@ -200,7 +375,7 @@ def enabled_guard(app: FastAPI):
 # routes
 
 @app.get('/')
-def _(request: Request):
+async def _(request: Request):
 	'''
 	Server check
 	'''
@@ -208,13 +383,28 @@ def _(request: Request):
 
 
 @app.get('/enabled')
-def _():
+async def _():
 	return JSONResponse(content={'enabled': app_enabled.is_set()}, status_code=200)
 
 
+@app.get('/metrics')
+async def _():
+	return JSONResponse(content=metrics.snapshot(), status_code=200)
+
+
+@app.post('/taskCallback')
+async def _(task: Annotated[Task, Body(embed=True)]):
+	'''
+	Webhook of the finished TaskProcessing tasks, see the 'webhook' option of nc_texttotext
+	'''
+	if not notify_task_finished(task):
+		logger.debug(f'No query is waiting for the finished task {task.id}')
+	return JSONResponse('ok')
+
+
 @app.post('/updateAccessDeclarative')
 @enabled_guard(app)
-def _(
+async def _(
 	userIds: Annotated[list[str], Body()],
 	sourceId: Annotated[str, Body()],
 ):
@@ -229,14 +419,14 @@ def _(
 	if not is_valid_source_id(sourceId):
 		return JSONResponse('Invalid source id', 400)
 
-	exec_in_proc(target=decl_update_access, args=(vectordb_loader, userIds, sourceId))
+	await adecl_update_access(vectordb_loader, userIds, sourceId)
 
 	return JSONResponse('Access updated')
 
 
 @app.post('/updateAccess')
 @enabled_guard(app)
-def _(
+async def _(
 	op: Annotated[UpdateAccessOp, Body()],
 	userIds: Annotated[list[str], Body()],
 	sourceId: Annotated[str, Body()],
@@ -253,14 +443,14 @@ def _(
 	if not is_valid_source_id(sourceId):
 		return JSONResponse('Invalid source id', 400)
 
-	exec_in_proc(target=update_access, args=(vectordb_loader, op, userIds, sourceId))
+	await aupdate_access(vectordb_loader, op, userIds, sourceId)
 
 	return JSONResponse('Access updated')
 
 
 @app.post('/updateAccessProvider')
 @enabled_guard(app)
-def _(
+async def _(
 	op: Annotated[UpdateAccessOp, Body()],
 	userIds: Annotated[list[str], Body()],
 	providerId: Annotated[str, Body()],
@@ -277,7 +467,7 @@ def _(
 	if not is_valid_provider_id(providerId):
 		return JSONResponse('Invalid provider id', 400)
 
-	exec_in_proc(target=update_access, args=(vectordb_loader, op, userIds, providerId))
+	await aupdate_access_provider(vectordb_loader, op, userIds, providerId)
 
 	return JSONResponse('Access updated')
 
@@ -294,7 +484,7 @@ def _(sourceIds: Annotated[list[str], Body(embed=True)]):
 	if len(sourceIds) == 0:
 		return JSONResponse('No sources provided', 400)
 
-	res = exec_in_proc(target=delete_by_source, args=(vectordb_loader, sourceIds))
+	res = worker_pool.submit(delete_by_source, args=(vectordb_loader, sourceIds))
 	if res is False:
 		return JSONResponse('Error: VectorDB delete failed, check vectordb logs for more info.', 400)
 
@@ -309,7 +499,7 @@ def _(providerKey: str = Body(embed=True)):
 	if value_of(providerKey) is None:
 		return JSONResponse('Invalid provider key provided', 400)
 
-	exec_in_proc(target=delete_by_provider, args=(vectordb_loader, providerKey))
+	worker_pool.submit(delete_by_provider, args=(vectordb_loader, providerKey))
 
 	return JSONResponse('All valid sources deleted')
 
@@ -322,7 +512,7 @@ def _(userId: str = Body(embed=True)):
 	if value_of(userId) is None:
 		return JSONResponse('Invalid userId provided', 400)
 
-	exec_in_proc(target=delete_user, args=(vectordb_loader, userId))
+	worker_pool.submit(delete_user, args=(vectordb_loader, userId))
 
 	return JSONResponse('User deleted')
 
@@ -330,10 +520,49 @@ def _(userId: str = Body(embed=True)):
 @app.post('/countIndexedDocuments')
 @enabled_guard(app)
 def _():
-	counts = exec_in_proc(target=count_documents_by_provider, args=(vectordb_loader,))
+	counts = worker_pool.submit(count_documents_by_provider, args=(vectordb_loader,))
 	return JSONResponse(counts)
 
 
+@app.post('/checkSources')
+@enabled_guard(app)
+def _(sources: Annotated[list[SourceManifestEntry], Body(embed=True)]):
+	'''
+	Takes a manifest of the sources to index and returns the ids of the ones that need to be uploaded
+	to /loadSources, the access of the up to date sources is updated right away.
+	'''
+	for source in sources:
+		if not is_valid_source_id(source.sourceId):
+			return JSONResponse(f'Invalid source id: {source.sourceId}', 400)
+		if len(source.userIds) == 0 or not value_of(source.provider):
+			return JSONResponse(f'Invalid/missing user ids or provider for: {source.sourceId}', 400)
+
+	sources_to_upload = worker_pool.submit(check_manifest, args=(vectordb_loader, sources))
+	logger.debug('checked sources manifest', extra={
+		'Count of sources to upload': f'{len(sources_to_upload)}/{len(sources)}',
+	})
+	return JSONResponse({'sources_to_upload': sources_to_upload})
+
+
+def _valid_source_headers(source: UploadFile) -> bool:
+	if (
+		value_of(source.headers.get('userIds'))
+		and value_of(source.headers.get('title'))
+		and value_of(source.headers.get('type'))
+		and value_of(source.headers.get('modified'))
+		and source.headers['modified'].isdigit()
+		and value_of(source.headers.get('provider'))
+	):
+		return True
+
+	logger.error('Invalid/missing headers received', extra={
+		'source_id': source.filename,
+		'title': source.headers.get('title'),
+		'headers': source.headers,
+	})
+	return False
+
+
 @app.put('/loadSources')
 @enabled_guard(app)
 def _(sources: list[UploadFile]):
@@ -355,38 +584,25 @@ def _(sources: list[UploadFile]):
 					headers={'cc-retry': 'true'},
 				)
 
-		if not (
-			value_of(source.headers.get('userIds'))
-			and value_of(source.headers.get('title'))
-			and value_of(source.headers.get('type'))
-			and value_of(source.headers.get('modified'))
-			and source.headers['modified'].isdigit()
-			and value_of(source.headers.get('provider'))
-		):
-			logger.error('Invalid/missing headers received', extra={
-				'source_id': source.filename,
-				'title': source.headers.get('title'),
-				'headers': source.headers,
-			})
+		if not _valid_source_headers(source):
 			return JSONResponse(f'Invaild/missing headers for: {source.filename}', 400)
 
-	# wait for 10 minutes before failing the request
-	semres = doc_parse_semaphore.acquire(block=True, timeout=10*60)
-	if not semres:
-		return JSONResponse(
-			'Document parser worker limit reached, try again in some time or consider increasing the limit',
-			503,
-			headers={'cc-retry': 'true'}
-		)
-
 	with index_lock:
 		for source in sources:
 			_indexing[source.filename] = source.size
 
 	try:
-		loaded_sources, not_added_sources = exec_in_proc(
-			target=embed_sources,
-			args=(vectordb_loader, app.extra['CONFIG'], sources)
+		# the ingest workers are shared with the ingest queue runners, wait for 10 minutes before failing the request
+		loaded_sources, not_added_sources = ingest_pool.submit(
+			embed_sources,
+			args=(vectordb_loader, app.extra['CONFIG'], sources),
+			wait_timeout=10*60,
+		)
+	except WorkerPoolBusyException:
+		return JSONResponse(
+			'Document parser worker limit reached, try again in some time or consider increasing the limit',
+			503,
+			headers={'cc-retry': 'true'}
 		)
 	except DbException as e:
 		raise e
@@ -396,7 +612,6 @@ def _(sources: list[UploadFile]):
 		with index_lock:
 			for source in sources:
 				_indexing.pop(source.filename, None)
-		doc_parse_semaphore.release()
 
 	if len(loaded_sources) != len(sources):
 		logger.debug('Some sources were not loaded', extra={
@@ -408,6 +623,60 @@ def _(sources: list[UploadFile]):
 	return JSONResponse({'loaded_sources': loaded_sources, 'sources_to_retry': not_added_sources})
 
 
+@app.put('/queueSources')
+@enabled_guard(app)
+def _(sources: list[UploadFile]):
+	'''
+	Stores the sources and indexes them in the background, the returned job id can be
+	passed to /jobStatus to follow the progress.
+	'''
+	if len(sources) == 0:
+		return JSONResponse('No sources provided', 400)
+
+	for source in sources:
+		if not value_of(source.filename):
+			return JSONResponse(f'Invalid source filename for: {source.headers.get("title")}', 400)
+		if not _valid_source_headers(source):
+			return JSONResponse(f'Invaild/missing headers for: {source.filename}', 400)
+
+	job_id = str(uuid.uuid4())
+	try:
+		queued = persist_sources(INGEST_QUEUE_DIR, job_id, sources)
+		worker_pool.submit(enqueue_sources, args=(vectordb_loader, queued))
+	except Exception as e:
+		shutil.rmtree(os.path.join(INGEST_QUEUE_DIR, job_id), ignore_errors=True)
+		if isinstance(e, DbException):
+			raise
+		raise DbException('Error: failed to queue sources') from e
+
+	logger.debug('queued sources', extra={'job_id': job_id, 'Count of queued sources': len(queued)})
+	return JSONResponse({'job_id': job_id, 'queued_sources': [s.source_id for s in queued]}, 202)
+
+
+@app.post('/jobStatus')
+@enabled_guard(app)
+def _(jobId: Annotated[str, Body(embed=True)]):
+	try:
+		job_id = str(uuid.UUID(jobId))
+	except ValueError:
+		return JSONResponse(f'Invalid job id: {jobId}', 400)
+
+	sources = worker_pool.submit(get_job_status, args=(vectordb_loader, job_id))
+	if len(sources) == 0:
+		return JSONResponse(f'Job not found: {job_id}', 404)
+
+	counts = {status.value: 0 for status in IngestStatus}
+	for source in sources:
+		counts[source['status']] = counts.get(source['status'], 0) + 1
+
+	return JSONResponse({
+		'job_id': job_id,
+		'counts': counts,
+		'done': counts[IngestStatus.queued.value] == 0 and counts[IngestStatus.processing.value] == 0,
+		'sources': sources,
+	})
+
+
 class Query(BaseModel):
 	userId: str
 	query: str
@@ -433,7 +702,7 @@ class Query(BaseModel):
 		return value
 
 
-def execute_query(query: Query, in_proc: bool = True) -> LLMOutput:
+def execute_query(query: Query) -> LLMOutput:
 	llm: LLM = llm_loader.load()
 	template = app.extra.get('LLM_TEMPLATE')
 	no_ctx_template = app.extra['LLM_NO_CTX_TEMPLATE']
@@ -465,36 +734,184 @@ def execute_query(query: Query, in_proc: bool = True) -> LLMOutput:
 			end_separator,
 		)
 
-	if in_proc:
-		return exec_in_proc(target=target, args=args)
-
 	return target(*args)  # pyright: ignore
 
 
+async def aexecute_query(query: Query) -> LLMOutput:
+	llm: LLM = await run_in_threadpool(llm_loader.load)
+	end_separator = app.extra.get('LLM_END_SEPARATOR', '')
+
+	if query.useContext:
+		return await aprocess_context_query(
+			query.userId,
+			vectordb_loader,
+			llm,
+			app_config,
+			query.query,
+			query.ctxLimit,
+			query.scopeType,
+			query.scopeList,
+			app.extra.get('LLM_TEMPLATE'),
+			end_separator,
+		)
+
+	return await aprocess_query(
+		query.userId,
+		llm,
+		app_config,
+		query.query,
+		app.extra['LLM_NO_CTX_TEMPLATE'],
+		end_separator,
+	)
+
+
 @app.post('/query')
 @enabled_guard(app)
-def _(query: Query) -> LLMOutput:
+async def _(query: Query) -> LLMOutput:
 	logger.debug('received query request', extra={ 'query': query.dict() })
 
-	if app_config.llm[0] == 'nc_texttotext':
-		return execute_query(query)
+	# the waiting queries queue up on the event loop, only the admitted ones use a thread
+	async with llm_admission.aslot(len(query.query)):
+		if app_config.llm[0] == 'nc_texttotext':
+			# the task processing requests are awaited, the admitted queries wait for their results at once
+			return await aexecute_query(query)
+
+		# the local models are loaded in the main process
+		return await run_in_threadpool(execute_query, query)
+
+
+def _stream_query_task(
+	llm: LLM,
+	prompt: str,
+	user_id: str,
+	stop: list[str] | None,
+	sources: list[str],
+	start: float,
+	put_event: Callable[[dict[str, str] | None], None],
+	started: Event,
+	cancelled: Event,
+):
+	'''
+	Generates the output of a streamed query, the thread owns the admission slot of the query
+	'''
+	output = []
+	first_token_secs = None
+	try:
+		if not started.wait(STREAM_START_TIMEOUT):
+			logger.warning(f'query stream was not read in {STREAM_START_TIMEOUT} seconds, dropping the query')
+			return
+
+		with closing(stream_output(llm, prompt, user_id, stop)) as tokens:
+			for token in tokens:
+				if cancelled.is_set():
+					logger.debug('query stream closed by the client, stopping the generation')
+					return
+				if first_token_secs is None:
+					first_token_secs = monotonic() - start
+					metrics.observe('query.stream.first_token_secs', first_token_secs)
+				output.append(token)
+				put_event({'event': 'token', 'data': json.dumps(token)})
+
+		total_secs = monotonic() - start
+		metrics.observe('query.stream.secs', total_secs)
+		put_event({'event': 'done', 'data': json.dumps({
+			'output': ''.join(output).strip(),
+			'sources': sources,
+			'first_token_secs': first_token_secs,
+			'total_secs': total_secs,
+		})})
+	except Exception as e:
+		logger.exception('Error streaming the query output', exc_info=e)
+		metrics.inc('query.stream.errors')
+		put_event({'event': 'error', 'data': json.dumps(f'LLM Error: {e}')})
+	finally:
+		llm_admission.release()
+		put_event(None)
+
 
-	with llm_lock:
-		return execute_query(query, in_proc=False)
+@app.post('/queryStream')
+@enabled_guard(app)
+async def _(query: Query):
+	'''
+	Same as /query but the answer is sent as server-sent events: a "sources" event with the source ids
+	of the context, a "token" event for each piece of the output as it is generated and a "done" event
+	with the complete output and the timings. Errors after the stream has started are sent as an "error" event.
+	'''
+	logger.debug('received streaming query request', extra={ 'query': query.dict() })
+	start = monotonic()
+	loop = asyncio.get_running_loop()
+	events: asyncio.Queue[dict[str, str] | None] = asyncio.Queue()
+	started = Event()
+	cancelled = Event()
+
+	def put_event(event: dict[str, str] | None):
+		# the event loop is closed if the server shut down meanwhile
+		with suppress(RuntimeError):
+			loop.call_soon_threadsafe(events.put_nowait, event)
+
+	# the waiting queries queue up on the event loop,
+	# the context retrieval errors are returned with the status code before the stream starts
+	await llm_admission.aacquire(len(query.query))
+	try:
+		llm: LLM = await run_in_threadpool(llm_loader.load)
+		end_separator = app.extra.get('LLM_END_SEPARATOR', '')
+		if query.useContext:
+			prompt, sources = await aget_context_query_prompt(
+				query.userId,
+				vectordb_loader,
+				llm,
+				app_config,
+				query.query,
+				query.ctxLimit,
+				query.scopeType,
+				query.scopeList,
+				app.extra.get('LLM_TEMPLATE'),
+			)
+			stop = [end_separator]
+		else:
+			prompt = await run_in_threadpool(
+				get_query_prompt, llm, app_config, query.query, app.extra['LLM_NO_CTX_TEMPLATE'],
+			)
+			sources = []
+			stop = [end_separator] if end_separator else None
+
+		# the generation thread takes over the slot and releases it when it is done,
+		# it waits for the stream to be read before generating
+		Thread(
+			target=_stream_query_task,
+			args=(llm, prompt, query.userId, stop, sources, start, put_event, started, cancelled),
+			daemon=True,
+		).start()
+	except BaseException:
+		llm_admission.release()
+		raise
+
+	async def event_stream():
+		started.set()
+		try:
+			yield {'event': 'sources', 'data': json.dumps(sources)}
+			# no thread waits for the tokens, a disconnect cancels the wait right away
+			while (event := await events.get()) is not None:
+				yield event
+		finally:
+			# the client disconnected or the generation finished
+			cancelled.set()
+
+	return EventSourceResponse(event_stream())
 
 
 @app.post('/docSearch')
 @enabled_guard(app)
-def _(query: Query) -> list[SearchResult]:
+async def _(query: Query) -> list[SearchResult]:
 	# useContext from Query is not used here
-	return exec_in_proc(target=do_doc_search, args=(
+	return await ado_doc_search(
 		query.userId,
 		query.query,
 		vectordb_loader,
 		query.ctxLimit,
 		query.scopeType,
 		query.scopeList,
-	))
+	)
 
 
 @app.get('/downloadLogs')
@@ -4,19 +4,21 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 
+import asyncio
 import gc
 import logging
+import os
+import threading
 from abc import ABC, abstractmethod
 from time import sleep, time
 from typing import Any
 
-import httpx
 import torch
 from fastapi import FastAPI
 from langchain.llms.base import LLM
 
 from .models.loader import init_model
-from .network_em import NetworkEmbeddings
+from .network_em import HEALTH_CHECK_TIMEOUT, NetworkEmbeddings, get_client, get_endpoint_pool
 from .types import EmbeddingException, LoaderException, TConfig
 from .vectordb.base import BaseVectorDB
 from .vectordb.loader import get_vector_db
@@ -39,28 +41,28 @@ class EmbeddingModelLoader(Loader):
 		self.config = config
 
 	def load(self):
-		emconf = self.config.embedding
+		pool = get_endpoint_pool(self.config.embedding)
+		# known to be up from a recent request or health check
+		if pool.is_healthy():
+			return
+
 		last_resp, last_exc = None, None
 		# poll for heartbeat
 		try_ = 0
-		with httpx.Client() as client:
-			while try_ < 20:
+		while try_ < 20:
+			# one healthy endpoint is enough, the requests are balanced over the healthy ones
+			for endpoint in pool.endpoints:
 				try:
-					# test the server is up
-					# todo: replace with a tcp connection check
-					response = client.post(
-						f'{emconf.protocol}://{emconf.host}:{emconf.port}/v1/embeddings',
-						json={'input': 'hello'},
-						timeout=20, # seconds
-					)
+					response = pool.check_endpoint(endpoint)
 					if response.status_code == 200:
+						pool.mark_healthy(endpoint)
 						return
 					last_resp = response
 				except Exception as e:
 					last_exc = e
-					logger.debug(f'Try {try_} failed in exception')
-				try_ += 1
-				sleep(3)
+					logger.debug(f'Try {try_} failed in exception', extra={'endpoint': endpoint.name})
+			try_ += 1
+			sleep(3)
 
 		raise EmbeddingException(
 			'Error: the embedding server is not responding or could not be started. '
@@ -68,28 +70,64 @@ class EmbeddingModelLoader(Loader):
 		) from last_exc
 
 	def offload(self):
-		...
+		emconf = self.config.embedding
+		pool = get_endpoint_pool(emconf)
+		# the local servers unload the model, it is loaded again with the next request
+		for endpoint in pool.endpoints:
+			if not endpoint.local:
+				continue
+			try:
+				get_client(emconf).post(f'{endpoint.url}/ccb/offload', timeout=HEALTH_CHECK_TIMEOUT)
+			except Exception as e:
+				logger.warning(f'Could not offload the embedding model of {endpoint.name}', exc_info=e)
 
 
 class VectorDBLoader(Loader):
+	# the loader is copied into every worker process, so the instances are cached per process id
+	# to keep the db connection pool and the embedding client warm between the tasks of a worker
+	_instances: dict[int, BaseVectorDB] = {}
+
 	def __init__(self, em_loader: EmbeddingModelLoader, config: TConfig) -> None:
 		self.config = config
 		self.em_loader = em_loader
 
-	def load(self) -> BaseVectorDB:
+	def load(self, check_embedding: bool = True) -> BaseVectorDB:
+		'''
+		Args
+		----
+		check_embedding: bool
+			Wait for the embedding server to be up, not needed by the callers that only use the database
+		'''
 		try:
 			client_klass = get_vector_db(self.config.vectordb[0])
 		except (AssertionError, ImportError) as e:
 			raise LoaderException() from e
 
 		try:
-			self.em_loader.load()
+			if check_embedding:
+				self.em_loader.load()
+			if (db := VectorDBLoader._instances.get(os.getpid())) is not None:
+				return db
+
 			embedding_model = NetworkEmbeddings(app_config=self.config)
-			return client_klass(embedding_model, **self.config.vectordb[1])  # type: ignore
+			db = client_klass(embedding_model, **self.config.vectordb[1])  # type: ignore
+			VectorDBLoader._instances[os.getpid()] = db
+			return db
 		except DbException as e:
 			raise LoaderException() from e
 
+	async def aload(self) -> BaseVectorDB:
+		'''
+		Returns the loaded instance without blocking the event loop, the first load and
+		the embedding server health checks run in a thread
+		'''
+		db = VectorDBLoader._instances.get(os.getpid())
+		if db is not None and get_endpoint_pool(self.config.embedding).is_healthy():
+			return db
+		return await asyncio.to_thread(self.load)
+
 	def offload(self) -> None:
+		VectorDBLoader._instances.pop(os.getpid(), None)
 		self.em_loader.offload()
 		clear_cache()
 
@@ -98,13 +136,27 @@ class LLMModelLoader(Loader):
 	def __init__(self, app: FastAPI, config: TConfig) -> None:
 		self.config = config
 		self.app = app
+		self.offload_after_mins = int(config.llm[1].get('offload_after_mins', 0) or 0)
+		self.warmup_on_enable = bool(config.llm[1].get('warmup_on_enable', False))
+		# concurrent queries are admitted for the batched local models, the model is loaded once
+		self._load_lock = threading.Lock()
 
 	def load(self) -> LLM:
 		if self.app.extra.get('LLM_MODEL') is not None:
 			self.app.extra['LLM_LAST_ACCESSED'] = time()
 			return self.app.extra['LLM_MODEL']
 
+		with self._load_lock:
+			if self.app.extra.get('LLM_MODEL') is not None:
+				return self.app.extra['LLM_MODEL']
+			return self._load()
+
+	def _load(self) -> LLM:
 		llm_name, llm_config = self.config.llm
+		# copied to not lose the reserved keys when the model is loaded again after an offload
+		llm_config = dict(llm_config)
+		llm_config.pop('offload_after_mins', None)
+		llm_config.pop('warmup_on_enable', None)
 		self.app.extra['LLM_TEMPLATE'] = llm_config.pop('template', '')
 		self.app.extra['LLM_NO_CTX_TEMPLATE'] = llm_config.pop('no_ctx_template', '')
 		self.app.extra['LLM_END_SEPARATOR'] = llm_config.pop('end_separator', '')
@@ -120,6 +172,14 @@ class LLMModelLoader(Loader):
 		self.app.extra['LLM_LAST_ACCESSED'] = time()
 		return model
 
+	def idle_secs(self) -> float | None:
+		'''
+		Returns the seconds since the loaded model was last used or None if no model is loaded
+		'''
+		if self.app.extra.get('LLM_MODEL') is None:
+			return None
+		return time() - self.app.extra.get('LLM_LAST_ACCESSED', 0)
+
 	def offload(self) -> None:
 		if self.app.extra.get('LLM_MODEL') is not None:
 			del self.app.extra['LLM_MODEL']
@@ -0,0 +1,64 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+'''
+Process local counters, maxima and gauges.
+The worker processes send their counters and maxima to the parent process with the result of each task
+(see worker_pool.py), so the main process ends up with the totals of all the workers.
+'''
+import threading
+
+__all__ = ['drain', 'inc', 'merge', 'observe', 'set_gauge', 'snapshot']
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_maxima: dict[str, float] = {}
+_gauges: dict[str, float] = {}
+
+
+def inc(name: str, value: float = 1):
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, value: float):
+	'''
+	Records a measurement (like a duration in seconds) as "<name>.count", "<name>.sum" and "<name>.max".
+	'''
+	with _lock:
+		_counters[f'{name}.count'] = _counters.get(f'{name}.count', 0) + 1
+		_counters[f'{name}.sum'] = _counters.get(f'{name}.sum', 0) + value
+		_maxima[f'{name}.max'] = max(_maxima.get(f'{name}.max', value), value)
+
+
+def set_gauge(name: str, value: float):
+	'''
+	Gauges are the current value of something in this process and are not sent to the parent process.
+	'''
+	with _lock:
+		_gauges[name] = value
+
+
+def drain() -> dict[str, dict[str, float]]:
+	'''
+	Returns the counters and maxima collected since the last call and resets them.
+	'''
+	global _counters, _maxima
+	with _lock:
+		delta = {'counters': _counters, 'maxima': _maxima}
+		_counters, _maxima = {}, {}
+	return delta
+
+
+def merge(delta: dict[str, dict[str, float]]):
+	with _lock:
+		for name, value in delta.get('counters', {}).items():
+			_counters[name] = _counters.get(name, 0) + value
+		for name, value in delta.get('maxima', {}).items():
+			_maxima[name] = max(_maxima.get(name, value), value)
+
+
+def snapshot() -> dict[str, float]:
+	with _lock:
+		return dict(sorted({**_counters, **_maxima, **_gauges}.items()))
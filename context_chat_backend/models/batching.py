@@ -0,0 +1,151 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import threading
+from collections import deque
+from collections.abc import Iterator
+from time import monotonic
+from typing import Any
+
+from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM, BaseLLM
+from langchain_core.outputs import GenerationChunk
+from pydantic import PrivateAttr
+
+from .. import metrics
+
+__all__ = ['BATCH_CONFIG_KEYS', 'DEFAULT_MAX_BATCH_SIZE', 'BatchedLLM']
+
+logger = logging.getLogger('ccb.models')
+
+# reserved keys of the llm config, not passed to the model
+BATCH_CONFIG_KEYS = ('max_batch_size', 'batch_wait_ms')
+DEFAULT_MAX_BATCH_SIZE = 4
+
+
+class _Request:
+	def __init__(self, prompt: str, stop: list[str] | None):
+		self.prompt = prompt
+		self.stop = stop
+		self.done = threading.Event()
+		self.output: str | None = None
+		self.error: BaseException | None = None
+
+
+class BatchedLLM(LLM):
+	'''
+	Runs the concurrent calls of a local model in micro-batches of up to max_batch_size prompts
+	with one generate() call of the wrapped model.
+
+	There is no batching thread: the first caller to get the model becomes the leader, waits up to
+	batch_wait_ms for more prompts, generates the outputs of the whole batch and hands them to the
+	other callers. The prompts that arrive meanwhile are batched by the next leader.
+	Streams use the model alone, between two batches.
+	'''
+
+	llm: BaseLLM
+	max_batch_size: int = DEFAULT_MAX_BATCH_SIZE
+	batch_wait_ms: int = 10
+
+	_pending: deque[_Request] = PrivateAttr(default_factory=deque)
+	_pending_cond: threading.Condition = PrivateAttr(default_factory=threading.Condition)
+	# the wrapped models are not safe to use from more than one thread at a time
+	_model_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+	@property
+	def _llm_type(self) -> str:
+		return f'batched_{self.llm._llm_type}'
+
+	@property
+	def _identifying_params(self) -> dict[str, Any]:
+		return {
+			**self.llm._identifying_params,
+			'max_batch_size': self.max_batch_size,
+			'batch_wait_ms': self.batch_wait_ms,
+		}
+
+	def get_num_tokens(self, text: str) -> int:
+		return self.llm.get_num_tokens(text)
+
+	def get_token_ids(self, text: str) -> list[int]:
+		return self.llm.get_token_ids(text)
+
+	def _call(
+		self,
+		prompt: str,
+		stop: list[str] | None = None,
+		run_manager: CallbackManagerForLLMRun | None = None,
+		**kwargs: Any,
+	) -> str:
+		'''
+		Queues the prompt for the next batch and waits for its output.
+		The extra kwargs (like 'userid') are only used by the nc_texttotext backend and are dropped.
+		'''
+		request = _Request(prompt, stop)
+		with self._pending_cond:
+			self._pending.append(request)
+			self._pending_cond.notify()
+
+		while not request.done.is_set():
+			with self._model_lock:
+				# the previous leader may have generated this output already
+				if not request.done.is_set():
+					self._run_batch()
+
+		if request.error is not None:
+			raise request.error
+		return request.output  # pyright: ignore[reportReturnType]
+
+	def _take_batch(self) -> list[_Request]:
+		deadline = monotonic() + self.batch_wait_ms / 1000
+		with self._pending_cond:
+			while len(self._pending) < self.max_batch_size and (timeout := deadline - monotonic()) > 0:
+				self._pending_cond.wait(timeout)
+
+			# only prompts with the same stop words can be generated together
+			stop = self._pending[0].stop
+			batch, rest = [], deque()
+			while len(self._pending) > 0:
+				request = self._pending.popleft()
+				if len(batch) < self.max_batch_size and request.stop == stop:
+					batch.append(request)
+				else:
+					rest.append(request)
+			self._pending.extendleft(reversed(rest))
+		return batch
+
+	def _run_batch(self):
+		batch = self._take_batch()
+		start = monotonic()
+		try:
+			result = self.llm.generate([request.prompt for request in batch], stop=batch[0].stop)
+			for request, generations in zip(batch, result.generations, strict=True):
+				request.output = generations[0].text
+		except Exception as e:
+			# every caller of the batch gets the error, not only the leader
+			for request in batch:
+				request.error = e
+		finally:
+			for request in batch:
+				request.done.set()
+
+		metrics.inc('llm.batches')
+		metrics.observe('llm.batch_size', len(batch))
+		metrics.observe('llm.batch_secs', monotonic() - start)
+		logger.debug(f'Generated a batch of {len(batch)} prompts in {monotonic() - start:.2f}s')
+
+	def _stream(
+		self,
+		prompt: str,
+		stop: list[str] | None = None,
+		run_manager: CallbackManagerForLLMRun | None = None,
+		**kwargs: Any,
+	) -> Iterator[GenerationChunk]:
+		with self._model_lock:
+			if type(self.llm)._stream is BaseLLM._stream:
+				# the model cannot stream, the whole output is one chunk
+				yield GenerationChunk(text=self.llm.invoke(prompt, stop=stop))
+				return
+			yield from self.llm._stream(prompt, stop=stop, run_manager=run_manager)
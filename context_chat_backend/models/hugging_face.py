@@ -7,6 +7,8 @@ from os import getenv, path
 
 from langchain_community.llms.huggingface_pipeline import HuggingFacePipeline
 
+from .batching import BATCH_CONFIG_KEYS, DEFAULT_MAX_BATCH_SIZE, BatchedLLM
+
 logger = logging.getLogger('ccb.models')
 
 def get_model_for(model_type: str, model_config: dict):
@@ -25,6 +27,11 @@ def get_model_for(model_type: str, model_config: dict):
 		return None
 
 	if model_type == 'llm':
-		return HuggingFacePipeline.from_model_id(**{**model_config, 'model_id': model_path})
+		batch_config = {k: model_config[k] for k in BATCH_CONFIG_KEYS if k in model_config}
+		hf_config = {k: v for k, v in model_config.items() if k not in BATCH_CONFIG_KEYS}
+		# the pipeline runs the whole micro-batch as one padded batch
+		hf_config.setdefault('batch_size', batch_config.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE))
+		hf_llm = HuggingFacePipeline.from_model_id(**{**hf_config, 'model_id': model_path})
+		return BatchedLLM(llm=hf_llm, **batch_config)
 
 	return None
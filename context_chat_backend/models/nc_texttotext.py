@@ -2,17 +2,14 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import asyncio
 import logging
-import time
 from typing import Any
 
-import httpx
-from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain_core.language_models.llms import LLM
-from nc_py_api import NextcloudApp, NextcloudException
-from pydantic import BaseModel, ValidationError
 
-from .types import LlmException
+from .task_processing import TaskProcessingConfig, get_task_client
 
 logger = logging.getLogger('ccb.models')
 
@@ -21,24 +18,17 @@ def get_model_for(model_type: str, model_config: dict):
 		return None
 
 	if model_type == 'llm':
-		return CustomLLM()
+		return CustomLLM(task_config=TaskProcessingConfig(**model_config))
 
 	return None
 
 
-class Task(BaseModel):
-	id: int
-	status: str
-	output: dict[str, str] | None = None
-
-
-class Response(BaseModel):
-	task: Task
-
-
 class CustomLLM(LLM):
 	'''A custom chat model that queries Nextcloud's TextToText provider'''
 
+	# the tasks of all the instances of a process are run by one shared client
+	task_config: TaskProcessingConfig = TaskProcessingConfig()
+
 	def _call(
 		self,
 		prompt: str,
@@ -62,89 +52,19 @@ class CustomLLM(LLM):
 		Returns:
 			The model output as a string. Actual completions SHOULD NOT include the prompt.
 		'''
-		nc = NextcloudApp()
-
-		if kwargs.get('userid') is not None:
-			nc.set_user(kwargs['userid'])
-		else:
-			logger.warning('No user ID provided for Nextcloud TextToText provider')
-
-		sched_tries = 3
-		while True:
-			try:
-				sched_tries -= 1
-				if sched_tries <= 0:
-					raise LlmException('Failed to schedule Nextcloud TaskProcessing task, tried 3 times')
-
-				response = nc.ocs(
-					'POST',
-					'/ocs/v1.php/taskprocessing/schedule',
-					json={'type': 'core:text2text', 'appId': 'context_chat_backend', 'input': {'input': prompt}},
-				)
-				break
-			except NextcloudException as e:
-				if e.status_code == httpx.codes.PRECONDITION_FAILED:
-					raise LlmException(
-						'Failed to schedule Nextcloud TaskProcessing task: '
-						'This app is setup to use a text generation provider in Nextcloud. '
-						'No such provider is installed on Nextcloud instance. '
-						'Please install integration_openai, llm2 or any other text2text provider.'
-					) from e
-
-				if e.status_code == httpx.codes.TOO_MANY_REQUESTS:
-					logger.warning('Rate limited during task scheduling, waiting 10s before retrying')
-					time.sleep(10)
-					continue
-
-				raise LlmException('Failed to schedule Nextcloud TaskProcessing task') from e
-
-		try:
-			task = Response.model_validate(response).task
-			logger.debug(f'Initial task schedule response: {task}')
-
-			i = 0
-			# wait for 30 minutes
-			while task.status != 'STATUS_SUCCESSFUL' and task.status != 'STATUS_FAILED' and i < 60 * 6:
-				if i < 60 * 3:
-					time.sleep(5)
-					i += 1
-				else:
-					# pool every 10 secs in the second half
-					time.sleep(10)
-					i += 2
-
-				try:
-					response = nc.ocs('GET', f'/ocs/v1.php/taskprocessing/task/{task.id}')
-				except (
-					httpx.RemoteProtocolError,
-					httpx.ReadError,
-					httpx.LocalProtocolError,
-					httpx.PoolTimeout,
-				) as e:
-					logger.warning('Ignored error during task polling', exc_info=e)
-					time.sleep(5)
-					i += 1
-					continue
-				except NextcloudException as e:
-					if e.status_code == httpx.codes.TOO_MANY_REQUESTS:
-						logger.warning('Rate limited during task polling, waiting 10s before retrying')
-						time.sleep(10)
-						i += 2
-						continue
-					raise LlmException('Failed to poll Nextcloud TaskProcessing task') from e
-
-				task = Response.model_validate(response).task
-				logger.debug(f'Task poll ({i * 5}s) response: {task}')
-		except ValidationError as e:
-			raise LlmException('Failed to parse Nextcloud TaskProcessing task result') from e
-
-		if task.status != 'STATUS_SUCCESSFUL':
-			raise LlmException('Nextcloud TaskProcessing Task failed')
-
-		if not isinstance(task.output, dict) or 'output' not in task.output:
-			raise LlmException('"output" key not found in Nextcloud TaskProcessing task result')
-
-		return task.output['output']
+		return get_task_client(self.task_config).run(prompt, kwargs.get('userid')).result()
+
+	async def _acall(
+		self,
+		prompt: str,
+		stop: list[str] | None = None,
+		run_manager: AsyncCallbackManagerForLLMRun | None = None,
+		**kwargs: Any,
+	) -> str:
+		'''
+		Same as _call but only a pending coroutine waits for the task, not a thread
+		'''
+		return await asyncio.wrap_future(get_task_client(self.task_config).run(prompt, kwargs.get('userid')))
 
 	@property
 	def _identifying_params(self) -> dict[str, Any]:
@@ -0,0 +1,371 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import asyncio
+import inspect
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
+
+import httpx
+from nc_py_api import AsyncNextcloudApp, NextcloudException
+from pydantic import BaseModel, ValidationError
+
+from .. import metrics
+from .types import LlmException
+
+__all__ = ['Task', 'TaskProcessingClient', 'TaskProcessingConfig', 'get_task_client', 'notify_task_finished']
+
+logger = logging.getLogger('ccb.models')
+
+APP_ID = 'context_chat_backend'
+SCHEDULE_PATH = '/ocs/v1.php/taskprocessing/schedule'
+# route of the controller that receives the finished tasks in the webhook mode
+CALLBACK_PATH = '/taskCallback'
+FINAL_STATUSES = ('STATUS_SUCCESSFUL', 'STATUS_FAILED')
+POLL_NETWORK_ERRORS = (
+	httpx.RemoteProtocolError,
+	httpx.ReadError,
+	httpx.LocalProtocolError,
+	httpx.PoolTimeout,
+)
+# used when a 429 response has no Retry-After header
+DEFAULT_RETRY_AFTER = 10
+SCHEDULE_TRIES = 3
+# finished tasks received by the webhook before their query started waiting for them
+MAX_EARLY_RESULTS = 256
+# clients of the users with recent queries, the least recently used ones are closed
+MAX_NC_CLIENTS = 128
+
+_clients: dict[int, 'TaskProcessingClient'] = {}
+_clients_lock = threading.Lock()
+
+
+class Task(BaseModel):
+	id: int
+	status: str
+	output: dict[str, str] | None = None
+
+
+class Response(BaseModel):
+	task: Task
+
+
+class TaskProcessingConfig(BaseModel):
+	# a task is polled after poll_min_secs first, the interval grows by poll_backoff up to poll_max_secs
+	poll_min_secs: float = 0.5
+	poll_max_secs: float = 10
+	poll_backoff: float = 1.5
+	# max concurrent requests of a polling round
+	max_concurrent_polls: int = 16
+	timeout_secs: int = 30 * 60
+	# Nextcloud calls /taskCallback when a task finishes, the tasks are only polled every
+	# webhook_poll_secs in case a callback is lost
+	webhook: bool = False
+	webhook_poll_secs: float = 60
+
+
+class _PendingTask:
+	def __init__(self, task_id: int, user_id: str | None, interval: float, future: asyncio.Future[Task]):
+		self.task_id = task_id
+		self.user_id = user_id
+		self.interval = interval
+		self.next_poll = monotonic() + interval
+		self.future = future
+
+
+def _retry_after(e: NextcloudException) -> float:
+	'''
+	Seconds to wait from the Retry-After header of a 429 response, as seconds or as an HTTP date.
+	Only the response of the exception is used, the last response headers of the client are
+	overwritten by the concurrent requests.
+	'''
+	response = getattr(e, 'response', None)
+	value = response.headers.get('Retry-After') if response is not None else None
+	if not value:
+		return DEFAULT_RETRY_AFTER
+
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+	try:
+		return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+	except (TypeError, ValueError):
+		return DEFAULT_RETRY_AFTER
+
+
+def _raise_for_schedule_error(e: NextcloudException):
+	'''
+	Raises an LlmException unless the scheduling was rate limited and can be retried
+	'''
+	if e.status_code == httpx.codes.PRECONDITION_FAILED:
+		raise LlmException(
+			'Failed to schedule Nextcloud TaskProcessing task: '
+			'This app is setup to use a text generation provider in Nextcloud. '
+			'No such provider is installed on Nextcloud instance. '
+			'Please install integration_openai, llm2 or any other text2text provider.'
+		) from e
+
+	if e.status_code != httpx.codes.TOO_MANY_REQUESTS:
+		raise LlmException('Failed to schedule Nextcloud TaskProcessing task') from e
+
+
+async def _aclose(nc: AsyncNextcloudApp):
+	'''
+	Closes the http sessions of a client, nc_py_api has no public method for it
+	'''
+	session = nc._session
+	for adapter in (getattr(session, 'adapter', None), getattr(session, 'adapter_dav', None)):
+		if adapter is None:
+			continue
+		# httpx clients have aclose(), niquests sessions an async close()
+		close = getattr(adapter, 'aclose', None) or adapter.close
+		try:
+			if inspect.isawaitable(result := close()):
+				await result
+		except Exception as e:
+			logger.debug('Error closing an evicted Nextcloud client', exc_info=e)
+
+
+def _task_output(task: Task) -> str:
+	if task.status != 'STATUS_SUCCESSFUL':
+		raise LlmException('Nextcloud TaskProcessing Task failed')
+
+	if not isinstance(task.output, dict) or 'output' not in task.output:
+		raise LlmException('"output" key not found in Nextcloud TaskProcessing task result')
+
+	return task.output['output']
+
+
+class TaskProcessingClient:
+	'''
+	Runs the text2text tasks of all the queries of a process.
+	The outstanding tasks are polled together in rounds by one poller, each task with its own
+	backed-off interval, and the waiting query is woken up as soon as its task is finished.
+	A rate limited response pauses the whole round for the time given in Retry-After.
+
+	The client has its own event loop in a daemon thread so that it can be used by sync callers
+	(blocking on the returned future) and by async callers of any event loop.
+	'''
+
+	def __init__(self, config: TaskProcessingConfig):
+		self.config = config
+		self._pending: dict[int, _PendingTask] = {}
+		self._early_results: OrderedDict[int, Task] = OrderedDict()
+		self._ncs: OrderedDict[str | None, AsyncNextcloudApp] = OrderedDict()
+		self._nc_locks: dict[str | None, asyncio.Lock] = {}
+		self._paused_until = 0.0
+
+		self._loop = asyncio.new_event_loop()
+		threading.Thread(target=self._loop.run_forever, name='ccb-taskprocessing', daemon=True).start()
+		asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+	async def _start(self):
+		self._wakeup = asyncio.Event()
+		self._poll_semaphore = asyncio.Semaphore(max(self.config.max_concurrent_polls, 1))
+		self._poller = self._loop.create_task(self._poll_forever())
+
+	def run(self, prompt: str, user_id: str | None) -> Future[str]:
+		'''
+		Schedules a text2text task and returns a future with its output
+
+		Raises (in the future)
+		------
+		LlmException
+		'''
+		return asyncio.run_coroutine_threadsafe(self._run(prompt, user_id), self._loop)
+
+	def complete(self, task: Task):
+		'''
+		Hands a finished task received by the webhook to the query waiting for it, thread-safe
+		'''
+		self._loop.call_soon_threadsafe(self._resolve, task)
+
+	def _resolve(self, task: Task):
+		pending = self._pending.get(task.id)
+		if pending is None:
+			# the scheduling request of the query has not returned yet
+			self._early_results[task.id] = task
+			while len(self._early_results) > MAX_EARLY_RESULTS:
+				self._early_results.popitem(last=False)
+			return
+
+		if not pending.future.done():
+			pending.future.set_result(task)
+
+	async def _nc(self, user_id: str | None) -> AsyncNextcloudApp:
+		# one client per user, the tasks can only be read by the user that scheduled them
+		if (nc := self._ncs.get(user_id)) is not None:
+			self._ncs.move_to_end(user_id)
+			return nc
+
+		# the concurrent first queries of a user wait for the same client
+		async with self._nc_locks.setdefault(user_id, asyncio.Lock()):
+			if (nc := self._ncs.get(user_id)) is not None:
+				self._ncs.move_to_end(user_id)
+				return nc
+
+			nc = AsyncNextcloudApp()
+			if user_id is not None:
+				await nc.set_user(user_id)
+			self._ncs[user_id] = nc
+
+		while len(self._ncs) > MAX_NC_CLIENTS:
+			evicted_user, evicted = self._ncs.popitem(last=False)
+			self._nc_locks.pop(evicted_user, None)
+			await _aclose(evicted)
+		return nc
+
+	async def _schedule(self, nc: AsyncNextcloudApp, prompt: str) -> Task:
+		body = {'type': 'core:text2text', 'appId': APP_ID, 'input': {'input': prompt}}
+		if self.config.webhook:
+			body['webhookUri'] = CALLBACK_PATH
+			body['webhookMethod'] = f'AppAPI:{APP_ID}:POST'
+
+		for _ in range(SCHEDULE_TRIES):
+			try:
+				response = await nc.ocs('POST', SCHEDULE_PATH, json=body)
+			except NextcloudException as e:
+				_raise_for_schedule_error(e)
+				wait = _retry_after(e)
+				metrics.inc('taskprocessing.rate_limited')
+				logger.warning(f'Rate limited during task scheduling, waiting {wait:.1f}s before retrying')
+				await asyncio.sleep(wait)
+				continue
+
+			try:
+				return Response.model_validate(response).task
+			except ValidationError as e:
+				raise LlmException('Failed to parse Nextcloud TaskProcessing task result') from e
+
+		raise LlmException(f'Failed to schedule Nextcloud TaskProcessing task, tried {SCHEDULE_TRIES} times')
+
+	async def _run(self, prompt: str, user_id: str | None) -> str:
+		if user_id is None:
+			logger.warning('No user ID provided for Nextcloud TextToText provider')
+
+		start = monotonic()
+		nc = await self._nc(user_id)
+		task = await self._schedule(nc, prompt)
+		logger.debug(f'Initial task schedule response: {task}')
+
+		task = self._early_results.pop(task.id, task)
+		if task.status not in FINAL_STATUSES:
+			interval = self.config.webhook_poll_secs if self.config.webhook else self.config.poll_min_secs
+			pending = _PendingTask(task.id, user_id, interval, self._loop.create_future())
+			self._pending[task.id] = pending
+			metrics.set_gauge('taskprocessing.pending', len(self._pending))
+			self._wakeup.set()
+			try:
+				task = await asyncio.wait_for(pending.future, self.config.timeout_secs)
+			except TimeoutError as e:
+				raise LlmException(
+					f'Nextcloud TaskProcessing task did not finish in {self.config.timeout_secs} seconds',
+				) from e
+			finally:
+				self._pending.pop(task.id, None)
+				metrics.set_gauge('taskprocessing.pending', len(self._pending))
+
+		metrics.observe('taskprocessing.task_secs', monotonic() - start)
+		return _task_output(task)
+
+	async def _poll_forever(self):
+		while True:
+			now = monotonic()
+			due = [
+				pending for pending in self._pending.values()
+				if pending.next_poll <= now and not pending.future.done()
+			]
+			if len(due) > 0 and now >= self._paused_until:
+				metrics.inc('taskprocessing.poll_rounds')
+				await asyncio.gather(*(self._poll(pending) for pending in due))
+				continue
+
+			timeout = None
+			if len(self._pending) > 0:
+				next_poll = min(pending.next_poll for pending in self._pending.values())
+				timeout = max(max(next_poll, self._paused_until) - monotonic(), 0)
+
+			self._wakeup.clear()
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), timeout)
+			except TimeoutError:
+				pass
+
+	async def _poll(self, pending: _PendingTask):
+		async with self._poll_semaphore:
+			metrics.inc('taskprocessing.polls')
+			nc = None
+			try:
+				nc = await self._nc(pending.user_id)
+				response = await nc.ocs('GET', f'/ocs/v1.php/taskprocessing/task/{pending.task_id}')
+				task = Response.model_validate(response).task
+			except POLL_NETWORK_ERRORS as e:
+				logger.warning('Ignored error during task polling', exc_info=e)
+				self._backoff(pending)
+				return
+			except NextcloudException as e:
+				if e.status_code == httpx.codes.TOO_MANY_REQUESTS:
+					wait = _retry_after(e)
+					metrics.inc('taskprocessing.rate_limited')
+					logger.warning(f'Rate limited during task polling, pausing the polling for {wait:.1f}s')
+					self._paused_until = max(self._paused_until, monotonic() + wait)
+					pending.next_poll = max(pending.next_poll, self._paused_until)
+					return
+				self._fail(pending, LlmException('Failed to poll Nextcloud TaskProcessing task'), e)
+				return
+			except ValidationError as e:
+				self._fail(pending, LlmException('Failed to parse Nextcloud TaskProcessing task result'), e)
+				return
+			except Exception as e:
+				self._fail(pending, LlmException('Failed to poll Nextcloud TaskProcessing task'), e)
+				return
+
+		logger.debug(f'Task poll response: {task}')
+		if task.status in FINAL_STATUSES:
+			if not pending.future.done():
+				pending.future.set_result(task)
+			return
+		self._backoff(pending)
+
+	def _backoff(self, pending: _PendingTask):
+		if not self.config.webhook:
+			pending.interval = min(pending.interval * self.config.poll_backoff, self.config.poll_max_secs)
+		pending.next_poll = monotonic() + pending.interval
+
+	def _fail(self, pending: _PendingTask, exc: LlmException, cause: Exception):
+		exc.__cause__ = cause
+		if not pending.future.done():
+			pending.future.set_exception(exc)
+
+
+def get_task_client(config: TaskProcessingConfig) -> TaskProcessingClient:
+	pid = os.getpid()
+	if (client := _clients.get(pid)) is not None:
+		return client
+
+	with _clients_lock:
+		if pid not in _clients:
+			_clients[pid] = TaskProcessingClient(config)
+		return _clients[pid]
+
+
+def notify_task_finished(task: Task) -> bool:
+	'''
+	Passes a task received by the webhook to the client of this process, if it has one
+
+	Returns
+	-------
+	bool
+		False if no query of this process uses the task processing client
+	'''
+	if (client := _clients.get(os.getpid())) is None:
+		return False
+	client.complete(task)
+	return True
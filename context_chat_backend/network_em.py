@@ -2,18 +2,234 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import asyncio
 import logging
-from time import sleep
+import os
+import random
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
 from typing import Literal, TypedDict
 
 import httpx
 from langchain_core.embeddings import Embeddings
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
-from .types import EmbeddingException, TConfig
+from . import metrics
+from .types import EmbeddingException, TConfig, TEmbedding, TEmbeddingEndpoint
+from .utils import text_hash
 
 logger = logging.getLogger('ccb.nextwork_em')
 
+RETRY_BASE_DELAY = 0.5 # seconds
+RETRY_MAX_DELAY = 10 # seconds
+MIN_ATTEMPT_TIMEOUT = 1 # seconds
+# rough estimate that overcounts the tokens of most languages, the exact count is not needed for batching
+CHARS_PER_TOKEN = 3
+# llama.cpp's default n_batch
+DEFAULT_N_BATCH = 512
+# consecutive failures after which an endpoint is taken out of the rotation
+EJECT_AFTER_FAILURES = 3
+EJECT_SECS = 30
+HEALTH_CHECK_TIMEOUT = 5 # seconds
+# server errors worth retrying, other 4xx responses (like too long inputs) fail the same way again
+RETRYABLE_STATUS_CODES = {
+	httpx.codes.REQUEST_TIMEOUT,
+	httpx.codes.TOO_MANY_REQUESTS,
+	httpx.codes.INTERNAL_SERVER_ERROR,
+	httpx.codes.BAD_GATEWAY,
+	httpx.codes.SERVICE_UNAVAILABLE,
+	httpx.codes.GATEWAY_TIMEOUT,
+}
+
+# clients are shared by all the embedding calls of a process to reuse the keep-alive connections.
+# they are keyed by the process id since the connections cannot be shared with forked processes,
+# and the async clients also by the event loop they are bound to.
+_clients: dict[int, httpx.Client] = {}
+_async_clients: dict[tuple[int, int], httpx.AsyncClient] = {}
+_endpoint_pools: dict[int, 'EndpointPool'] = {}
+_clients_lock = threading.Lock()
+
+
+def _limits(emconf: TEmbedding) -> httpx.Limits:
+	return httpx.Limits(
+		max_connections=emconf.max_connections,
+		max_keepalive_connections=emconf.max_keepalive_connections,
+		keepalive_expiry=emconf.keepalive_expiry,
+	)
+
+
+def get_client(emconf: TEmbedding) -> httpx.Client:
+	pid = os.getpid()
+	if (client := _clients.get(pid)) is not None:
+		return client
+
+	with _clients_lock:
+		if pid not in _clients:
+			_clients[pid] = httpx.Client(limits=_limits(emconf))
+		return _clients[pid]
+
+
+def get_async_client(emconf: TEmbedding) -> httpx.AsyncClient:
+	key = (os.getpid(), id(asyncio.get_running_loop()))
+	if (client := _async_clients.get(key)) is not None:
+		return client
+
+	with _clients_lock:
+		if key not in _async_clients:
+			_async_clients[key] = httpx.AsyncClient(limits=_limits(emconf))
+		return _async_clients[key]
+
+
+def get_endpoint_pool(emconf: TEmbedding) -> 'EndpointPool':
+	pid = os.getpid()
+	if (pool := _endpoint_pools.get(pid)) is not None:
+		return pool
+
+	with _clients_lock:
+		if pid not in _endpoint_pools:
+			_endpoint_pools[pid] = EndpointPool(emconf)
+		return _endpoint_pools[pid]
+
+
+class _Endpoint:
+	def __init__(self, endpoint: TEmbeddingEndpoint):
+		self.name = f'{endpoint.host}:{endpoint.port}'
+		self.url = f'{endpoint.protocol}://{endpoint.host}:{endpoint.port}'
+		self.local = endpoint.local
+		self.in_flight = 0
+		self.failures = 0
+		# 0 when the endpoint is in the rotation
+		self.ejected_until = 0.0
+		self.probing = False
+
+
+class EndpointPool:
+	'''
+	Balances the embedding requests of a process over the configured endpoints
+	by sending each request to the endpoint with the fewest requests in flight.
+	Endpoints failing consecutive requests are ejected and added back once a health check passes.
+	'''
+
+	def __init__(self, emconf: TEmbedding):
+		self.emconf = emconf
+		self.endpoints = [_Endpoint(e) for e in emconf.get_endpoints()]
+		# readiness of the embedding servers, refreshed by successful requests and health checks
+		self.healthy_until = 0.0
+		self._lock = threading.Lock()
+
+	def is_healthy(self) -> bool:
+		return monotonic() < self.healthy_until
+
+	def check_endpoint(self, endpoint: _Endpoint) -> httpx.Response:
+		'''
+		Cheap liveness probe that does not run the model.
+		The server loads the model before it starts listening so a response means that it is ready.
+		/ccb/health does not wait for the lock of the model (unlike /v1/models), so an endpoint
+		that is busy with a long embedding request is not ejected.
+		'''
+		metrics.inc('embedding.health_checks')
+		return get_client(self.emconf).get(f'{endpoint.url}/ccb/health', timeout=HEALTH_CHECK_TIMEOUT)
+
+	def mark_healthy(self, endpoint: _Endpoint):
+		with self._lock:
+			endpoint.failures = 0
+			endpoint.ejected_until = 0
+			self.healthy_until = monotonic() + self.emconf.health_ttl_secs
+
+	def has_due_probes(self) -> bool:
+		now = monotonic()
+		return any(0 < e.ejected_until <= now and not e.probing for e in self.endpoints)
+
+	def probe_due(self):
+		'''
+		Health checks the ejected endpoints whose ejection period is over.
+		'''
+		now = monotonic()
+		with self._lock:
+			due = [e for e in self.endpoints if 0 < e.ejected_until <= now and not e.probing]
+			for endpoint in due:
+				endpoint.probing = True
+
+		for endpoint in due:
+			try:
+				healthy = self.check_endpoint(endpoint).status_code == 200
+			except httpx.HTTPError:
+				healthy = False
+
+			if healthy:
+				self.mark_healthy(endpoint)
+			with self._lock:
+				endpoint.probing = False
+				if not healthy:
+					endpoint.ejected_until = monotonic() + EJECT_SECS
+
+			if healthy:
+				logger.info(f'Embedding endpoint {endpoint.name} is healthy again, adding it back')
+			else:
+				logger.debug(f'Embedding endpoint {endpoint.name} failed the health check')
+
+	def acquire(self) -> _Endpoint:
+		with self._lock:
+			# all of them are tried if every endpoint is ejected, the request may still go through
+			candidates = [e for e in self.endpoints if e.ejected_until == 0] or self.endpoints
+			fewest = min(e.in_flight for e in candidates)
+			endpoint = random.choice([e for e in candidates if e.in_flight == fewest])  # noqa: S311
+			endpoint.in_flight += 1
+			metrics.set_gauge(f'embedding.endpoint.{endpoint.name}.in_flight', endpoint.in_flight)
+			return endpoint
+
+	def release(self, endpoint: _Endpoint, latency: float, error: BaseException | None):
+		# a busy server (429) is not an unhealthy one
+		failed = isinstance(error, httpx.TransportError) or (
+			isinstance(error, _EmbeddingHTTPError) and error.status_code >= 500
+		)
+		eject = False
+
+		with self._lock:
+			endpoint.in_flight -= 1
+			metrics.set_gauge(f'embedding.endpoint.{endpoint.name}.in_flight', endpoint.in_flight)
+			if not failed:
+				endpoint.failures = 0
+				if error is None:
+					self.healthy_until = monotonic() + self.emconf.health_ttl_secs
+			else:
+				endpoint.failures += 1
+				if endpoint.failures >= EJECT_AFTER_FAILURES and endpoint.ejected_until == 0:
+					eject = True
+					endpoint.ejected_until = monotonic() + EJECT_SECS
+					if all(e.ejected_until > 0 for e in self.endpoints):
+						self.healthy_until = 0
+
+		metrics.inc(f'embedding.endpoint.{endpoint.name}.requests')
+		metrics.observe(f'embedding.endpoint.{endpoint.name}.latency', latency)
+		if error is not None:
+			metrics.inc(f'embedding.endpoint.{endpoint.name}.errors')
+		if eject:
+			metrics.inc(f'embedding.endpoint.{endpoint.name}.ejections')
+			logger.warning(
+				f'Embedding endpoint {endpoint.name} failed {endpoint.failures} requests in a row,'
+				f' ejecting it for {EJECT_SECS} seconds',
+				exc_info=error,
+			)
+
+
+class _EmbeddingHTTPError(Exception):
+	def __init__(self, status_code: int, text: str):
+		super().__init__(f'{status_code}: {text}')
+		self.status_code = status_code
+
+
+def _estimate_tokens(text: str) -> int:
+	return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _is_retryable(error: Exception) -> bool:
+	if isinstance(error, _EmbeddingHTTPError):
+		return error.status_code in RETRYABLE_STATUS_CODES
+	return isinstance(error, httpx.TransportError)
+
 # Copied from llama_cpp/llama_types.py
 
 class EmbeddingUsage(TypedDict):
@@ -34,39 +250,58 @@ class CreateEmbeddingResponse(TypedDict):
 	usage: EmbeddingUsage
 
 
+class EmbeddingCache(ABC):
+	'''
+	Persistent store of the embeddings keyed by the model id and the hash of the embedded text
+	'''
+
+	@abstractmethod
+	def get_many(self, model_id: str, text_hashes: list[str]) -> dict[str, list[float]]:
+		'''
+		Returns the cached embeddings of the given text hashes, the missing ones are not present in the dict.
+		'''
+
+	@abstractmethod
+	def put_many(self, model_id: str, embeddings: dict[str, list[float]]):
+		'''
+		Stores the embeddings by their text hashes.
+		'''
+
+
 class NetworkEmbeddings(Embeddings, BaseModel):
+	model_config = ConfigDict(arbitrary_types_allowed=True)
+
 	app_config: TConfig
+	cache: EmbeddingCache | None = None
 
-	def _get_embedding(self, input_: str | list[str], try_: int = 3) -> list[float] | list[list[float]]:
-		emconf = self.app_config.embedding
+	@property
+	def model_id(self) -> str:
+		return os.path.basename(str(self.app_config.embedding.llama.get('model', '')))
 
+	def _log_request(self, input_: str | list[str]):
 		lengths = [len(text) for text in (input_ if isinstance(input_, list) else [input_])]
 		logger.info(
 			f'Sending embedding request for {len(lengths)} chunks of the following sizes (total: {sum(lengths)}):'
 			, extra={'lengths':lengths}
 		)
 
-		try:
-			with httpx.Client() as client:
-				response = client.post(
-					f'{emconf.protocol}://{emconf.host}:{emconf.port}/v1/embeddings',
-					json={'input': input_},
-					timeout=emconf.request_timeout,
-				)
-				if response.status_code != 200:
-					raise EmbeddingException(response.text)
-		except (
-			EmbeddingException,
-			httpx.RemoteProtocolError,
-			httpx.ReadError,
-			httpx.LocalProtocolError,
-			httpx.PoolTimeout,
-		) as e:
-			if try_ > 0:
-				logger.debug('Retrying embedding request in 5 secs', extra={'try': try_})
-				sleep(5)
-				return self._get_embedding(input_, try_ - 1)
-			raise EmbeddingException('Error: request to get embeddings failed') from e
+	def _retry_delay(self, attempt: int, deadline: float, error: Exception) -> float | None:
+		'''
+		Returns the seconds to wait before the next attempt or None if the request should not be retried.
+		'''
+		if not _is_retryable(error) or attempt >= self.app_config.embedding.max_retries:
+			return None
+
+		# exponential backoff with jitter so that the workers do not retry in lockstep
+		backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+		delay = backoff / 2 + random.uniform(0, backoff / 2)  # noqa: S311
+		if monotonic() + delay >= deadline:
+			return None
+		return delay
+
+	def _parse_response(self, input_: str | list[str], response: httpx.Response) -> list[float] | list[list[float]]:
+		if response.status_code != 200:
+			raise _EmbeddingHTTPError(response.status_code, response.text)
 
 		# converts TypedDict to a pydantic model
 		resp = CreateEmbeddingResponse(**response.json())
@@ -76,8 +311,205 @@ class NetworkEmbeddings(Embeddings, BaseModel):
 		# only one embedding in d['embedding'] since truncate is True
 		return [d['embedding'] for d in resp['data']]  # pyright: ignore[reportReturnType]
 
+	def _get_embedding(self, input_: str | list[str]) -> list[float] | list[list[float]]:
+		emconf = self.app_config.embedding
+		self._log_request(input_)
+
+		# request_timeout is the budget for all the attempts together
+		deadline = monotonic() + emconf.request_timeout
+		attempt = 0
+		pool = get_endpoint_pool(emconf)
+		while True:
+			pool.probe_due()
+			endpoint = pool.acquire()
+			start = monotonic()
+			try:
+				response = get_client(emconf).post(
+					f'{endpoint.url}/v1/embeddings',
+					json={'input': input_},
+					timeout=max(deadline - monotonic(), MIN_ATTEMPT_TIMEOUT),
+				)
+				result = self._parse_response(input_, response)
+			except (_EmbeddingHTTPError, httpx.TransportError) as e:
+				pool.release(endpoint, monotonic() - start, e)
+				delay = self._retry_delay(attempt, deadline, e)
+				if delay is None:
+					raise EmbeddingException('Error: request to get embeddings failed') from e
+				logger.debug(
+					f'Retrying embedding request in {delay:.2f} secs',
+					extra={'attempt': attempt, 'error': str(e), 'endpoint': endpoint.name},
+				)
+				sleep(delay)
+				attempt += 1
+				continue
+			except BaseException as e:
+				pool.release(endpoint, monotonic() - start, e)
+				raise
+
+			pool.release(endpoint, monotonic() - start, None)
+			return result
+
+	async def _aget_embedding(self, input_: str | list[str]) -> list[float] | list[list[float]]:
+		emconf = self.app_config.embedding
+		self._log_request(input_)
+
+		deadline = monotonic() + emconf.request_timeout
+		attempt = 0
+		pool = get_endpoint_pool(emconf)
+		while True:
+			if pool.has_due_probes():
+				await asyncio.to_thread(pool.probe_due)
+			endpoint = pool.acquire()
+			start = monotonic()
+			try:
+				response = await get_async_client(emconf).post(
+					f'{endpoint.url}/v1/embeddings',
+					json={'input': input_},
+					timeout=max(deadline - monotonic(), MIN_ATTEMPT_TIMEOUT),
+				)
+				result = self._parse_response(input_, response)
+			except (_EmbeddingHTTPError, httpx.TransportError) as e:
+				pool.release(endpoint, monotonic() - start, e)
+				delay = self._retry_delay(attempt, deadline, e)
+				if delay is None:
+					raise EmbeddingException('Error: request to get embeddings failed') from e
+				logger.debug(
+					f'Retrying embedding request in {delay:.2f} secs',
+					extra={'attempt': attempt, 'error': str(e), 'endpoint': endpoint.name},
+				)
+				await asyncio.sleep(delay)
+				attempt += 1
+				continue
+			except BaseException as e:
+				pool.release(endpoint, monotonic() - start, e)
+				raise
+
+			pool.release(endpoint, monotonic() - start, None)
+			return result
+
+	def _batch_budget(self) -> tuple[int, int]:
+		'''
+		Returns the max estimated tokens and the max number of chunks of a micro-batch
+		'''
+		emconf = self.app_config.embedding
+		if emconf.batch_max_tokens:
+			return emconf.batch_max_tokens, max(emconf.batch_max_chunks, 1)
+
+		# the embeddings of a request are decoded in batches of n_batch tokens (at most n_ctx),
+		# a larger micro-batch is rejected and bisected on every call
+		max_tokens = int(emconf.llama.get('n_batch', 0) or 0) or DEFAULT_N_BATCH
+		if n_ctx := int(emconf.llama.get('n_ctx', 0) or 0):
+			max_tokens = min(max_tokens, n_ctx)
+		return max_tokens, max(emconf.batch_max_chunks, 1)
+
+	def _make_batches(self, texts: list[str]) -> list[tuple[int, int]]:
+		'''
+		Splits the texts into consecutive micro-batches, returned as (start, end) index ranges.
+		A text larger than the token budget gets a batch of its own, the server truncates it.
+		'''
+		max_tokens, max_chunks = self._batch_budget()
+		batches = []
+		start, tokens = 0, 0
+		for i, text in enumerate(texts):
+			text_tokens = _estimate_tokens(text)
+			if i > start and (tokens + text_tokens > max_tokens or i - start >= max_chunks):
+				batches.append((start, i))
+				start, tokens = i, 0
+			tokens += text_tokens
+		if start < len(texts):
+			batches.append((start, len(texts)))
+		return batches
+
+	def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+		'''
+		Embeds one micro-batch. If the server rejects it, the batch is bisected to isolate the failing texts
+		so that the rest of it is still embedded (and cached).
+
+		Raises
+		------
+		EmbeddingException
+			If a text could not be embedded or the server is unreachable
+		'''
+		try:
+			embeddings = self._get_embedding(texts)
+		except EmbeddingException as e:
+			# only split when the server answered, splitting does not help if it is down
+			if len(texts) == 1 or not isinstance(e.__cause__, _EmbeddingHTTPError):
+				raise
+			metrics.inc('embedding.batch_splits')
+			mid = len(texts) // 2
+			logger.warning(f'Embedding batch of {len(texts)} chunks failed, retrying it in two halves', exc_info=e)
+			left = self._embed_batch(texts[:mid])
+			right = self._embed_batch(texts[mid:])
+			return left + right
+
+		metrics.inc('embedding.batches')
+		return embeddings  # pyright: ignore[reportReturnType]
+
+	def _cache_put(self, hashes: list[str], embeddings: list[list[float]]):
+		if self.cache is None:
+			return
+		try:
+			self.cache.put_many(self.model_id, dict(zip(hashes, embeddings, strict=True)))
+		except Exception as e:
+			logger.warning('Error writing to the embedding cache', exc_info=e)
+
 	def embed_documents(self, texts: list[str]) -> list[list[float]]:
-		return self._get_embedding(texts)  # pyright: ignore[reportReturnType]
+		if len(texts) == 0:
+			return []
+
+		hashes = [text_hash(text) for text in texts]
+		embeddings: dict[str, list[float]] = {}
+		if self.cache is not None:
+			try:
+				embeddings = self.cache.get_many(self.model_id, list(set(hashes)))
+			except Exception as e:
+				logger.warning('Error reading from the embedding cache, embedding all the texts', exc_info=e)
+
+		# identical texts are only embedded once
+		missing = {h: text for h, text in zip(hashes, texts, strict=True) if h not in embeddings}
+		if self.cache is not None:
+			hits = len(texts) - sum(1 for h in hashes if h in missing)
+			metrics.inc('embedding_cache.hits', hits)
+			metrics.inc('embedding_cache.misses', len(missing))
+			logger.debug('embedding cache lookup', extra={'hits': hits, 'misses': len(missing)})
+
+		missing_hashes = list(missing.keys())
+		missing_texts = list(missing.values())
+		batches = self._make_batches(missing_texts)
+
+		def embed(batch: tuple[int, int]) -> list[list[float]]:
+			batch_embeddings = self._embed_batch(missing_texts[batch[0]:batch[1]])
+			# cached as soon as the batch is done so that a retry after a failure only embeds what is left
+			self._cache_put(missing_hashes[batch[0]:batch[1]], batch_embeddings)
+			return batch_embeddings
+
+		errors = []
+		emconf = self.app_config.embedding
+		# each endpoint serves 'workers' requests at a time
+		concurrency = max(emconf.workers, 1) * len(emconf.get_endpoints())
+		workers = max(min(concurrency, len(batches)), 1)
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ccb-embed') as executor:
+			futures = {batch: executor.submit(embed, batch) for batch in batches}
+			for (start, end), future in futures.items():
+				try:
+					embeddings.update(zip(missing_hashes[start:end], future.result(), strict=True))
+				except Exception as e:
+					errors.append(e)
+
+		if len(errors) > 0:
+			raise EmbeddingException(
+				f'Error: {len(errors)} of {len(batches)} embedding batches failed'
+			) from errors[0]
+
+		return [embeddings[h] for h in hashes]
 
 	def embed_query(self, text: str) -> list[float]:
 		return self._get_embedding(text)  # pyright: ignore[reportReturnType]
+
+	async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+		# batched in threads, the cache is synchronous too
+		return await asyncio.get_running_loop().run_in_executor(None, self.embed_documents, texts)
+
+	async def aembed_query(self, text: str) -> list[float]:
+		return await self._aget_embedding(text)  # pyright: ignore[reportReturnType]
@@ -9,8 +9,20 @@ __all__ = [
 	'LoaderException',
 	'TConfig',
 	'TEmbedding',
+	'TEmbeddingEndpoint',
+	'TIngestPipeline',
+	'TIngestQueue',
+	'TQueryQueue',
 ]
 
+class TEmbeddingEndpoint(BaseModel):
+	protocol: str = 'http'
+	host: str
+	port: int
+	# started by main_em.py with the 'llama' config
+	local: bool = False
+
+
 class TEmbedding(BaseModel):
 	protocol: str
 	host: str
@@ -18,8 +30,66 @@ class TEmbedding(BaseModel):
 	workers: int
 	offload_after_mins: int
 	request_timeout: int
+	health_ttl_secs: int = 30
+	max_retries: int = 3
+	max_connections: int = 16
+	max_keepalive_connections: int = 8
+	keepalive_expiry: float = 60
+	batch_max_tokens: int = 0
+	batch_max_chunks: int = 32
+	endpoints: list[TEmbeddingEndpoint] = []
 	llama: dict
 
+	def get_endpoints(self) -> list[TEmbeddingEndpoint]:
+		'''
+		The configured endpoints, or the one local server from 'protocol', 'host' and 'port'
+		'''
+		if self.endpoints:
+			return self.endpoints
+		return [TEmbeddingEndpoint(protocol=self.protocol, host=self.host, port=self.port, local=True)]
+
+
+class TIngestPipeline(BaseModel):
+	parse_workers: int = 2
+	# per document, the decoding runs in separate processes
+	parse_timeout_secs: int = 900
+	parse_max_memory_mb: int = 4096
+	split_workers: int = 1
+	embed_workers: int = 2
+	# max number of documents written to the db in one transaction
+	write_batch_size: int = 16
+	# max number of items waiting between two stages
+	queue_size: int = 8
+	# modified documents are split at content-defined boundaries and only the changed chunks are embedded
+	incremental_reindex: bool = False
+
+
+class TIngestQueue(BaseModel):
+	# threads taking batches from the queue, each one occupies an ingest worker while it processes a batch
+	runners: int = 2
+	batch_size: int = 16
+	# a batch is given to another runner if not finished in this time, e.g. after a crash
+	lease_secs: int = 3600
+	max_attempts: int = 3
+	poll_interval_secs: int = 5
+	# finished sources are removed from the job status after this time
+	retention_hours: int = 168
+
+
+class TQueryQueue(BaseModel):
+	# max queries using the LLM at once per llm backend, the backends not listed get 1.
+	# The concurrent queries of hugging_face are generated in micro-batches.
+	max_in_flight: dict[str, int] = {'nc_texttotext': 8, 'hugging_face': 4}
+	# more waiting queries are rejected
+	max_queued: int = 64
+	queue_timeout_secs: float = 120
+	# each 1000 characters of a query count as arriving this many seconds later,
+	# short queries go first without starving the long ones (0 for first come, first served)
+	priority_secs_per_kchar: float = 10
+
+	def max_in_flight_for(self, llm_name: str) -> int:
+		return self.max_in_flight.get(llm_name, 1)
+
 
 class TConfig(BaseModel):
 	debug: bool
@@ -30,9 +100,15 @@ class TConfig(BaseModel):
 	uvicorn_workers: int
 	embedding_chunk_size: int
 	doc_parser_worker_limit: int
+	worker_pool_size: int
+	worker_max_tasks: int
+	worker_max_rss_mb: int
 
 	vectordb: tuple[str, dict]
 	embedding: TEmbedding
+	ingest_pipeline: TIngestPipeline
+	ingest_queue: TIngestQueue
+	query_queue: TQueryQueue
 	llm: tuple[str, dict]
 
 
@@ -2,6 +2,8 @@
 # SPDX-FileCopyrightText: 2023 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import hashlib
+import inspect
 import logging
 import multiprocessing as mp
 import re
@@ -99,6 +101,13 @@ def exec_in_proc(group=None, target=None, name=None, args=(), kwargs={}, *, daem
 	return result['value']
 
 
+def text_hash(text: str) -> str:
+	'''
+	Hex encoded sha256 hash of the text, same as "encode(sha256(convert_to(text, 'UTF8')), 'hex')" in postgres
+	'''
+	return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
 def is_valid_source_id(source_id: str) -> bool:
 	return re.match(r'^[a-zA-Z0-9_-]+__[a-zA-Z0-9_-]+: \d+$', source_id) is not None
 
@@ -111,6 +120,17 @@ def timed(func: Callable):
 	'''
 	Decorator to time a function
 	'''
+	if inspect.iscoroutinefunction(func):
+		@wraps(func)
+		async def async_wrapper(*args, **kwargs):
+			start = perf_counter_ns()
+			res = await func(*args, **kwargs)
+			end = perf_counter_ns()
+			_logger.debug(f'{func.__name__} took {(end - start)/1e6:.2f}ms')
+			return res
+
+		return async_wrapper
+
 	@wraps(func)
 	def wrapper(*args, **kwargs):
 		start = perf_counter_ns()
@@ -2,6 +2,7 @@
 # SPDX-FileCopyrightText: 2023 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Any
 
@@ -12,7 +13,7 @@ from langchain.schema.vectorstore import VectorStore
 
 from ..chain.types import InDocument, ScopeType
 from ..utils import timed
-from .types import UpdateAccessOp
+from .types import IngestStatus, QueuedSource, SourceManifestEntry, UpdateAccessOp
 
 
 class BaseVectorDB(ABC):
@@ -77,11 +78,51 @@ class BaseVectorDB(ABC):
 			List of source ids that were successfully added and the list of source ids that need to be retried.
 		'''
 
+	@abstractmethod
+	def embed_indocument(self, indoc: InDocument, reuse_chunks: bool = False) -> Any:
+		'''
+		Embeds the chunks of the given indocument without writing anything to the vectordb.
+
+		Args
+		----
+		indoc: InDocument
+			InDocument object to embed.
+		reuse_chunks: bool
+			If the source is already stored, the chunks with the same text as the stored ones are not
+			embedded again and write_embedded keeps their rows, the other stored chunks are replaced.
+
+		Returns
+		-------
+		Any
+			The embedded document to pass to write_embedded.
+
+		Raises
+		------
+		EmbeddingException
+		'''
+
+	@abstractmethod
+	def write_embedded(self, embedded: list[Any]) -> tuple[list[str],list[str]]:
+		'''
+		Writes the documents returned by embed_indocument to the vectordb and updates the docs + access tables.
+
+		Args
+		----
+		embedded: list[Any]
+			List of the embedded documents.
+
+		Returns
+		-------
+		tuple[list[str],list[str]]
+			List of source ids that were successfully added and the list of source ids that need to be retried.
+		'''
+
 	@timed
 	@abstractmethod
 	def check_sources(
 		self,
 		sources: list[UploadFile],
+		incremental: bool = False,
 	) -> tuple[list[str], list[str]]:
 		'''
 		Checks the sources in the vectordb if they are already embedded
@@ -93,6 +134,9 @@ class BaseVectorDB(ABC):
 		----
 		sources: list[UploadFile]
 			List of source ids to check.
+		incremental: bool
+			Keep the outdated sources, their chunks are diffed with the new ones
+			(see embed_indocument's reuse_chunks).
 
 		Returns
 		-------
@@ -176,6 +220,28 @@ class BaseVectorDB(ABC):
 		'''
 		...
 
+	@abstractmethod
+	def check_manifest(self, entries: list[SourceManifestEntry]) -> list[str]:
+		'''
+		Checks which sources of the manifest need to be uploaded for indexing.
+		The users of the sources that are already indexed and up to date are
+		allowed access to them, in addition to the existing users.
+
+		Args
+		----
+		entries: list[SourceManifestEntry]
+			The source id, modified timestamp, user ids and provider of each source.
+
+		Returns
+		-------
+		list[str]
+			Source ids of the new and the modified sources.
+
+		Raises
+		------
+		DbException
+		'''
+
 	@abstractmethod
 	def decl_update_access(
 		self,
@@ -219,6 +285,131 @@ class BaseVectorDB(ABC):
 		'''
 		...
 
+	@abstractmethod
+	def enqueue_sources(self, sources: list[QueuedSource]):
+		'''
+		Adds the persisted sources to the ingest queue to be indexed in the background.
+
+		Args
+		----
+		sources: list[QueuedSource]
+			Sources with their job id, headers and the path of the persisted file.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
+	@abstractmethod
+	def lease_queued_sources(self, limit: int, lease_secs: int) -> list[QueuedSource]:
+		'''
+		Marks up to `limit` queued sources as processing for `lease_secs` seconds and returns them.
+		Sources whose lease expired are leased again, and the rows locked by other runners are skipped.
+
+		Args
+		----
+		limit: int
+			Maximum number of sources to lease.
+		lease_secs: int
+			Seconds after which the source can be leased by another runner.
+
+		Returns
+		-------
+		list[QueuedSource]
+			The leased sources, oldest first.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
+	@abstractmethod
+	def return_queued_sources(self, ids: list[int]):
+		'''
+		Puts leased sources that were not processed back in the queue, the lease does not count as an attempt.
+
+		Args
+		----
+		ids: list[int]
+			Queue ids of the leased sources.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
+	@abstractmethod
+	def finish_queued_sources(self, statuses: dict[int, tuple[IngestStatus, str | None]]):
+		'''
+		Releases the leased sources with their new status and error message.
+
+		Args
+		----
+		statuses: dict[int, tuple[IngestStatus, str | None]]
+			Queue ids mapped to the new status and the error, if any.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
+	@abstractmethod
+	def get_job_status(self, job_id: str) -> list[dict[str, Any]]:
+		'''
+		Args
+		----
+		job_id: str
+			The id returned when the sources were queued.
+
+		Returns
+		-------
+		list[dict[str, Any]]
+			Source id, status, attempts, error and the last update timestamp of each source in the job.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
+	@abstractmethod
+	def cleanup_ingest_queue(self, retention_hours: int) -> int:
+		'''
+		Deletes the finished sources of the ingest queue that are older than `retention_hours`.
+
+		Returns
+		-------
+		int
+			Number of deleted rows.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
+	@abstractmethod
+	def ensure_index(self) -> bool:
+		'''
+		Creates the configured approximate nearest neighbour index on the embeddings
+		if it does not exist yet, and drops the stale ones.
+		The index is built online, without blocking the reads and writes, and can take a long time.
+
+		Returns
+		-------
+		bool
+			False if the index could not be built yet, e.g. no embeddings are stored to detect the dimensions.
+
+		Raises
+		------
+		DbException
+		'''
+		...
+
 	@timed
 	@abstractmethod
 	def doc_search(
@@ -251,3 +442,37 @@ class BaseVectorDB(ABC):
 		SafeDbException
 		'''
 		...
+
+	# async variants for the request handlers of the main process, the default implementations run
+	# the sync methods in a thread, vectordbs with an async client override them
+
+	async def adoc_search(
+		self,
+		user_id: str,
+		query: str,
+		k: int,
+		scope_type: ScopeType | None = None,
+		scope_list: list[str] | None = None,
+	) -> list[Document]:
+		'''
+		Async variant of doc_search
+		'''
+		return await asyncio.to_thread(self.doc_search, user_id, query, k, scope_type, scope_list)
+
+	async def aupdate_access(self, op: UpdateAccessOp, user_ids: list[str], source_id: str):
+		'''
+		Async variant of update_access
+		'''
+		await asyncio.to_thread(self.update_access, op, user_ids, source_id)
+
+	async def adecl_update_access(self, user_ids: list[str], source_id: str):
+		'''
+		Async variant of decl_update_access
+		'''
+		await asyncio.to_thread(self.decl_update_access, user_ids, source_id)
+
+	async def aupdate_access_provider(self, op: UpdateAccessOp, user_ids: list[str], provider_id: str):
+		'''
+		Async variant of update_access_provider
+		'''
+		await asyncio.to_thread(self.update_access_provider, op, user_ids, provider_id)
@@ -2,9 +2,15 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import json
 import logging
 import os
+import re
+import uuid
+from collections import deque
+from collections.abc import Callable
 from datetime import datetime
+from typing import Any, Literal, NamedTuple
 
 import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql as postgresql_dialects
@@ -14,23 +20,78 @@ from fastapi import UploadFile
 from langchain.schema import Document
 from langchain.vectorstores import VectorStore
 from langchain_core.embeddings import Embeddings
-from langchain_postgres.vectorstores import Base, PGVector
+from langchain_postgres.vectorstores import DEFAULT_DISTANCE_STRATEGY, Base, DistanceStrategy, PGVector
+from pgvector.sqlalchemy import Vector
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
+from .. import metrics
 from ..chain.types import InDocument, ScopeType
+from ..network_em import EmbeddingCache, NetworkEmbeddings
 from ..types import EmbeddingException
-from ..utils import timed
+from ..utils import text_hash, timed
 from .base import BaseVectorDB
-from .types import DbException, SafeDbException, UpdateAccessOp
+from .types import (
+	DbException,
+	IngestStatus,
+	QueuedSource,
+	SafeDbException,
+	SourceManifestEntry,
+	UpdateAccessOp,
+)
 
 load_dotenv()
 
 COLLECTION_NAME = 'ccb_store'
 DOCUMENTS_TABLE_NAME = 'docs'
 ACCESS_LIST_TABLE_NAME = 'access_list'
+EMBEDDING_CACHE_TABLE_NAME = 'embedding_cache'
+INGEST_QUEUE_TABLE_NAME = 'ingest_queue'
+# number of new cache entries after which the cache size is checked
+EMBEDDING_CACHE_EVICTION_INTERVAL = 10000
 PG_BATCH_SIZE = 50000
+INDEX_NAME_PREFIX = 'ccb_embedding_'
+# first pgvector version with the iterative_scan search parameters
+ITERATIVE_SCAN_MIN_VERSION = (0, 8)
 
 logger = logging.getLogger('ccb.vectordb')
 
+
+class EmbeddedDocument(NamedTuple):
+	indoc: InDocument
+	chunk_ids: list[uuid.UUID]
+	# None for the stored chunks that are kept
+	embeddings: list[list[float] | None]
+	# chunks of the stored version of the source that is updated in place, None for a new source
+	previous_chunk_ids: list[uuid.UUID] | None = None
+
+
+class IndexConfig(BaseModel):
+	'''Approximate nearest neighbour index on the embeddings, see https://github.com/pgvector/pgvector#indexing'''
+
+	type: Literal['hnsw', 'ivfflat', 'none'] = 'none'
+	# dimension of the embedding model's vectors, detected from the stored embeddings if not provided
+	dimensions: int | None = None
+	# hnsw build and search parameters
+	m: int = 16
+	ef_construction: int = 64
+	ef_search: int = 100
+	# ivfflat build and search parameters
+	lists: int = 100
+	probes: int = 10
+	# keep scanning the index when the filtered results are less than the limit (pgvector >= 0.8.0)
+	iterative_scan: Literal['off', 'relaxed_order', 'strict_order'] = 'relaxed_order'
+	maintenance_work_mem: str | None = None
+
+
+class EmbeddingCacheConfig(BaseModel):
+	'''Embeddings cached by the hash of the chunk text, shared by all the sources'''
+
+	enabled: bool = True
+	# least recently used entries are evicted above this size
+	max_entries: int = 1_000_000
+
+
 # we're responsible for keeping this in sync with the langchain_postgres table
 class DocumentsStore(Base):
 	"""Documents table that links to chunks."""
@@ -97,6 +158,124 @@ class AccessListStore(Base):
 			raise DbException('Error: getting all users from access list') from e
 
 
+class IngestQueueStore(Base):
+	"""Sources waiting to be indexed in the background, one row per source of a job."""
+
+	__tablename__ = INGEST_QUEUE_TABLE_NAME
+
+	id: orm.Mapped[int] = orm.mapped_column(sa.BigInteger, primary_key=True, autoincrement=True)
+	job_id: orm.Mapped[uuid.UUID] = orm.mapped_column(sa.UUID(as_uuid=True), nullable=False, index=True)
+	source_id: orm.Mapped[str] = orm.mapped_column(nullable=False, index=True)
+	# headers of the upload (title, type, modified, provider, userIds)
+	headers: orm.Mapped[dict] = orm.mapped_column(postgresql_dialects.JSONB, nullable=False)
+	# the upload stored in the persistent storage
+	file_path: orm.Mapped[str] = orm.mapped_column(nullable=False)
+	size: orm.Mapped[int | None] = orm.mapped_column(sa.BigInteger, nullable=True)
+	status: orm.Mapped[str] = orm.mapped_column(nullable=False, default=IngestStatus.queued.value)
+	attempts: orm.Mapped[int] = orm.mapped_column(nullable=False, default=0)
+	error: orm.Mapped[str | None] = orm.mapped_column(sa.Text, nullable=True)
+	leased_until: orm.Mapped[datetime | None] = orm.mapped_column(sa.DateTime, nullable=True)
+	created: orm.Mapped[datetime] = orm.mapped_column(sa.DateTime, server_default=sa.func.now(), nullable=False)
+	updated: orm.Mapped[datetime] = orm.mapped_column(sa.DateTime, server_default=sa.func.now(), nullable=False)
+
+	__table_args__ = (
+		sa.Index(
+			'ingest_queue_status_idx',
+			'status',
+			'id',
+		),
+	)
+
+
+class EmbeddingCacheStore(Base):
+	"""Embeddings cache keyed by the model and the hash of the embedded text."""
+
+	__tablename__ = EMBEDDING_CACHE_TABLE_NAME
+
+	model_id: orm.Mapped[str] = orm.mapped_column(nullable=False, primary_key=True)
+	text_hash: orm.Mapped[str] = orm.mapped_column(nullable=False, primary_key=True)
+	embedding: orm.Mapped[Any] = orm.mapped_column(Vector(), nullable=False)
+	last_used: orm.Mapped[datetime] = orm.mapped_column(
+		sa.DateTime,
+		server_default=sa.func.now(),
+		nullable=False,
+		index=True,
+	)
+
+
+class PgEmbeddingCache(EmbeddingCache):
+	def __init__(self, session_maker: Callable[[], orm.Session], max_entries: int):
+		self.session_maker = session_maker
+		self.max_entries = max_entries
+		self._new_entries = 0
+
+	def get_many(self, model_id: str, text_hashes: list[str]) -> dict[str, list[float]]:
+		hashes_param = sa.bindparam('text_hashes', text_hashes, type_=sa.ARRAY(sa.String))
+		with self.session_maker() as session:
+			result = session.execute(
+				sa.select(EmbeddingCacheStore.text_hash, EmbeddingCacheStore.embedding)
+				.filter(EmbeddingCacheStore.model_id == model_id)
+				.filter(EmbeddingCacheStore.text_hash == sa.any_(hashes_param))
+			).fetchall()
+			found = {r.text_hash: r.embedding.tolist() for r in result}
+
+			if len(found) > 0:
+				# refreshed at most once a day to not turn every lookup into a write
+				session.execute(
+					sa.update(EmbeddingCacheStore)
+					.filter(EmbeddingCacheStore.model_id == model_id)
+					.filter(EmbeddingCacheStore.text_hash == sa.any_(
+						sa.bindparam('found_hashes', list(found), type_=sa.ARRAY(sa.String))
+					))
+					.filter(EmbeddingCacheStore.last_used < sa.func.now() - sa.text("interval '1 day'"))
+					.values(last_used=sa.func.now())
+				)
+				session.commit()
+
+		return found
+
+	def put_many(self, model_id: str, embeddings: dict[str, list[float]]):
+		items = list(embeddings.items())
+		with self.session_maker() as session:
+			# 3 values per row
+			for i in range(0, len(items), PG_BATCH_SIZE // 3):
+				session.execute(
+					postgresql_dialects.insert(EmbeddingCacheStore)
+					.values([
+						{'model_id': model_id, 'text_hash': h, 'embedding': embedding}
+						for h, embedding in items[i:i + PG_BATCH_SIZE // 3]
+					])
+					.on_conflict_do_nothing(index_elements=['model_id', 'text_hash'])
+				)
+			session.commit()
+
+		self._new_entries += len(items)
+		if self._new_entries >= EMBEDDING_CACHE_EVICTION_INTERVAL:
+			self._new_entries = 0
+			self.evict()
+
+	def evict(self):
+		with self.session_maker() as session:
+			count = session.execute(sa.select(sa.func.count()).select_from(EmbeddingCacheStore)).scalar() or 0
+			excess = count - self.max_entries
+			if excess <= 0:
+				return
+
+			oldest = (
+				sa.select(EmbeddingCacheStore.model_id, EmbeddingCacheStore.text_hash)
+				.order_by(EmbeddingCacheStore.last_used.asc())
+				.limit(excess)
+			)
+			session.execute(
+				sa.delete(EmbeddingCacheStore)
+				.filter(sa.tuple_(EmbeddingCacheStore.model_id, EmbeddingCacheStore.text_hash).in_(oldest))
+			)
+			session.commit()
+
+		metrics.inc('embedding_cache.evictions', excess)
+		logger.info(f'Evicted {excess} entries from the embedding cache', extra={'max_entries': self.max_entries})
+
+
 class VectorDB(BaseVectorDB):
 	def __init__(self, embedding: Embeddings | None = None, **kwargs):
 		if not embedding:
@@ -110,9 +289,29 @@ class VectorDB(BaseVectorDB):
 		if 'connection' not in kwargs:
 			kwargs['connection'] = os.environ['CCB_DB_URL']
 
+		try:
+			self.index_config = IndexConfig(**(kwargs.pop('index', None) or {}))
+			cache_config = EmbeddingCacheConfig(**(kwargs.pop('embedding_cache', None) or {}))
+		except Exception as e:
+			raise DbException('Error: invalid index or embedding cache config for pgvector') from e
+
+		self.distance_strategy = DistanceStrategy(kwargs.get('distance_strategy', DEFAULT_DISTANCE_STRATEGY))
+		self._index_dimensions: int | None = self.index_config.dimensions
+		# whether the installed pgvector supports iterative_scan, read with the dimensions
+		self._iterative_scan_supported: bool | None = None
+
 		# setup langchain db + our access list table
 		self.client = PGVector(embedding, collection_name=COLLECTION_NAME, **kwargs)
 
+		# the async engine for the request handlers of the main process, created on first use
+		self._connection = kwargs['connection']
+		self._engine_args = kwargs.get('engine_args') or {}
+		self._async_session_maker: async_sessionmaker[AsyncSession] | None = None
+		self._collection_id: uuid.UUID | None = None
+
+		if cache_config.enabled and isinstance(embedding, NetworkEmbeddings):
+			embedding.cache = PgEmbeddingCache(self.client.session_maker, cache_config.max_entries)
+
 	def get_instance(self) -> VectorStore:
 		return self.client
 
@@ -122,6 +321,35 @@ class VectorDB(BaseVectorDB):
 		except Exception as e:
 			raise DbException('Error: creating session for vectordb') from e
 
+	def async_session_maker(self) -> AsyncSession:
+		if self._async_session_maker is None:
+			try:
+				url = (
+					sa.make_url(self._connection)
+					if isinstance(self._connection, str)
+					else self._connection.url
+				)
+				# psycopg 3 has an async mode with the same connection string
+				if url.drivername in ('postgresql', 'postgresql+psycopg2'):
+					url = url.set(drivername='postgresql+psycopg')
+				engine = create_async_engine(url, **self._engine_args)
+			except Exception as e:
+				raise DbException('Error: creating the async engine for vectordb') from e
+			self._async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+		return self._async_session_maker()
+
+	async def _acollection_id(self, session: AsyncSession) -> uuid.UUID:
+		if self._collection_id is None:
+			collection = (await session.execute(
+				sa.select(self.client.CollectionStore)
+				.filter(self.client.CollectionStore.name == self.client.collection_name)
+			)).scalars().first()
+			if not collection:
+				raise DbException('Collection not found')
+			self._collection_id = collection.uuid
+		return self._collection_id
+
 	def get_users(self) -> list[str]:
 		with self.session_maker() as session:
 			try:
@@ -129,88 +357,287 @@ class VectorDB(BaseVectorDB):
 			except Exception as e:
 				raise DbException('Error: getting a list of all users from access list') from e
 
+	def _get_stored_chunks(self, source_id: str) -> tuple[list[uuid.UUID], dict[str, deque[uuid.UUID]]] | None:
+		'''
+		Returns the chunk ids of the stored source and the ids grouped by the hash of their text,
+		or None if the source is not stored
+		'''
+		with self.session_maker() as session:
+			try:
+				chunk_ids = session.execute(
+					sa.select(DocumentsStore.chunks).filter(DocumentsStore.source_id == source_id)
+				).scalar_one_or_none()
+				if chunk_ids is None:
+					return None
+
+				collection = self.client.get_collection(session)
+				# same hash as text_hash() without fetching the texts
+				stmt = (
+					sa.select(
+						self.client.EmbeddingStore.id,
+						sa.func.encode(
+							sa.func.sha256(sa.func.convert_to(self.client.EmbeddingStore.document, 'UTF8')),
+							'hex',
+						).label('text_hash'),
+					)
+					.filter(self.client.EmbeddingStore.collection_id == collection.uuid)
+					.filter(self.client.EmbeddingStore.id.in_([str(c) for c in chunk_ids]))
+				)
+				hashes = {row.id: row.text_hash for row in session.execute(stmt)}
+			except Exception as e:
+				raise DbException('Error: getting the stored chunks of the source') from e
+
+		by_hash: dict[str, deque[uuid.UUID]] = {}
+		for chunk_id in chunk_ids:
+			if (h := hashes.get(str(chunk_id))) is not None:
+				by_hash.setdefault(h, deque()).append(chunk_id)
+		return chunk_ids, by_hash
+
+	def embed_indocument(self, indoc: InDocument, reuse_chunks: bool = False) -> EmbeddedDocument:
+		stored = self._get_stored_chunks(indoc.source_id) if reuse_chunks else None
+		previous_chunk_ids, by_hash = stored if stored is not None else (None, {})
+
+		chunk_ids = []
+		to_embed = []
+		for i, doc in enumerate(indoc.documents):
+			if (same := by_hash.get(text_hash(doc.page_content))):
+				chunk_ids.append(same.popleft())
+				continue
+			chunk_ids.append(uuid.uuid4())
+			to_embed.append(i)
+
+		new_embeddings = (
+			self.client.embeddings.embed_documents([indoc.documents[i].page_content for i in to_embed])
+			if len(to_embed) > 0
+			else []
+		)
+		if len(new_embeddings) != len(to_embed):
+			raise EmbeddingException(
+				f'Error: got {len(new_embeddings)} embeddings for {len(to_embed)} chunks of {indoc.source_id}'
+			)
+
+		embeddings: list[list[float] | None] = [None] * len(indoc.documents)
+		for i, embedding in zip(to_embed, new_embeddings, strict=True):
+			embeddings[i] = embedding
+
+		if previous_chunk_ids is not None:
+			reused = len(indoc.documents) - len(to_embed)
+			metrics.inc('ingest.reindex.reused_chunks', reused)
+			metrics.inc('ingest.reindex.embedded_chunks', len(to_embed))
+			logger.debug('diffed the chunks of the modified source', extra={
+				'source_id': indoc.source_id,
+				'reused_chunks': reused,
+				'embedded_chunks': len(to_embed),
+				'deleted_chunks': len(previous_chunk_ids) - reused,
+			})
+
+		return EmbeddedDocument(
+			indoc=indoc,
+			chunk_ids=chunk_ids,
+			embeddings=embeddings,
+			previous_chunk_ids=previous_chunk_ids,
+		)
+
+	def _update_reindexed(self, session: orm.Session, collection_id: uuid.UUID, item: EmbeddedDocument):
+		'''
+		Updates a source that was re-indexed in place: the chunks that were not kept are deleted,
+		the metadata of the kept ones is refreshed (title, start index) and the docs and access rows
+		are replaced. The new chunks are written by _copy_embedded.
+		'''
+		indoc = item.indoc
+		stored = session.execute(
+			sa.select(DocumentsStore.chunks)
+			.filter(DocumentsStore.source_id == indoc.source_id)
+			.with_for_update()
+		).scalar_one_or_none()
+		kept = [
+			(chunk_id, doc.metadata)
+			for chunk_id, doc, embedding in zip(item.chunk_ids, indoc.documents, item.embeddings, strict=True)
+			if embedding is None
+		]
+		if stored is None or not {chunk_id for chunk_id, _ in kept} <= set(stored):
+			raise DbException(f'Error: the stored chunks of {indoc.source_id} changed while it was re-indexed')
+
+		stale = [str(chunk_id) for chunk_id in set(stored) - set(item.chunk_ids)]
+		# 1 value per row
+		for i in range(0, len(stale), PG_BATCH_SIZE):
+			session.execute(
+				sa.delete(self.client.EmbeddingStore)
+				.filter(self.client.EmbeddingStore.collection_id == collection_id)
+				.filter(self.client.EmbeddingStore.id.in_(stale[i:i + PG_BATCH_SIZE]))
+			)
+
+		# 2 values per row
+		for i in range(0, len(kept), PG_BATCH_SIZE // 2):
+			metadata = sa.values(
+				sa.column('id', sa.String),
+				sa.column('cmetadata', postgresql_dialects.JSONB),
+				name='metadata',
+			).data([(str(chunk_id), meta) for chunk_id, meta in kept[i:i + PG_BATCH_SIZE // 2]])
+			session.execute(
+				sa.update(self.client.EmbeddingStore)
+				.filter(self.client.EmbeddingStore.id == metadata.c.id)
+				.values(cmetadata=metadata.c.cmetadata)
+			)
+
+		session.execute(
+			sa.update(DocumentsStore)
+			.filter(DocumentsStore.source_id == indoc.source_id)
+			.values(
+				provider=indoc.provider,
+				modified=datetime.fromtimestamp(indoc.modified),
+				chunks=item.chunk_ids,
+			)
+		)
+
+		# the access of the new version replaces the old one, as if the source was deleted and added again
+		session.execute(sa.delete(AccessListStore).filter(AccessListStore.source_id == indoc.source_id))
+		session.execute(
+			postgresql_dialects.insert(AccessListStore)
+			.values([{'uid': user_id, 'source_id': indoc.source_id} for user_id in dict.fromkeys(indoc.userIds)])
+			.on_conflict_do_nothing(index_elements=['uid', 'source_id'])
+		)
+
+	def _copy_embedded(self, session: orm.Session, embedded: list[EmbeddedDocument]):
+		'''
+		Writes the chunks, the docs rows and the access list rows of the given documents with COPY
+		in the session's transaction. The caller is responsible for the commit/rollback.
+		'''
+		collection = self.client.get_collection(session)
+		if not collection:
+			raise DbException('Collection not found')
+
+		new_sources = [item for item in embedded if item.previous_chunk_ids is None]
+		for item in embedded:
+			if item.previous_chunk_ids is not None:
+				self._update_reindexed(session, collection.uuid, item)
+
+		# psycopg's connection, in the transaction of the session
+		conn = session.connection().connection.driver_connection
+		with conn.cursor() as cursor:  # pyright: ignore[reportOptionalMemberAccess]
+			with cursor.copy(
+				f'COPY {self.client.EmbeddingStore.__tablename__}'
+				' (id, collection_id, embedding, document, cmetadata) FROM STDIN'
+			) as copy:
+				for item in embedded:
+					for chunk_id, doc, embedding in zip(
+						item.chunk_ids, item.indoc.documents, item.embeddings, strict=True,
+					):
+						if embedding is None:
+							# kept from the stored version of the source
+							continue
+						copy.write_row((
+							str(chunk_id),
+							collection.uuid,
+							'[' + ','.join(map(str, embedding)) + ']',
+							doc.page_content,
+							json.dumps(doc.metadata),
+						))
+
+			with cursor.copy(f'COPY {DOCUMENTS_TABLE_NAME} (source_id, provider, modified, chunks) FROM STDIN') as copy:
+				for item in new_sources:
+					copy.write_row((
+						item.indoc.source_id,
+						item.indoc.provider,
+						datetime.fromtimestamp(item.indoc.modified),
+						item.chunk_ids,
+					))
+
+			# after the docs rows for the foreign key
+			with cursor.copy(f'COPY {ACCESS_LIST_TABLE_NAME} (uid, source_id) FROM STDIN') as copy:
+				for item in new_sources:
+					for user_id in dict.fromkeys(item.indoc.userIds):
+						copy.write_row((user_id, item.indoc.source_id))
+
 	def add_indocuments(self, indocuments: list[InDocument]) -> tuple[list[str], list[str]]:
-		added_sources = []
+		embedded: list[EmbeddedDocument] = []
 		retry_sources = []
-		batch_size = PG_BATCH_SIZE // 5
 
-		with self.session_maker() as session:
-			for indoc in indocuments:
-				try:
-					# query paramerters limitation in postgres is 65535 (https://www.postgresql.org/docs/current/limits.html)
-					# so we chunk the documents into (5 values * 10k) chunks
-					# change the chunk size when there are more inserted values per document
-					chunk_ids = []
-					for i in range(0, len(indoc.documents), batch_size):
-						chunk_ids.extend(self.client.add_documents(indoc.documents[i:i+batch_size]))
-
-					doc = DocumentsStore(
-						source_id=indoc.source_id,
-						provider=indoc.provider,
-						modified=datetime.fromtimestamp(indoc.modified),
-						chunks=chunk_ids,
-					)
-					session.add(doc)
-					session.commit()
+		# embed everything first so the db transaction is not held open while waiting for the embedder
+		for indoc in indocuments:
+			try:
+				embedded.append(self.embed_indocument(indoc))
+			except Exception as e:
+				logger.exception('Error embedding documents', exc_info=e, extra={
+					'source_id': indoc.source_id,
+				})
+				retry_sources.append(indoc.source_id)
 
-					self.decl_update_access(indoc.userIds, indoc.source_id, session)
-					added_sources.append(indoc.source_id)
-					session.commit()
-				except SafeDbException as e:
-					# for when the source_id is not found. This here can be an error in the DB
-					# and the source should be retried later
-					logger.exception('Error adding documents to vectordb', exc_info=e, extra={
-						'source_id': indoc.source_id,
-					})
-					retry_sources.append(indoc.source_id)
-					continue
-				except EmbeddingException as e:
+		added_sources, failed_sources = self.write_embedded(embedded)
+		return added_sources, [*retry_sources, *failed_sources]
+
+	def write_embedded(self, embedded: list[EmbeddedDocument]) -> tuple[list[str], list[str]]:
+		if len(embedded) == 0:
+			return [], []
+
+		retry_sources = []
+		with self.session_maker() as session:
+			try:
+				self._copy_embedded(session, embedded)
+				session.commit()
+				return [item.indoc.source_id for item in embedded], []
+			except Exception as e:
+				session.rollback()
+				if len(embedded) == 1:
 					logger.exception('Error adding documents to vectordb', exc_info=e, extra={
-						'source_id': indoc.source_id,
+						'source_id': embedded[0].indoc.source_id,
 					})
-					retry_sources.append(indoc.source_id)
-					continue
+					return [], [embedded[0].indoc.source_id]
+				logger.warning(
+					'Error adding the batch of documents to vectordb, retrying one source at a time',
+					exc_info=e,
+				)
+
+			# isolate the failing sources, e.g. the ones that were inserted by another request in the meantime
+			added_sources = []
+			for item in embedded:
+				try:
+					self._copy_embedded(session, [item])
+					session.commit()
+					added_sources.append(item.indoc.source_id)
 				except Exception as e:
+					session.rollback()
 					logger.exception('Error adding documents to vectordb', exc_info=e, extra={
-						'source_id': indoc.source_id,
+						'source_id': item.indoc.source_id,
 					})
-					retry_sources.append(indoc.source_id)
-					continue
+					retry_sources.append(item.indoc.source_id)
 
 		return added_sources, retry_sources
 
 	@timed
-	def check_sources(self, sources: list[UploadFile]) -> tuple[list[str], list[str]]:
+	def check_sources(self, sources: list[UploadFile], incremental: bool = False) -> tuple[list[str], list[str]]:
+		if len(sources) == 0:
+			return [], []
+
 		with self.session_maker() as session:
 			try:
+				incoming = sa.values(
+					sa.column('source_id', sa.String),
+					sa.column('modified', sa.DateTime),
+					name='incoming',
+				).data([
+					(source.filename, datetime.fromtimestamp(int(source.headers['modified'])))
+					for source in sources
+				])
+
+				# existence and staleness of all the sources in one query
 				stmt = (
-					sa.select(DocumentsStore.source_id)
-					.filter(DocumentsStore.source_id.in_([source.filename for source in sources]))
-					.with_for_update()
+					sa.select(
+						DocumentsStore.source_id,
+						(DocumentsStore.modified < incoming.c.modified).label('stale'),
+					)
+					.join(incoming, incoming.c.source_id == DocumentsStore.source_id)
+					.with_for_update(of=DocumentsStore)
 				)
 
 				results = session.execute(stmt).fetchall()
 				existing_sources = {r.source_id for r in results}
+				to_delete = list({r.source_id: None for r in results if r.stale})
 				to_embed = [source.filename for source in sources if source.filename not in existing_sources]
+				to_embed.extend(to_delete)
 
-				to_delete = []
-
-				for source in sources:
-					stmt = (
-						sa.select(DocumentsStore.source_id)
-						.filter(DocumentsStore.source_id == source.filename)
-						.filter(DocumentsStore.modified < sa.cast(
-							datetime.fromtimestamp(int(source.headers['modified'])),
-							sa.DateTime,
-						))
-					)
-
-					result = session.execute(stmt).fetchone()
-					if result is not None:
-						to_embed.append(result.source_id)
-						to_delete.append(result.source_id)
-
-				if len(to_delete) > 0:
+				# the outdated sources are updated in place when they are written
+				if len(to_delete) > 0 and not incremental:
 					self.delete_source_ids(to_delete, session)
 
 			except Exception as e:
@@ -226,6 +653,61 @@ class VectorDB(BaseVectorDB):
 			# the pyright issue stems from source.filename, which has already been validated
 			return list(still_existing_sources), to_embed  # pyright: ignore[reportReturnType]
 
+	def check_manifest(self, entries: list[SourceManifestEntry]) -> list[str]:
+		if len(entries) == 0:
+			return []
+
+		# the last entry wins for duplicate source ids
+		by_source = {entry.sourceId: entry for entry in entries}
+		with self.session_maker() as session:
+			try:
+				up_to_date = set()
+				sources = list(by_source.values())
+				# 2 values per row
+				for i in range(0, len(sources), PG_BATCH_SIZE // 2):
+					incoming = sa.values(
+						sa.column('source_id', sa.String),
+						sa.column('modified', sa.DateTime),
+						name='incoming',
+					).data([
+						(entry.sourceId, datetime.fromtimestamp(entry.modified))
+						for entry in sources[i:i + PG_BATCH_SIZE // 2]
+					])
+					stmt = (
+						sa.select(DocumentsStore.source_id)
+						.join(incoming, sa.and_(
+							incoming.c.source_id == DocumentsStore.source_id,
+							DocumentsStore.modified >= incoming.c.modified,
+						))
+					)
+					up_to_date.update(session.execute(stmt).scalars())
+
+				# same as for the up to date sources in /loadSources,
+				# the users are allowed in addition to the existing ones
+				access = [
+					(uid, source_id)
+					for source_id in up_to_date
+					for uid in set(by_source[source_id].userIds)
+				]
+				for i in range(0, len(access), PG_BATCH_SIZE // 2):
+					access_values = sa.values(
+						sa.column('uid', sa.String),
+						sa.column('source_id', sa.String),
+						name='access',
+					).data(access[i:i + PG_BATCH_SIZE // 2])
+					session.execute(
+						postgresql_dialects.insert(AccessListStore)
+						.from_select(['uid', 'source_id'], sa.select(access_values.c.uid, access_values.c.source_id))
+						.on_conflict_do_nothing(index_elements=['uid', 'source_id'])
+					)
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: checking the sources manifest in vectordb') from e
+
+		# new and modified sources
+		return [source_id for source_id in by_source if source_id not in up_to_date]
+
 	def decl_update_access(self, user_ids: list[str], source_id: str, session_: orm.Session | None = None):
 		session = session_ or self.session_maker()
 
@@ -349,18 +831,157 @@ class VectorDB(BaseVectorDB):
 	):
 		with self.session_maker() as session:
 			try:
-				stmt = (
-					sa.select(DocumentsStore.source_id)
-					.filter(DocumentsStore.provider == provider_id)
-				)
-				result = session.execute(stmt).fetchall()
-				source_ids = [str(r.source_id) for r in result]
+				match op:
+					case UpdateAccessOp.allow:
+						users = sa.values(sa.column('uid', sa.String), name='users').data([(uid,) for uid in user_ids])
+						stmt = (
+							postgresql_dialects.insert(AccessListStore)
+							.from_select(
+								['uid', 'source_id'],
+								sa.select(users.c.uid, DocumentsStore.source_id)
+								.join(users, sa.true())
+								.filter(DocumentsStore.provider == provider_id),
+							)
+							.on_conflict_do_nothing(index_elements=['uid', 'source_id'])
+						)
+						session.execute(stmt)
+						session.commit()
+
+					case UpdateAccessOp.deny:
+						collection = self.client.get_collection(session)
+						stmt = (
+							sa.delete(AccessListStore)
+							.filter(AccessListStore.uid.in_(user_ids))
+							.filter(AccessListStore.source_id == DocumentsStore.source_id)
+							.filter(DocumentsStore.provider == provider_id)
+						)
+						session.execute(stmt)
+
+						# delete the documents of the provider that no user has access to anymore
+						session.execute(self._delete_docs_stmt(
+							collection.uuid,
+							DocumentsStore.provider == provider_id,
+							~sa.exists().where(AccessListStore.source_id == DocumentsStore.source_id),
+						))
+						session.commit()
+
+					case _:
+						raise SafeDbException('Error: invalid access operation', 400)
+			except SafeDbException:
+				raise
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: updating access list for provider') from e
+
+	async def _asource_exists(self, session: AsyncSession, source_id: str) -> bool:
+		result = await session.execute(
+			sa.select(DocumentsStore.source_id).filter(DocumentsStore.source_id == source_id)
+		)
+		return result.first() is not None
+
+	def _allow_access_stmt(self, user_ids: list[str], source_id: str) -> sa.Insert:
+		return (
+			postgresql_dialects.insert(AccessListStore)
+			.values([{'uid': user_id, 'source_id': source_id} for user_id in user_ids])
+			.on_conflict_do_nothing(index_elements=['uid', 'source_id'])
+		)
+
+	async def adecl_update_access(self, user_ids: list[str], source_id: str):
+		async with self.async_session_maker() as session:
+			try:
+				if not await self._asource_exists(session, source_id):
+					logger.info('Error: declaratively updating access list, source id not found', extra={
+						'source_id': source_id,
+					})
+					return
+
+				# unlike the sync variant, the old and the new access are swapped in one transaction
+				await session.execute(sa.delete(AccessListStore).filter(AccessListStore.source_id == source_id))
+				await session.execute(self._allow_access_stmt(user_ids, source_id))
+				await session.commit()
+			except Exception as e:
+				await session.rollback()
+				raise DbException('Error: declaratively updating access list') from e
+
+	async def aupdate_access(self, op: UpdateAccessOp, user_ids: list[str], source_id: str):
+		async with self.async_session_maker() as session:
+			try:
+				if not await self._asource_exists(session, source_id):
+					logger.info('Error: updating access list, source id not found', extra={
+						'source_id': source_id,
+					})
+					return
+
+				match op:
+					case UpdateAccessOp.allow:
+						await session.execute(self._allow_access_stmt(user_ids, source_id))
+
+					case UpdateAccessOp.deny:
+						await session.execute(
+							sa.delete(AccessListStore)
+							.filter(AccessListStore.uid.in_(user_ids))
+							.filter(AccessListStore.source_id == source_id)
+						)
+						# delete the source if no user has access to it anymore
+						await session.execute(self._delete_docs_stmt(
+							await self._acollection_id(session),
+							DocumentsStore.source_id == source_id,
+							~sa.exists().where(AccessListStore.source_id == DocumentsStore.source_id),
+						))
+
+					case _:
+						raise SafeDbException('Error: invalid access operation', 400)
+
+				await session.commit()
+			except SafeDbException as e:
+				await session.rollback()
+				logger.info('Error: updating access list', exc_info=e, extra={
+					'source_id': source_id,
+				})
 			except Exception as e:
-				raise DbException('Error: getting source ids for provider') from e
+				await session.rollback()
+				raise DbException('Error: updating access list') from e
+
+	async def aupdate_access_provider(self, op: UpdateAccessOp, user_ids: list[str], provider_id: str):
+		async with self.async_session_maker() as session:
+			try:
+				match op:
+					case UpdateAccessOp.allow:
+						users = sa.values(sa.column('uid', sa.String), name='users').data([(uid,) for uid in user_ids])
+						await session.execute(
+							postgresql_dialects.insert(AccessListStore)
+							.from_select(
+								['uid', 'source_id'],
+								sa.select(users.c.uid, DocumentsStore.source_id)
+								.join(users, sa.true())
+								.filter(DocumentsStore.provider == provider_id),
+							)
+							.on_conflict_do_nothing(index_elements=['uid', 'source_id'])
+						)
+
+					case UpdateAccessOp.deny:
+						await session.execute(
+							sa.delete(AccessListStore)
+							.filter(AccessListStore.uid.in_(user_ids))
+							.filter(AccessListStore.source_id == DocumentsStore.source_id)
+							.filter(DocumentsStore.provider == provider_id)
+						)
+						# delete the documents of the provider that no user has access to anymore
+						await session.execute(self._delete_docs_stmt(
+							await self._acollection_id(session),
+							DocumentsStore.provider == provider_id,
+							~sa.exists().where(AccessListStore.source_id == DocumentsStore.source_id),
+						))
+
+					case _:
+						raise SafeDbException('Error: invalid access operation', 400)
 
-			# painful process
-			for source_id in source_ids:
-				self.update_access(op, user_ids, source_id, session)
+				await session.commit()
+			except SafeDbException:
+				raise
+			except Exception as e:
+				await session.rollback()
+				raise DbException('Error: updating access list for provider') from e
 
 	def _cleanup_if_orphaned(self, source_ids: list[str], session_: orm.Session | None = None):
 		if len(source_ids) == 0:
@@ -394,42 +1015,36 @@ class VectorDB(BaseVectorDB):
 		if session_ is None:
 			session.close()
 
+	def _delete_docs_stmt(self, collection_id: Any, *filters: sa.ColumnElement[bool]) -> sa.Delete:
+		'''
+		Deletes the matching documents and their chunks in a single statement.
+		Entries from "AccessListStore" are deleted automatically due to the foreign key constraint.
+		'''
+		deleted_docs = (
+			sa.delete(DocumentsStore)
+			.filter(*filters)
+			.returning(DocumentsStore.chunks)
+			.cte('deleted_docs')
+		)
+		return (
+			sa.delete(self.client.EmbeddingStore)
+			.filter(self.client.EmbeddingStore.collection_id == collection_id)
+			.filter(self.client.EmbeddingStore.id.in_(
+				sa.select(sa.cast(sa.func.unnest(deleted_docs.c.chunks), sa.String))
+			))
+		)
+
 	def delete_source_ids(self, source_ids: list[str], session_: orm.Session | None = None):
 		session = session_ or self.session_maker()
 
 		try:
 			collection = self.client.get_collection(session)
-
-			# entry from "AccessListStore" is deleted automatically due to the foreign key constraint
-			stmt_doc = (
-				sa.delete(DocumentsStore)
-				.filter(DocumentsStore.source_id.in_(source_ids))
-				.returning(DocumentsStore.chunks)
-			)
-
-			doc_result = session.execute(stmt_doc)
-			chunks_to_delete = [str(c) for res in doc_result for c in res.chunks]
-		except Exception as e:
-			session.rollback()
-			if session_ is None:
-				session.close()
-			raise DbException('Error: deleting source ids from docs store') from e
-
-		try:
-			stmt_chunks = (
-				sa.delete(self.client.EmbeddingStore)
-				.filter(self.client.EmbeddingStore.collection_id == collection.uuid)
-				.filter(self.client.EmbeddingStore.id.in_(chunks_to_delete))
-			)
-
-			session.execute(stmt_chunks)
+			session.execute(self._delete_docs_stmt(collection.uuid, DocumentsStore.source_id.in_(source_ids)))
 			session.commit()
 		except Exception as e:
-			logger.error('Error deleting chunks, rolling back documents store deletion for source ids')
+			logger.error('Error deleting source ids, rolling back the deletion')
 			session.rollback()
-			raise DbException(
-				'Error: deleting chunks, rolling back documents store deletion for source ids'
-			) from e
+			raise DbException('Error: deleting source ids and their chunks, rolled back the deletion') from e
 		finally:
 			if session_ is None:
 				session.close()
@@ -496,6 +1111,218 @@ class VectorDB(BaseVectorDB):
 		except Exception as e:
 			raise DbException('Error: Could not count documents in database') from e
 
+	def enqueue_sources(self, sources: list[QueuedSource]):
+		if len(sources) == 0:
+			return
+
+		with self.session_maker() as session:
+			try:
+				session.execute(
+					sa.insert(IngestQueueStore),
+					[
+						{
+							'job_id': uuid.UUID(source.job_id),
+							'source_id': source.source_id,
+							'headers': source.headers,
+							'file_path': source.file_path,
+							'size': source.size,
+							'status': IngestStatus.queued.value,
+						}
+						for source in sources
+					],
+				)
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: adding sources to the ingest queue') from e
+
+	def lease_queued_sources(self, limit: int, lease_secs: int) -> list[QueuedSource]:
+		with self.session_maker() as session:
+			try:
+				other = orm.aliased(IngestQueueStore)
+				leasable = (
+					sa.select(IngestQueueStore.id)
+					.filter(sa.or_(
+						IngestQueueStore.status == IngestStatus.queued.value,
+						# the runner that had the lease did not finish in time
+						sa.and_(
+							IngestQueueStore.status == IngestStatus.processing.value,
+							IngestQueueStore.leased_until < sa.func.now(),
+						),
+					))
+					# a source is not indexed by two runners at once
+					.filter(~sa.exists().where(
+						other.source_id == IngestQueueStore.source_id,
+						other.status == IngestStatus.processing.value,
+						other.leased_until >= sa.func.now(),
+					))
+					.order_by(IngestQueueStore.id)
+					.limit(limit)
+					.with_for_update(skip_locked=True)
+				)
+				stmt = (
+					sa.update(IngestQueueStore)
+					.filter(IngestQueueStore.id.in_(leasable.scalar_subquery()))
+					.values(
+						status=IngestStatus.processing.value,
+						attempts=IngestQueueStore.attempts + 1,
+						leased_until=sa.func.now() + sa.func.make_interval(0, 0, 0, 0, 0, 0, lease_secs),
+						updated=sa.func.now(),
+					)
+					.returning(
+						IngestQueueStore.id,
+						IngestQueueStore.job_id,
+						IngestQueueStore.source_id,
+						IngestQueueStore.headers,
+						IngestQueueStore.file_path,
+						IngestQueueStore.size,
+						IngestQueueStore.attempts,
+					)
+				)
+				rows = session.execute(stmt).fetchall()
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: leasing sources from the ingest queue') from e
+
+		return [
+			QueuedSource(
+				id=row.id,
+				job_id=str(row.job_id),
+				source_id=row.source_id,
+				headers=row.headers,
+				file_path=row.file_path,
+				size=row.size,
+				attempts=row.attempts,
+			)
+			for row in sorted(rows, key=lambda r: r.id)
+		]
+
+	def return_queued_sources(self, ids: list[int]):
+		if len(ids) == 0:
+			return
+
+		with self.session_maker() as session:
+			try:
+				session.execute(
+					sa.update(IngestQueueStore)
+					.filter(
+						IngestQueueStore.id.in_(ids),
+						IngestQueueStore.status == IngestStatus.processing.value,
+					)
+					.values(
+						status=IngestStatus.queued.value,
+						attempts=IngestQueueStore.attempts - 1,
+						leased_until=None,
+						updated=sa.func.now(),
+					)
+				)
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: returning sources to the ingest queue') from e
+
+	def finish_queued_sources(self, statuses: dict[int, tuple[IngestStatus, str | None]]):
+		if len(statuses) == 0:
+			return
+
+		with self.session_maker() as session:
+			try:
+				results = sa.values(
+					sa.column('id', sa.BigInteger),
+					sa.column('status', sa.String),
+					sa.column('error', sa.Text),
+					name='results',
+				).data([(id_, status.value, error) for id_, (status, error) in statuses.items()])
+				session.execute(
+					sa.update(IngestQueueStore)
+					.filter(IngestQueueStore.id == results.c.id)
+					.values(
+						status=results.c.status,
+						error=results.c.error,
+						leased_until=None,
+						updated=sa.func.now(),
+					)
+				)
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: updating sources in the ingest queue') from e
+
+	def get_job_status(self, job_id: str) -> list[dict[str, Any]]:
+		with self.session_maker() as session:
+			try:
+				stmt = (
+					sa.select(
+						IngestQueueStore.source_id,
+						IngestQueueStore.status,
+						IngestQueueStore.attempts,
+						IngestQueueStore.error,
+						IngestQueueStore.updated,
+					)
+					.filter(IngestQueueStore.job_id == uuid.UUID(job_id))
+					.order_by(IngestQueueStore.id)
+				)
+				rows = session.execute(stmt).fetchall()
+			except Exception as e:
+				raise DbException('Error: getting the ingest job status') from e
+
+		return [
+			{
+				'source_id': row.source_id,
+				'status': row.status,
+				'attempts': row.attempts,
+				'error': row.error,
+				'updated': int(row.updated.timestamp()),
+			}
+			for row in rows
+		]
+
+	def cleanup_ingest_queue(self, retention_hours: int) -> int:
+		retention = sa.func.make_interval(0, 0, 0, 0, retention_hours)
+		with self.session_maker() as session:
+			try:
+				stmt = (
+					sa.delete(IngestQueueStore)
+					.filter(IngestQueueStore.status.in_([
+						IngestStatus.indexed.value,
+						IngestStatus.skipped.value,
+						IngestStatus.failed.value,
+					]))
+					.filter(IngestQueueStore.updated < sa.func.now() - retention)
+				)
+				count = session.execute(stmt).rowcount
+				session.commit()
+			except Exception as e:
+				session.rollback()
+				raise DbException('Error: cleaning up the ingest queue') from e
+
+		return count
+
+	def _accessible_chunks_stmt(
+		self,
+		user_id: str,
+		scope_type: ScopeType | None,
+		scope_list: list[str] | None,
+	) -> sa.Select:
+		if scope_type is not None and scope_list is None:
+			raise SafeDbException('Error: scope_list is required when scope_type is provided', 400)
+
+		doc_filters = [AccessListStore.uid == user_id]
+		match scope_type:
+			case ScopeType.PROVIDER:
+				doc_filters.append(DocumentsStore.provider.in_(scope_list))  # pyright: ignore[reportArgumentType]
+			case ScopeType.SOURCE:
+				doc_filters.append(DocumentsStore.source_id.in_(scope_list))  # pyright: ignore[reportArgumentType]
+
+		# chunks associated with the user, resolved inside the db in the same query as the distance search
+		# so the number of chunks a user has access to does not matter for the data transferred
+		return (
+			sa.select(sa.cast(sa.func.unnest(DocumentsStore.chunks), sa.String))
+			.join(AccessListStore, AccessListStore.source_id == DocumentsStore.source_id)
+			.filter(*doc_filters)
+		)
+
 	@timed
 	def doc_search(
 		self,
@@ -505,38 +1332,76 @@ class VectorDB(BaseVectorDB):
 		scope_type: ScopeType | None = None,
 		scope_list: list[str] | None = None,
 	) -> list[Document]:
-		if scope_type is not None and scope_list is None:
-			raise SafeDbException('Error: scope_list is required when scope_type is provided', 400)
+		chunk_ids = self._accessible_chunks_stmt(user_id, scope_type, scope_list)
 
 		try:
 			with self.session_maker() as session:
-				doc_filters = [AccessListStore.uid == user_id]
-				match scope_type:
-					case ScopeType.PROVIDER:
-						doc_filters.append(DocumentsStore.provider.in_(scope_list))  # pyright: ignore[reportArgumentType]
-					case ScopeType.SOURCE:
-						doc_filters.append(DocumentsStore.source_id.in_(scope_list))  # pyright: ignore[reportArgumentType]
-
-				# get chunks associated with the user
-				stmt = (
-					sa.select(DocumentsStore.chunks)
-					.join(AccessListStore, AccessListStore.source_id==DocumentsStore.source_id)
-					.filter(*doc_filters)
-				)
-				result = session.execute(stmt).fetchall()
-				chunk_ids = [str(c) for res in result for c in res.chunks]
-
 				# get embeddings
 				return self._similarity_search(session, query, chunk_ids, k)
 		except Exception as e:
 			raise DbException('Error: performing doc search in vectordb') from e
 
+	@timed
+	async def adoc_search(
+		self,
+		user_id: str,
+		query: str,
+		k: int,
+		scope_type: ScopeType | None = None,
+		scope_list: list[str] | None = None,
+	) -> list[Document]:
+		chunk_ids = self._accessible_chunks_stmt(user_id, scope_type, scope_list)
+
+		try:
+			embedding = await self.client.embeddings.aembed_query(query)
+			async with self.async_session_maker() as session:
+				collection_id = await self._acollection_id(session)
+				if self.index_config.type != 'none' and self._index_dimensions is None:
+					self._index_dimensions = (await session.execute(self._index_dims_stmt())).scalar()
+				if self.index_config.type != 'none' and self._iterative_scan_supported is None:
+					self._check_vector_version((await session.execute(self._vector_version_stmt())).scalar())
+				for stmt in self._search_params_stmts():
+					await session.execute(stmt)
+				results = (await session.execute(
+					self._similarity_stmt(collection_id, embedding, chunk_ids, k)
+				)).all()
+		except Exception as e:
+			raise DbException('Error: performing doc search in vectordb') from e
+
+		return self._to_documents(results)
+
+	def _similarity_stmt(self, collection_id: Any, embedding: list[float], chunk_ids: sa.Select, k: int) -> sa.Select:
+		return (
+			sa.select(
+				self.client.EmbeddingStore,
+				self._distance(embedding).label('distance'),
+			)
+			.filter(
+				self.client.EmbeddingStore.collection_id == collection_id,
+				self.client.EmbeddingStore.id.in_(chunk_ids),
+			)
+			.order_by(sa.asc('distance'))
+			.limit(k)
+		)
+
+	def _to_documents(self, results: Any) -> list[Document]:
+		# iterative index scans with relaxed ordering can return slightly out of order results
+		results = sorted(results, key=lambda r: r.distance)
+
+		return [
+			Document(
+				id=str(result.EmbeddingStore.id),
+				page_content=result.EmbeddingStore.document,
+				metadata=result.EmbeddingStore.cmetadata,
+			) for result in results
+		]
+
 	# modified from langchain_postgres.vectorstores
 	def _similarity_search(
 		self,
 		session: orm.Session,
 		query: str,
-		chunk_ids: list[str],
+		chunk_ids: sa.Select,
 		k: int = 20,
 	) -> list[Document]:
 		embedding = self.client.embeddings.embed_query(query)
@@ -544,43 +1409,163 @@ class VectorDB(BaseVectorDB):
 		if not collection:
 			raise DbException('Collection not found')
 
-		# Initialize results list to store all potential matches
-		all_results = []
-		# Process chunk_ids in batches to prevent db errors
-		# query paramerters limitation in postgres is 65535 (https://www.postgresql.org/docs/current/limits.html)
-		for i in range(0, len(chunk_ids), PG_BATCH_SIZE):
-			batch_chunk_ids = chunk_ids[i:i+PG_BATCH_SIZE]
+		self._set_search_params(session)
+		results = session.execute(self._similarity_stmt(collection.uuid, embedding, chunk_ids, k)).all()
+		return self._to_documents(results)
+
+	# -- vector index -- #
+
+	def _index_ops(self) -> str:
+		return {
+			DistanceStrategy.EUCLIDEAN: 'vector_l2_ops',
+			DistanceStrategy.MAX_INNER_PRODUCT: 'vector_ip_ops',
+		}.get(self.distance_strategy, 'vector_cosine_ops')
+
+	def _index_name(self, dims: int) -> str:
+		# the build parameters are part of the name so that a config change leads to a rebuild
+		conf = self.index_config
+		params = f'm{int(conf.m)}_efc{int(conf.ef_construction)}' if conf.type == 'hnsw' else f'lists{int(conf.lists)}'
+		distance = self._index_ops().removeprefix('vector_').removesuffix('_ops')
+		return f'{INDEX_NAME_PREFIX}{conf.type}_{distance}_{params}_d{int(dims)}_idx'
+
+	def _index_dims_stmt(self) -> sa.Select:
+		return sa.select(sa.func.vector_dims(self.client.EmbeddingStore.embedding)).limit(1)
+
+	def _index_dims(self, session: orm.Session) -> int | None:
+		if self._index_dimensions is None:
+			self._index_dimensions = session.execute(self._index_dims_stmt()).scalar()
+		if self._iterative_scan_supported is None:
+			self._check_vector_version(session.execute(self._vector_version_stmt()).scalar())
+		return self._index_dimensions
+
+	def _vector_version_stmt(self) -> sa.TextClause:
+		return sa.text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+
+	def _check_vector_version(self, version: str | None):
+		parsed = tuple(int(part) for part in re.findall(r'\d+', version or ''))
+		self._iterative_scan_supported = parsed >= ITERATIVE_SCAN_MIN_VERSION
+		if not self._iterative_scan_supported and self.index_config.iterative_scan != 'off':
+			# older versions reject the unknown hnsw.* and ivfflat.* parameters
+			logger.warning(
+				f'pgvector {version} does not support iterative_scan (requires >= 0.8.0), searching without it',
+			)
 
-			filter_by = [
-				self.client.EmbeddingStore.collection_id == collection.uuid,
-				self.client.EmbeddingStore.id.in_(batch_chunk_ids),
-			]
+	def _indexed_embedding(self, dims: int) -> sa.ColumnElement:
+		# the langchain column is created without dimensions which are required for an index,
+		# so the index is built on the casted expression and the queries use the same expression
+		return sa.cast(self.client.EmbeddingStore.embedding, Vector(dims))
+
+	def _distance(self, embedding: list[float]) -> sa.ColumnElement:
+		if self.index_config.type == 'none' or self._index_dimensions is None:
+			return self.client.distance_strategy(embedding)
+
+		indexed = self._indexed_embedding(self._index_dimensions)
+		match self.distance_strategy:
+			case DistanceStrategy.EUCLIDEAN:
+				return indexed.l2_distance(embedding)
+			case DistanceStrategy.MAX_INNER_PRODUCT:
+				return indexed.max_inner_product(embedding)
+			case _:
+				return indexed.cosine_distance(embedding)
+
+	def _search_params_stmts(self) -> list[sa.Select]:
+		conf = self.index_config
+		if conf.type == 'none':
+			return []
+
+		params = {
+			'hnsw': {'hnsw.ef_search': conf.ef_search},
+			'ivfflat': {'ivfflat.probes': conf.probes},
+		}[conf.type]
+		if conf.iterative_scan != 'off' and self._iterative_scan_supported:
+			params[f'{conf.type}.iterative_scan'] = conf.iterative_scan
+
+		# local to the current transaction
+		return [sa.select(sa.func.set_config(name, str(value), True)) for name, value in params.items()]
+
+	def _set_search_params(self, session: orm.Session):
+		if self.index_config.type == 'none':
+			return
 
-			batch_results = (
-				session.query(
-					self.client.EmbeddingStore,
-					self.client.distance_strategy(embedding).label('distance'),
-				)
-				.filter(*filter_by)
-				.join(
-					self.client.CollectionStore,
-					self.client.EmbeddingStore.collection_id == self.client.CollectionStore.uuid,
-				)
-				.order_by(sa.asc('distance'))
-				.limit(k)  # Get up to k results from the batch
-			)
+		# the dimensions are needed to build the same expression as the index
+		self._index_dims(session)
 
-			all_results.extend(batch_results)
+		for stmt in self._search_params_stmts():
+			session.execute(stmt)
 
-		# Sort all collected results by distance and take top k
-		if len(chunk_ids) > PG_BATCH_SIZE:
-			all_results.sort(key=lambda x: x.distance)
-		top_k_results = all_results[:k]
+	def ensure_index(self) -> bool:
+		conf = self.index_config
+		table = self.client.EmbeddingStore.__tablename__
+		ops = self._index_ops()
 
-		return [
-			Document(
-				id=str(result.EmbeddingStore.id),
-				page_content=result.EmbeddingStore.document,
-				metadata=result.EmbeddingStore.cmetadata,
-			) for result in top_k_results
-		]
+		try:
+			with self.session_maker() as session:
+				existing = {
+					r.relname: r.indisvalid
+					for r in session.execute(
+						sa.text(
+							'SELECT c.relname, i.indisvalid FROM pg_index i'
+							' JOIN pg_class c ON c.oid = i.indexrelid'
+							' WHERE i.indrelid = CAST(:table AS regclass) AND c.relname LIKE :prefix'
+						),
+						{'table': table, 'prefix': f'{INDEX_NAME_PREFIX}%'},
+					)
+				}
+				dims = self._index_dims(session) if conf.type != 'none' else None
+				has_rows = session.execute(sa.select(self.client.EmbeddingStore.id).limit(1)).first() is not None
+				engine = session.get_bind()
+		except Exception as e:
+			raise DbException('Error: reading the existing vector indexes') from e
+
+		if conf.type != 'none' and dims is None:
+			logger.info('No embeddings stored yet to detect the vector dimensions, skipping the index build')
+			return False
+
+		wanted = self._index_name(dims) if conf.type != 'none' else None  # pyright: ignore[reportArgumentType]
+		# drop the indexes of other types or build parameters and the ones left invalid by a failed concurrent build
+		to_drop = [name for name, valid in existing.items() if name != wanted or not valid]
+		to_build = wanted is not None and (wanted not in existing or not existing[wanted])
+
+		if to_build and conf.type == 'ivfflat' and not has_rows:
+			# ivfflat lists are computed from the existing data
+			logger.info('No embeddings stored yet, skipping the ivfflat index build')
+			return False
+
+		if not to_drop and not to_build:
+			logger.debug('Vector index is up to date', extra={'index': wanted})
+			return True
+
+		try:
+			# concurrent index operations cannot run inside a transaction
+			with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+				for name in to_drop:
+					logger.info(f'Dropping vector index {name}')
+					conn.execute(sa.text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+
+				if not to_build:
+					return True
+
+				if conf.maintenance_work_mem:
+					conn.execute(sa.select(
+						sa.func.set_config('maintenance_work_mem', conf.maintenance_work_mem, False)
+					))
+
+				with_params = (
+					f'm = {int(conf.m)}, ef_construction = {int(conf.ef_construction)}'
+					if conf.type == 'hnsw'
+					else f'lists = {int(conf.lists)}'
+				)
+				logger.info(f'Building vector index {wanted}, this can take a while', extra={
+					'dimensions': dims,
+					'params': with_params,
+				})
+				conn.execute(sa.text(
+					f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {wanted} ON {table}'
+					f' USING {conf.type} ((CAST(embedding AS vector({int(dims)}))) {ops})'  # pyright: ignore[reportArgumentType]
+					f' WITH ({with_params})'
+				))
+				logger.info(f'Vector index {wanted} built')
+		except Exception as e:
+			raise DbException('Error: building the vector index') from e
+
+		return True
@@ -6,7 +6,7 @@ import logging
 
 from ..dyn_loader import VectorDBLoader
 from .base import BaseVectorDB
-from .types import DbException, UpdateAccessOp
+from .types import DbException, QueuedSource, SourceManifestEntry, UpdateAccessOp
 
 logger = logging.getLogger('ccb.vectordb')
 
@@ -32,6 +32,12 @@ def delete_user(vectordb_loader: VectorDBLoader, user_id: str):
 	db.delete_user(user_id)
 
 
+def check_manifest(vectordb_loader: VectorDBLoader, entries: list[SourceManifestEntry]) -> list[str]:
+	db: BaseVectorDB = vectordb_loader.load()
+	logger.debug('checking sources manifest', extra={ 'len(entries)': len(entries) })
+	return db.check_manifest(entries)
+
+
 def update_access(
 	vectordb_loader: VectorDBLoader,
 	op: UpdateAccessOp,
@@ -67,3 +73,53 @@ def count_documents_by_provider(vectordb_loader: VectorDBLoader):
 	db: BaseVectorDB = vectordb_loader.load()
 	logger.debug('counting documents by provider')
 	return db.count_documents_by_provider()
+
+
+def ensure_index(vectordb_loader: VectorDBLoader) -> bool:
+	db: BaseVectorDB = vectordb_loader.load()
+	logger.debug('ensuring the vector index')
+	return db.ensure_index()
+
+
+def enqueue_sources(vectordb_loader: VectorDBLoader, sources: list[QueuedSource]):
+	db: BaseVectorDB = vectordb_loader.load()
+	logger.debug('queueing sources', extra={ 'source_ids': [s.source_id for s in sources] })
+	db.enqueue_sources(sources)
+
+
+def get_job_status(vectordb_loader: VectorDBLoader, job_id: str):
+	db: BaseVectorDB = vectordb_loader.load()
+	logger.debug('getting the ingest job status', extra={ 'job_id': job_id })
+	return db.get_job_status(job_id)
+
+
+async def aupdate_access(
+	vectordb_loader: VectorDBLoader,
+	op: UpdateAccessOp,
+	user_ids: list[str],
+	source_id: str,
+):
+	db: BaseVectorDB = await vectordb_loader.aload()
+	logger.debug('updating access', extra={ 'op': op, 'user_ids': user_ids, 'source_id': source_id })
+	await db.aupdate_access(op, user_ids, source_id)
+
+
+async def aupdate_access_provider(
+	vectordb_loader: VectorDBLoader,
+	op: UpdateAccessOp,
+	user_ids: list[str],
+	provider_id: str,
+):
+	db: BaseVectorDB = await vectordb_loader.aload()
+	logger.debug('updating access by provider', extra={ 'op': op, 'user_ids': user_ids, 'provider_id': provider_id })
+	await db.aupdate_access_provider(op, user_ids, provider_id)
+
+
+async def adecl_update_access(
+	vectordb_loader: VectorDBLoader,
+	user_ids: list[str],
+	source_id: str,
+):
+	db: BaseVectorDB = await vectordb_loader.aload()
+	logger.debug('decl update access', extra={ 'user_ids': user_ids, 'source_id': source_id })
+	await db.adecl_update_access(user_ids, source_id)
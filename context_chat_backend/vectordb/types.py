@@ -4,6 +4,8 @@
 #
 from enum import Enum
 
+from pydantic import BaseModel
+
 
 class DbException(Exception):
 	...
@@ -16,3 +18,30 @@ class SafeDbException(Exception):
 class UpdateAccessOp(Enum):
 	allow = 'allow'
 	deny = 'deny'
+
+
+class SourceManifestEntry(BaseModel):
+	sourceId: str
+	# unix timestamp
+	modified: int
+	userIds: list[str]
+	provider: str
+
+
+class IngestStatus(Enum):
+	queued = 'queued'
+	processing = 'processing'
+	indexed = 'indexed'
+	# empty, unsupported or superseded by a newer upload
+	skipped = 'skipped'
+	failed = 'failed'
+
+
+class QueuedSource(BaseModel):
+	id: int | None = None
+	job_id: str
+	source_id: str
+	headers: dict[str, str]
+	file_path: str
+	size: int | None = None
+	attempts: int = 0
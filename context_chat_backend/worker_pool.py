@@ -0,0 +1,309 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import multiprocessing as mp
+import os
+import threading
+import traceback
+from collections.abc import Callable
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import DupFd, ForkingPickler
+from time import monotonic
+from typing import Any
+
+import psutil
+from fastapi import UploadFile
+from starlette.datastructures import Headers
+from starlette.datastructures import UploadFile as StarletteUploadFile
+
+from . import metrics
+
+__all__ = ['WorkerPool', 'WorkerPoolBusyException', 'WorkerPoolException']
+
+logger = logging.getLogger('ccb.worker_pool')
+
+
+class WorkerPoolException(Exception):
+	...
+
+
+class WorkerPoolBusyException(WorkerPoolException):
+	'''
+	No worker became free in the given wait time
+	'''
+
+
+# UploadFile objects are backed by a SpooledTemporaryFile which cannot be pickled.
+# The file descriptor is shared with the worker instead of copying the file contents.
+def _rebuild_upload_file(dup_fd: Any, filename: str | None, size: int | None, raw_headers: list) -> UploadFile:
+	file = os.fdopen(dup_fd.detach(), 'rb')
+	file.seek(0)
+	return UploadFile(file=file, size=size, filename=filename, headers=Headers(raw=raw_headers))
+
+
+def _reduce_upload_file(upload: StarletteUploadFile):
+	# fileno() rolls the spooled file over to disk if it is still in memory
+	fd = upload.file.fileno()
+	return _rebuild_upload_file, (DupFd(fd), upload.filename, upload.size, upload.headers.raw)
+
+
+# the form parser creates starlette's UploadFile, fastapi's class is a subclass of it
+ForkingPickler.register(StarletteUploadFile, _reduce_upload_file)
+ForkingPickler.register(UploadFile, _reduce_upload_file)
+
+
+def _worker_main(conn: Connection, max_tasks: int, max_rss_mb: int, initializer: Callable | None, initargs: tuple):
+	# the forked worker starts with a copy of the parent's counters, only its own are sent back
+	metrics.drain()
+
+	if initializer is not None:
+		initializer(*initargs)
+
+	proc = psutil.Process()
+	tasks_done = 0
+
+	while True:
+		try:
+			task = conn.recv()
+		except (EOFError, OSError):
+			# the parent process went away
+			break
+
+		if task is None:
+			break
+
+		fun, args, kwargs = task
+		try:
+			result = { 'value': fun(*args, **kwargs), 'error': None }
+		except Exception as e:
+			result = { 'value': None, 'error': e, 'traceback': traceback.format_exc() }
+
+		tasks_done += 1
+		result['metrics'] = metrics.drain()
+		rss_mb = proc.memory_info().rss / (1024 * 1024)
+		result['recycle'] = (
+			(max_tasks > 0 and tasks_done >= max_tasks)
+			or (max_rss_mb > 0 and rss_mb >= max_rss_mb)
+		)
+
+		try:
+			conn.send(result)
+		except Exception as e:
+			# the result or the exception could not be pickled
+			conn.send({
+				'value': None,
+				'error': WorkerPoolException(f'Error: could not send the result of {fun.__name__}: {e}'),
+				'traceback': traceback.format_exc(),
+				'recycle': result['recycle'],
+				'metrics': result['metrics'],
+			})
+
+		if result['recycle']:
+			logger.debug('recycling worker process', extra={
+				'pid': os.getpid(),
+				'tasks_done': tasks_done,
+				'rss_mb': round(rss_mb, 2),
+			})
+			break
+
+	conn.close()
+
+
+class _Worker:
+	def __init__(
+		self,
+		name: str,
+		max_tasks: int,
+		max_rss_mb: int,
+		initializer: Callable | None,
+		initargs: tuple,
+		daemon: bool,
+	):
+		self.conn, child_conn = mp.Pipe()
+		self.process = mp.Process(
+			target=_worker_main,
+			name=name,
+			args=(child_conn, max_tasks, max_rss_mb, initializer, initargs),
+			daemon=daemon,
+		)
+		self.process.start()
+		child_conn.close()
+
+	def run(self, target: Callable, args: tuple, kwargs: dict, timeout: float | None) -> dict:
+		self.conn.send((target, args, kwargs))
+
+		if timeout is not None and not self.conn.poll(timeout):
+			self.kill()
+			raise WorkerPoolException(f'Error: {target.__name__} did not complete in {timeout} seconds')
+
+		try:
+			return self.conn.recv()
+		except (EOFError, OSError) as e:
+			self.kill()
+			raise WorkerPoolException(
+				f'Error: worker process exited unexpectedly while running {target.__name__}'
+				f' (exit code: {self.process.exitcode})'
+			) from e
+
+	def is_alive(self) -> bool:
+		return self.process.is_alive()
+
+	def stop(self):
+		try:
+			self.conn.send(None)
+		except Exception:
+			...
+		self.conn.close()
+		self.process.join(5)
+		if self.process.is_alive():
+			self.kill()
+
+	def kill(self):
+		self.conn.close()
+		self.process.kill()
+		self.process.join()
+
+
+class WorkerPool:
+	'''
+	A pool of long-lived worker processes.
+	The workers keep their state (db connections, http clients, loaded modules) between tasks
+	and are replaced after "max_tasks" tasks or when their memory usage exceeds "max_rss_mb".
+	Workers are started on demand, up to "size" at a time.
+	They are not daemon processes by default so that the tasks are free to start their own child processes,
+	daemon workers are terminated with the process that owns the pool.
+	'''
+
+	def __init__(
+		self,
+		name: str,
+		size: int,
+		max_tasks: int = 0,
+		max_rss_mb: int = 0,
+		initializer: Callable | None = None,
+		initargs: tuple = (),
+		daemon: bool = False,
+	):
+		if size < 1:
+			raise ValueError(f'Error: worker pool "{name}" should have at least one worker')
+
+		self.name = name
+		self.size = size
+		self.max_tasks = max_tasks
+		self.max_rss_mb = max_rss_mb
+		self.initializer = initializer
+		self.initargs = initargs
+		self.daemon = daemon
+
+		self._idle: list[_Worker] = []
+		self._count = 0
+		self._closed = False
+		self._cond = threading.Condition()
+
+	def _acquire(self, wait_timeout: float | None = None) -> _Worker:
+		deadline = monotonic() + wait_timeout if wait_timeout is not None else None
+		with self._cond:
+			while not self._idle and self._count >= self.size and not self._closed:
+				if deadline is None:
+					self._cond.wait()
+					continue
+				if (remaining := deadline - monotonic()) <= 0:
+					raise WorkerPoolBusyException(
+						f'Error: no worker of the pool "{self.name}" became free in {wait_timeout} seconds',
+					)
+				self._cond.wait(remaining)
+
+			if self._closed:
+				raise WorkerPoolException(f'Error: worker pool "{self.name}" is shut down')
+
+			while self._idle:
+				worker = self._idle.pop()
+				if worker.is_alive():
+					return worker
+				self._count -= 1
+
+			self._count += 1
+
+		try:
+			return _Worker(
+				f'{self.name}-{self._count}',
+				self.max_tasks,
+				self.max_rss_mb,
+				self.initializer,
+				self.initargs,
+				self.daemon,
+			)
+		except Exception:
+			with self._cond:
+				self._count -= 1
+				self._cond.notify()
+			raise
+
+	def _release(self, worker: _Worker, retire: bool):
+		if retire:
+			worker.stop()
+
+		with self._cond:
+			if retire or self._closed:
+				self._count -= 1
+			else:
+				self._idle.append(worker)
+			self._cond.notify()
+
+		if self._closed and not retire:
+			worker.stop()
+
+	def submit(
+		self,
+		target: Callable,
+		args: tuple = (),
+		kwargs: dict | None = None,
+		timeout: float | None = None,
+		wait_timeout: float | None = None,
+	) -> Any:
+		'''
+		Runs the target in one of the workers and blocks until the result is available.
+		The arguments and the result should be picklable.
+		All the workers may be busy, "wait_timeout" limits the wait for a free one.
+
+		Raises
+		------
+		WorkerPoolBusyException
+			If no worker became free in "wait_timeout" seconds
+		WorkerPoolException
+			If the worker died or timed out while running the task
+		Exception
+			Any exception raised by the target
+		'''
+		worker = self._acquire(wait_timeout)
+		try:
+			result = worker.run(target, args, kwargs or {}, timeout)
+		except WorkerPoolException:
+			self._release(worker, retire=True)
+			raise
+		except BaseException:
+			# the task state is unknown, do not reuse the worker
+			worker.kill()
+			self._release(worker, retire=True)
+			raise
+
+		self._release(worker, retire=result['recycle'])
+		metrics.merge(result.get('metrics', {}))
+
+		if result['error'] is not None:
+			logger.error('original traceback: %s', result['traceback'])
+			raise result['error']
+
+		return result['value']
+
+	def shutdown(self):
+		with self._cond:
+			self._closed = True
+			idle, self._idle = self._idle, []
+			self._count -= len(idle)
+			self._cond.notify_all()
+
+		for worker in idle:
+			worker.stop()
@@ -25,15 +25,19 @@ def _setup_log_levels(debug: bool):
 
 	LOGGERS = (
 		'ccb',
+		'ccb.admission',
 		'ccb.chain',
 		'ccb.doc_loader',
 		'ccb.injest',
+		'ccb.job_queue',
+		'ccb.ingest_pipeline',
 		'ccb.models',
 		'ccb.vectordb',
 		'ccb.controller',
 		'ccb.dyn_loader',
 		'ccb.ocs_utils',
 		'ccb.utils',
+		'ccb.worker_pool',
 	)
 
 	for name in LOGGERS:
@@ -3,23 +3,168 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+import gc
 import logging
+import multiprocessing as mp
 import os
-from time import sleep
+import threading
+from time import monotonic, sleep
 
 import httpx
 import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
+from context_chat_backend import metrics  # isort: skip
 from context_chat_backend.config_parser import get_config  # isort: skip
 from context_chat_backend.logger import get_logging_config, setup_logging  # isort: skip
 from context_chat_backend.ocs_utils import sign_request  # isort: skip
 from context_chat_backend.setup_functions import ensure_config_file, setup_env_vars  # isort: skip
+from context_chat_backend.types import TConfig  # isort: skip
 
 
 LOGGER_CONFIG_NAME = 'logger_config_em.yaml'
 # todo: config and env var for this
 MODEL_ALIAS = 'em_model'
 STARTUP_CHECK_SEC = 10
+IDLE_CHECK_SEC = 60
+# requests that do not run the model and do not count as activity
+IDLE_EXEMPT_PATHS = ('/v1/models', '/ccb/')
+
+logger = logging.getLogger('emserver')
+_last_activity = monotonic()
+
+
+def unload_model(reason: str) -> bool:
+	'''
+	Closes the loaded model to free its memory, the llama proxy loads it again with the next request.
+
+	Returns
+	-------
+	bool
+		True if a model was unloaded
+	'''
+	import llama_cpp.server.app as llama_app
+
+	# same lock order as llama_app.get_llama_proxy() to wait for the running requests
+	with llama_app.llama_outer_lock:
+		llama_app.llama_inner_lock.acquire()
+	try:
+		proxy = llama_app._llama_proxy
+		if proxy is None or proxy._current_model is None:
+			return False
+		proxy._current_model.close()
+		proxy._current_model = None
+	finally:
+		llama_app.llama_inner_lock.release()
+
+	gc.collect()
+	metrics.inc('embedding_server.unloads')
+	metrics.set_gauge('embedding_server.model_loaded', 0)
+	logger.info(f'Embedding model unloaded ({reason})')
+	return True
+
+
+def time_model_loads():
+	'''
+	Records the (re)load time of the model, the reloads after an unload happen in the first request.
+	'''
+	from llama_cpp.server.model import LlamaProxy
+
+	load = LlamaProxy.load_llama_from_model_settings
+
+	def timed_load(settings):
+		start = monotonic()
+		model = load(settings)
+		elapsed = monotonic() - start
+		metrics.observe('embedding_server.model_load_secs', elapsed)
+		metrics.set_gauge('embedding_server.model_loaded', 1)
+		logger.info(f'Embedding model loaded in {elapsed:.2f} seconds')
+		return model
+
+	LlamaProxy.load_llama_from_model_settings = staticmethod(timed_load)
+
+
+def setup_idle_offload(app: FastAPI, offload_after_mins: int):
+	@app.middleware('http')
+	async def track_activity(request: Request, call_next):
+		global _last_activity
+		if request.url.path.startswith(IDLE_EXEMPT_PATHS):
+			return await call_next(request)
+
+		_last_activity = monotonic()
+		try:
+			return await call_next(request)
+		finally:
+			_last_activity = monotonic()
+
+	@app.get('/ccb/health')
+	async def _():
+		# does not take the locks of the llama proxy, a busy server is still healthy
+		return JSONResponse(content={'status': 'ok'})
+
+	@app.get('/ccb/metrics')
+	def _():
+		return JSONResponse(content=metrics.snapshot())
+
+	@app.post('/ccb/offload')
+	def _():
+		return JSONResponse(content={'unloaded': unload_model('requested')})
+
+	if offload_after_mins <= 0:
+		return
+
+	def offload_idle():
+		while True:
+			sleep(IDLE_CHECK_SEC)
+			if monotonic() - _last_activity < offload_after_mins * 60:
+				continue
+			try:
+				unload_model(f'idle for more than {offload_after_mins} minutes')
+			except Exception as e:
+				logger.exception('Error unloading the idle embedding model', exc_info=e)
+
+	threading.Thread(target=offload_idle, name='em-idle-offload', daemon=True).start()
+
+
+def run_server(app_config: TConfig, logging_config: dict, host: str, port: int):
+	em_conf = app_config.embedding
+
+	# delayed import for libcuda.so.1 to be available
+	from llama_cpp.server.app import create_app
+	from llama_cpp.server.settings import ModelSettings, ServerSettings
+
+	time_model_loads()
+	server_settings = ServerSettings(
+		host=host,
+		port=port,
+	)
+	model_settings = [ModelSettings(model_alias=MODEL_ALIAS, embedding=True, **em_conf.llama)]
+	app = create_app(
+		server_settings=server_settings,
+		model_settings=model_settings,
+	)
+	setup_idle_offload(app, em_conf.offload_after_mins)
+
+	uv_log_config = uvicorn.config.LOGGING_CONFIG  # pyright: ignore[reportAttributeAccessIssue]
+	uv_log_config['formatters']['json'] = logging_config['formatters']['json']
+	uv_log_config['handlers']['file_json'] = logging_config['handlers']['file_json']
+
+	uv_log_config['loggers']['uvicorn']['handlers'].append('file_json')
+	uv_log_config['loggers']['uvicorn.access']['handlers'].append('file_json')
+
+	uvicorn.run(
+		# todo: use string import of the app
+		app=app,
+		host=host,
+		port=port,
+		http='h11',
+		interface='asgi3',
+		log_config=uv_log_config,
+		log_level=app_config.uvicorn_log_level,
+		use_colors=bool(app_config.use_colors and os.getenv('CI', 'false') == 'false'),
+		workers=em_conf.workers,
+	)
 
 
 if __name__ == '__main__':
@@ -39,7 +184,6 @@ if __name__ == '__main__':
 
 	logging_config = get_logging_config(LOGGER_CONFIG_NAME)
 	setup_logging(logging_config)
-	logger = logging.getLogger('emserver')
 	if app_config.debug:
 		logger.setLevel(logging.DEBUG)
 
@@ -85,36 +229,24 @@ if __name__ == '__main__':
 		if not os.path.isfile(em_conf.llama['model']):
 			raise ValueError('Error: Model file not found at the updated path')
 
-	# delayed import for libcuda.so.1 to be available
-	from llama_cpp.server.app import create_app
-	from llama_cpp.server.settings import ModelSettings, ServerSettings
-
-	server_settings = ServerSettings(
-		host=em_conf.host,
-		port=em_conf.port,
-	)
-	model_settings = [ModelSettings(model_alias=MODEL_ALIAS, embedding=True, **em_conf.llama)]
-	app = create_app(
-		server_settings=server_settings,
-		model_settings=model_settings,
-	)
-
-	uv_log_config = uvicorn.config.LOGGING_CONFIG  # pyright: ignore[reportAttributeAccessIssue]
-	uv_log_config['formatters']['json'] = logging_config['formatters']['json']
-	uv_log_config['handlers']['file_json'] = logging_config['handlers']['file_json']
-
-	uv_log_config['loggers']['uvicorn']['handlers'].append('file_json')
-	uv_log_config['loggers']['uvicorn.access']['handlers'].append('file_json')
+	local_endpoints = [e for e in em_conf.get_endpoints() if e.local]
+	if len(local_endpoints) == 0:
+		print('No local embedding endpoints configured, exiting...', flush=True)
+		exit(0)
 
-	uvicorn.run(
-		# todo: use string import of the app
-		app=app,
-		host=em_conf.host,
-		port=em_conf.port,
-		http='h11',
-		interface='asgi3',
-		log_config=uv_log_config,
-		log_level=app_config.uvicorn_log_level,
-		use_colors=bool(app_config.use_colors and os.getenv('CI', 'false') == 'false'),
-		workers=em_conf.workers,
-	)
+	if len(local_endpoints) == 1:
+		run_server(app_config, logging_config, local_endpoints[0].host, local_endpoints[0].port)
+	else:
+		# one server process per endpoint, each one loads its own copy of the model
+		servers = [
+			mp.Process(
+				target=run_server,
+				args=(app_config, logging_config, endpoint.host, endpoint.port),
+				name=f'em-server-{endpoint.port}',
+			)
+			for endpoint in local_endpoints
+		]
+		for server in servers:
+			server.start()
+		for server in servers:
+			server.join()
@@ -0,0 +1,145 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import asyncio
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+from context_chat_backend.admission import AdmissionException, AdmissionScheduler
+
+
+def _scheduler(**kwargs) -> AdmissionScheduler:
+	options = {
+		'max_in_flight': 1,
+		'max_queued': 8,
+		'queue_timeout_secs': 5,
+		'priority_secs_per_kchar': 10,
+		**kwargs,
+	}
+	return AdmissionScheduler('test.admission', **options)
+
+
+def _wait_queued(scheduler: AdmissionScheduler, count: int):
+	deadline = monotonic() + 5
+	while len(scheduler._queue) < count:
+		assert monotonic() < deadline, 'the requests were not queued'
+		sleep(0.005)
+
+
+class _RacyScheduler(AdmissionScheduler):
+	'''
+	The running request is released right when a waiter gives up, before it is removed from the queue
+	'''
+	def _dequeue(self, waiter):
+		self.release()
+		return super()._dequeue(waiter)
+
+
+def test_short_prompts_are_admitted_first():
+	# one second per character, the prompt length decides over the arrival time
+	scheduler = _scheduler(priority_secs_per_kchar=1000)
+	scheduler.acquire()
+
+	admitted = []
+
+	def query(prompt_len: int):
+		with scheduler.slot(prompt_len):
+			admitted.append(prompt_len)
+
+	threads = []
+	for prompt_len in (3000, 2000, 10):
+		threads.append(threading.Thread(target=query, args=(prompt_len,)))
+		threads[-1].start()
+		_wait_queued(scheduler, len(threads))
+
+	scheduler.release()
+	for thread in threads:
+		thread.join(5)
+
+	assert admitted == [10, 2000, 3000]
+	assert scheduler._in_flight == 0
+
+
+def test_full_queue_is_rejected():
+	scheduler = _scheduler(max_queued=1, queue_timeout_secs=7)
+	scheduler.acquire()
+	thread = threading.Thread(target=scheduler.acquire)
+	thread.start()
+	_wait_queued(scheduler, 1)
+
+	with pytest.raises(AdmissionException) as e:
+		scheduler.acquire()
+	assert e.value.retry_after == 7
+
+	scheduler.release()
+	thread.join(5)
+
+
+def test_waiter_times_out():
+	scheduler = _scheduler(queue_timeout_secs=0.05)
+	scheduler.acquire()
+
+	with pytest.raises(AdmissionException):
+		scheduler.acquire()
+	assert len(scheduler._queue) == 0
+	assert scheduler._in_flight == 1
+
+
+def test_async_waiter_times_out():
+	scheduler = _scheduler(queue_timeout_secs=0.05)
+	scheduler.acquire()
+
+	with pytest.raises(AdmissionException):
+		asyncio.run(scheduler.aacquire())
+	assert len(scheduler._queue) == 0
+	assert scheduler._in_flight == 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+	scheduler = _scheduler()
+	scheduler.acquire()
+
+	async def cancel():
+		task = asyncio.create_task(scheduler.aacquire())
+		await asyncio.sleep(0.01)
+		task.cancel()
+		with pytest.raises(asyncio.CancelledError):
+			await task
+
+	asyncio.run(cancel())
+	assert len(scheduler._queue) == 0
+
+	scheduler.release()
+	assert scheduler._in_flight == 0
+
+
+def test_slot_granted_during_a_timeout_is_used():
+	scheduler = _RacyScheduler('test.admission', 1, 8, 0.01, 10)
+	scheduler.acquire()
+
+	# the waiter got the released slot, it is admitted instead of timing out
+	scheduler.acquire()
+	assert scheduler._in_flight == 1
+
+	scheduler.release()
+	asyncio.run(scheduler.aacquire())
+	assert scheduler._in_flight == 1
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_released():
+	scheduler = _RacyScheduler('test.admission', 1, 8, 5, 10)
+	scheduler.acquire()
+
+	async def cancel():
+		task = asyncio.create_task(scheduler.aacquire())
+		await asyncio.sleep(0.01)
+		task.cancel()
+		with pytest.raises(asyncio.CancelledError):
+			await task
+
+	asyncio.run(cancel())
+	assert len(scheduler._queue) == 0
+	assert scheduler._in_flight == 0
@@ -0,0 +1,101 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from typing import Any
+
+import pytest
+
+pytest.importorskip('langchain_core')
+
+from langchain_core.language_models.llms import LLM  # noqa: E402
+from langchain_core.outputs import LLMResult  # noqa: E402
+
+from context_chat_backend.models.batching import BatchedLLM  # noqa: E402
+
+
+class _FakeLLM(LLM):
+	'''
+	Answers with the upper case prompt and records the generate() batches
+	'''
+	batches: list[tuple[list[str], list[str] | None]] = []
+	error: str | None = None
+	delay: float = 0.05
+
+	@property
+	def _llm_type(self) -> str:
+		return 'fake'
+
+	def _call(self, prompt: str, stop: list[str] | None = None, run_manager: Any = None, **kwargs: Any) -> str:
+		return prompt.upper()
+
+	def _generate(
+		self,
+		prompts: list[str],
+		stop: list[str] | None = None,
+		run_manager: Any = None,
+		**kwargs: Any,
+	) -> LLMResult:
+		self.batches.append((list(prompts), stop))
+		# the next callers queue up while the batch is generated
+		sleep(self.delay)
+		if self.error is not None:
+			raise RuntimeError(self.error)
+		return super()._generate(prompts, stop, run_manager, **kwargs)
+
+
+def _invoke_all(llm: BatchedLLM, prompts: list[str], stops: list[list[str] | None]) -> list[Any]:
+	barrier = threading.Barrier(len(prompts))
+
+	def invoke(prompt: str, stop: list[str] | None) -> Any:
+		barrier.wait()
+		try:
+			return llm.invoke(prompt, stop=stop)
+		except Exception as e:
+			return e
+
+	with ThreadPoolExecutor(len(prompts)) as executor:
+		return list(executor.map(invoke, prompts, stops))
+
+
+def test_concurrent_calls_are_generated_in_batches():
+	fake = _FakeLLM()
+	llm = BatchedLLM(llm=fake, max_batch_size=4, batch_wait_ms=50)
+	prompts = [f'prompt {i}' for i in range(10)]
+
+	outputs = _invoke_all(llm, prompts, [None] * len(prompts))
+
+	# every caller gets its own output, also when another caller led the batch
+	assert outputs == [prompt.upper() for prompt in prompts]
+	assert sorted(p for batch, _ in fake.batches for p in batch) == sorted(prompts)
+	assert all(len(batch) <= 4 for batch, _ in fake.batches)
+	assert len(fake.batches) < len(prompts)
+
+
+def test_prompts_with_other_stop_words_are_not_batched_together():
+	fake = _FakeLLM()
+	llm = BatchedLLM(llm=fake, max_batch_size=8, batch_wait_ms=50)
+	stops = [['</s>'], None, ['</s>'], None, ['</s>'], None]
+
+	outputs = _invoke_all(llm, [f'prompt {i}' for i in range(len(stops))], stops)
+
+	assert outputs == [f'PROMPT {i}' for i in range(len(stops))]
+	for batch, stop in fake.batches:
+		assert all(stops[int(prompt.split()[1])] == stop for prompt in batch)
+
+
+def test_batch_error_is_raised_to_every_caller():
+	fake = _FakeLLM(error='model error')
+	llm = BatchedLLM(llm=fake, max_batch_size=4, batch_wait_ms=50)
+
+	outputs = _invoke_all(llm, [f'prompt {i}' for i in range(4)], [None] * 4)
+
+	assert all(isinstance(output, RuntimeError) and str(output) == 'model error' for output in outputs)
+
+
+def test_stream_of_a_model_that_cannot_stream_is_one_chunk():
+	llm = BatchedLLM(llm=_FakeLLM(), max_batch_size=4, batch_wait_ms=0)
+	assert list(llm.stream('prompt')) == ['PROMPT']
@@ -0,0 +1,148 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import asyncio
+from collections.abc import Iterator
+from contextlib import suppress
+from datetime import UTC, datetime, timedelta
+from email.utils import format_datetime
+from time import monotonic
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+pytest.importorskip('nc_py_api')
+
+from nc_py_api import NextcloudException  # noqa: E402
+
+from context_chat_backend.models import task_processing  # noqa: E402
+from context_chat_backend.models.task_processing import TaskProcessingClient, TaskProcessingConfig  # noqa: E402
+
+
+def _rate_limited(retry_after: str | None) -> NextcloudException:
+	headers = {'Retry-After': retry_after} if retry_after is not None else {}
+	return NextcloudException(429, reason='Too Many Requests', response=SimpleNamespace(headers=headers))
+
+
+class _FakeNc:
+	'''
+	Schedules task 1 and answers its polls with the given task statuses or exceptions
+	'''
+	def __init__(self, polls: list[str | Exception]):
+		self.polls = polls
+		self.poll_times: list[float] = []
+
+	async def ocs(self, method: str, path: str, json: Any = None) -> dict:
+		if method == 'POST':
+			return {'task': {'id': 1, 'status': 'STATUS_SCHEDULED'}}
+
+		self.poll_times.append(monotonic())
+		status = self.polls.pop(0)
+		if isinstance(status, Exception):
+			raise status
+		return {'task': {'id': 1, 'status': status, 'output': {'output': 'answer'}}}
+
+
+class _Client(TaskProcessingClient):
+	def __init__(self, config: TaskProcessingConfig, nc: _FakeNc):
+		self.fake_nc = nc
+		super().__init__(config)
+
+	async def _nc(self, user_id: str | None) -> Any:
+		return self.fake_nc
+
+
+@pytest.fixture
+def client_for() -> Iterator:
+	clients = []
+
+	def make(config: TaskProcessingConfig, nc: _FakeNc) -> _Client:
+		clients.append(_Client(config, nc))
+		return clients[-1]
+
+	yield make
+	for client in clients:
+		asyncio.run_coroutine_threadsafe(_stop_poller(client), client._loop).result(5)
+		client._loop.call_soon_threadsafe(client._loop.stop)
+
+
+async def _stop_poller(client: TaskProcessingClient):
+	client._poller.cancel()
+	with suppress(asyncio.CancelledError):
+		await client._poller
+
+
+def test_poll_interval_backs_off_up_to_the_max(client_for):
+	nc = _FakeNc(['STATUS_RUNNING'] * 4 + ['STATUS_SUCCESSFUL'])
+	config = TaskProcessingConfig(poll_min_secs=0.02, poll_max_secs=0.08, poll_backoff=2)
+	client = client_for(config, nc)
+
+	assert client.run('prompt', 'user').result(timeout=5) == 'answer'
+
+	intervals = [b - a for a, b in zip(nc.poll_times, nc.poll_times[1:])]
+	# 0.04, 0.08 and then capped at 0.08
+	assert intervals[0] >= 0.04
+	assert intervals[1] >= 0.08
+	assert all(interval < 0.08 + 0.05 for interval in intervals[2:])
+
+
+def test_rate_limited_poll_pauses_the_polling(client_for):
+	nc = _FakeNc([_rate_limited('0.3'), 'STATUS_SUCCESSFUL'])
+	config = TaskProcessingConfig(poll_min_secs=0.01, poll_max_secs=0.01)
+	client = client_for(config, nc)
+
+	assert client.run('prompt', 'user').result(timeout=5) == 'answer'
+	assert nc.poll_times[1] - nc.poll_times[0] >= 0.3
+
+
+def test_failed_poll_fails_the_query(client_for):
+	nc = _FakeNc([NextcloudException(500, reason='Internal Server Error')])
+	client = client_for(TaskProcessingConfig(poll_min_secs=0.01), nc)
+
+	with pytest.raises(task_processing.LlmException):
+		client.run('prompt', 'user').result(timeout=5)
+
+
+def test_retry_after_is_read_from_the_response():
+	assert task_processing._retry_after(_rate_limited('3')) == 3
+	assert task_processing._retry_after(_rate_limited('-1')) == 0
+	assert task_processing._retry_after(_rate_limited(None)) == task_processing.DEFAULT_RETRY_AFTER
+	assert task_processing._retry_after(_rate_limited('soon')) == task_processing.DEFAULT_RETRY_AFTER
+
+	date = format_datetime(datetime.now(UTC) + timedelta(seconds=30), usegmt=True)
+	assert 25 < task_processing._retry_after(_rate_limited(date)) <= 30
+
+
+def test_clients_are_shared_per_user_and_evicted(client_for, monkeypatch):
+	created, closed = [], []
+
+	class Adapter:
+		async def close(self):
+			closed.append(self)
+
+	class FakeApp:
+		def __init__(self):
+			self._session = SimpleNamespace(adapter=Adapter(), adapter_dav=Adapter())
+			created.append(self)
+
+		async def set_user(self, user_id: str):
+			# the concurrent first queries of the user arrive meanwhile
+			await asyncio.sleep(0.01)
+
+	monkeypatch.setattr(task_processing, 'AsyncNextcloudApp', FakeApp)
+	monkeypatch.setattr(task_processing, 'MAX_NC_CLIENTS', 2)
+	client = client_for(TaskProcessingConfig(), _FakeNc([]))
+
+	async def get_clients():
+		first = await asyncio.gather(*(TaskProcessingClient._nc(client, 'user1') for _ in range(5)))
+		assert all(nc is first[0] for nc in first)
+		for user_id in ('user2', 'user1', 'user3'):
+			await TaskProcessingClient._nc(client, user_id)
+
+	asyncio.run_coroutine_threadsafe(get_clients(), client._loop).result(5)
+	assert len(created) == 3
+	# user2 was the least recently used
+	assert list(client._ncs) == ['user1', 'user3']
+	assert len(closed) == 2
@@ -0,0 +1,84 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import gc
+from typing import Any
+
+import pytest
+
+pytest.importorskip('langchain_community')
+
+from langchain_core.language_models.llms import LLM  # noqa: E402
+
+from context_chat_backend.chain import token_counter  # noqa: E402
+from context_chat_backend.chain.token_counter import TokenCounter, get_token_counter  # noqa: E402
+from context_chat_backend.models.batching import BatchedLLM  # noqa: E402
+
+
+class _WordsLLM(LLM):
+	'''
+	One token per word, counts the calls of the tokenizer
+	'''
+	calls: int = 0
+
+	@property
+	def _llm_type(self) -> str:
+		return 'words'
+
+	def _call(self, prompt: str, stop: list[str] | None = None, run_manager: Any = None, **kwargs: Any) -> str:
+		return prompt
+
+	def get_num_tokens(self, text: str) -> int:
+		self.calls += 1
+		return len(text.split())
+
+
+def test_truncate_keeps_the_words_that_fit():
+	llm = _WordsLLM()
+	counter = TokenCounter(llm)
+	text = ' '.join(f'word{i}' for i in range(100))
+
+	assert counter.truncate(text, 10) == ' '.join(f'word{i}' for i in range(10))
+	# one count of the whole text and a binary search over the 100 words
+	assert llm.calls <= 1 + 7
+
+
+def test_truncate_edge_cases():
+	# the counter only has a weak reference to the model
+	llm = _WordsLLM()
+	counter = TokenCounter(llm)
+	assert counter.truncate('a b c', 3) == 'a b c'
+	assert counter.truncate('a b c', 0) == ''
+	assert counter.truncate('  a b c', 1) == '  a'
+
+
+def test_memoized_counts_are_evicted_least_recently_used_first(monkeypatch):
+	monkeypatch.setattr(token_counter, 'MAX_MEMOIZED', 2)
+	llm = _WordsLLM()
+	counter = TokenCounter(llm)
+
+	assert counter.count_many(['a', 'b b', 'c c c'], ['1', '2', '3']) == [1, 2, 3]
+	assert list(counter._memo) == ['2', '3']
+	assert llm.calls == 3
+
+	# 2 is memoized and used again, 1 was evicted and is encoded again
+	assert counter.count_many(['b b', 'a'], ['2', '1']) == [2, 1]
+	assert llm.calls == 4
+	assert list(counter._memo) == ['2', '1']
+
+	# texts without a key are not memoized
+	assert counter.count_many(['d d d d'], [None]) == [4]
+	assert list(counter._memo) == ['2', '1']
+
+
+def test_counter_is_shared_by_the_model_and_its_batched_wrapper():
+	llm = _WordsLLM()
+	counter = get_token_counter(llm)
+	assert get_token_counter(BatchedLLM(llm=llm)) is counter
+
+	# the counter is forgotten with the offloaded model
+	key = id(llm)
+	del counter, llm
+	gc.collect()
+	assert key not in token_counter._counters
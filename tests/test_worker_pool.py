@@ -0,0 +1,85 @@
+#
+# SPDX-FileCopyrightText: 2025 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import threading
+from time import sleep
+
+import pytest
+
+from context_chat_backend import metrics
+from context_chat_backend.worker_pool import WorkerPool, WorkerPoolBusyException
+
+
+def _sleep_task(secs: float) -> float:
+	sleep(secs)
+	return secs
+
+
+def _count_task():
+	metrics.inc('test.task')
+	return True
+
+
+@pytest.fixture
+def _reset_metrics():
+	metrics.drain()
+	yield
+	metrics.drain()
+
+
+def _counter(name: str) -> float:
+	return metrics.snapshot().get(name, 0)
+
+
+def test_submit_returns_the_result():
+	pool = WorkerPool('test-worker', 1, daemon=True)
+	try:
+		assert pool.submit(_sleep_task, args=(0,)) == 0
+	finally:
+		pool.shutdown()
+
+
+def test_busy_pool_raises_after_the_wait_timeout():
+	pool = WorkerPool('test-worker', 1, daemon=True)
+	busy = threading.Thread(target=pool.submit, args=(_sleep_task,), kwargs={'args': (1,)})
+	try:
+		busy.start()
+		sleep(0.2)
+		with pytest.raises(WorkerPoolBusyException):
+			pool.submit(_sleep_task, args=(0,), wait_timeout=0.1)
+
+		# the worker is used again once it is free
+		busy.join()
+		assert pool.submit(_sleep_task, args=(0,), wait_timeout=1) == 0
+	finally:
+		pool.shutdown()
+
+
+@pytest.mark.usefixtures('_reset_metrics')
+def test_recycled_workers_do_not_resend_the_parent_counters():
+	metrics.inc('test.parent', 5)
+	# every task runs in a new worker forked from the parent
+	pool = WorkerPool('test-worker', 1, max_tasks=1, daemon=True)
+	try:
+		for _ in range(3):
+			assert pool.submit(_count_task) is True
+	finally:
+		pool.shutdown()
+
+	assert _counter('test.parent') == 5
+	assert _counter('test.task') == 3
+
+
+@pytest.mark.usefixtures('_reset_metrics')
+def test_long_lived_worker_sends_each_counter_once():
+	metrics.inc('test.parent', 2)
+	pool = WorkerPool('test-worker', 1, daemon=True)
+	try:
+		for _ in range(3):
+			pool.submit(_count_task)
+	finally:
+		pool.shutdown()
+
+	assert _counter('test.parent') == 2
+	assert _counter('test.task') == 3